@@ -63,6 +63,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, so its total covers the other middleware too
+    'storefront.middleware.PerformanceMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -70,6 +72,7 @@ MIDDLEWARE = [
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
+    'storefront.middleware.CartCookieMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
@@ -85,6 +88,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'storefront.context_processors.cart',
             ],
         },
     },
@@ -96,12 +100,156 @@ WSGI_APPLICATION = 'ecommerce.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
-DATABASES = {
+# Pick the database with DJANGO_DB_ENGINE (sqlite or postgresql). Connections
+# are kept open between requests for DJANGO_DB_CONN_MAX_AGE seconds and
+# checked before reuse. DJANGO_DB_POOL_SIZE > 0 uses a psycopg connection
+# pool on PostgreSQL instead, which replaces persistent connections.
+# SQLite runs in WAL mode so readers don't block the writer, and starts
+# every transaction with BEGIN IMMEDIATE so concurrent writers queue on the
+# busy timeout (DJANGO_DB_TIMEOUT) instead of failing with "database is
+# locked" when a read transaction tries to write.
+
+_db_engine = os.environ.get('DJANGO_DB_ENGINE', 'sqlite')
+_db_pool_size = int(os.environ.get('DJANGO_DB_POOL_SIZE', 0))
+
+if _db_engine == 'postgresql':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('DJANGO_DB_NAME', 'controllerhub'),
+            'USER': os.environ.get('DJANGO_DB_USER', ''),
+            'PASSWORD': os.environ.get('DJANGO_DB_PASSWORD', ''),
+            'HOST': os.environ.get('DJANGO_DB_HOST', ''),
+            'PORT': os.environ.get('DJANGO_DB_PORT', ''),
+            'CONN_MAX_AGE': 0 if _db_pool_size else int(os.environ.get('DJANGO_DB_CONN_MAX_AGE', 60)),
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {'pool': {'min_size': min(2, _db_pool_size), 'max_size': _db_pool_size}} if _db_pool_size else {},
+        }
+    }
+elif _db_engine == 'sqlite':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.environ.get('DJANGO_DB_NAME', BASE_DIR / 'db.sqlite3'),
+            'CONN_MAX_AGE': int(os.environ.get('DJANGO_DB_CONN_MAX_AGE', 60)),
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {
+                'timeout': int(os.environ.get('DJANGO_DB_TIMEOUT', 20)),
+                'transaction_mode': 'IMMEDIATE',
+                'init_command': (
+                    'PRAGMA journal_mode=WAL;'
+                    f"PRAGMA synchronous={os.environ.get('DJANGO_SQLITE_SYNCHRONOUS', 'NORMAL')};"
+                    f"PRAGMA mmap_size={int(os.environ.get('DJANGO_SQLITE_MMAP_SIZE', 128 * 2**20))};"
+                    'PRAGMA temp_store=MEMORY;'
+                ),
+            },
+        }
+    }
+else:
+    raise ValueError(f"Unknown DJANGO_DB_ENGINE {_db_engine!r}")
+
+
+# Cache
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+# Pick the backend with DJANGO_CACHE_BACKEND (locmem, file or redis) and
+# point it somewhere with DJANGO_CACHE_LOCATION (a directory for file, a
+# redis:// URL for redis). Any Redis protocol compatible server will do.
+# locmem is per process: run more than one web process on redis, or a
+# change only invalidates the pages cached by the process that made it.
+# DJANGO_CACHE_STATS=1 counts hits and misses for `manage.py cache_stats`,
+# at the cost of a cache write per lookup.
+
+CACHE_BACKENDS = {
+    'locmem': ('django.core.cache.backends.locmem.LocMemCache', 'controllerhub'),
+    'file': ('django.core.cache.backends.filebased.FileBasedCache',
+             str(os.path.join(BASE_DIR, 'cache'))),
+    'redis': ('django.core.cache.backends.redis.RedisCache', 'redis://127.0.0.1:6379/1'),
+}
+_cache_backend, _cache_location = CACHE_BACKENDS[os.environ.get('DJANGO_CACHE_BACKEND', 'locmem')]
+
+CACHES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'BACKEND': _cache_backend,
+        'LOCATION': os.environ.get('DJANGO_CACHE_LOCATION', _cache_location),
+        'TIMEOUT': int(os.environ.get('DJANGO_CACHE_TIMEOUT', 600)),
+        'KEY_PREFIX': 'controllerhub',
     }
 }
+CACHE_STATS = os.environ.get('DJANGO_CACHE_STATS', '') == '1'
+
+
+# Sessions
+# https://docs.djangoproject.com/en/5.2/topics/http/sessions/
+# Pick where sessions live with DJANGO_SESSION_ENGINE:
+#   db              a django_session row, read and written per request
+#   cached_db       read from the cache, written through to the database
+#   cache           the cache only, logs everyone out when it is flushed
+#   signed_cookies  the session itself in a signed cookie, no server state
+# cached_db and cache need DJANGO_CACHE_BACKEND=redis: with a per-process
+# cache, a logout handled by one worker would go unseen by the others
+# until their copy of the session expired.
+# Anonymous carts don't use the session (see storefront/carts.py), so
+# browsing and shopping logged out doesn't create sessions at all. Run
+# `python manage.py purge_sessions` periodically with db or cached_db.
+
+SESSION_ENGINES = {
+    'db': 'django.contrib.sessions.backends.db',
+    'cached_db': 'django.contrib.sessions.backends.cached_db',
+    'cache': 'django.contrib.sessions.backends.cache',
+    'signed_cookies': 'django.contrib.sessions.backends.signed_cookies',
+}
+_session_engine = os.environ.get('DJANGO_SESSION_ENGINE', 'db')
+if _session_engine in ('cached_db', 'cache') and _cache_backend != CACHE_BACKENDS['redis'][0]:
+    raise ValueError(f"DJANGO_SESSION_ENGINE {_session_engine!r} needs DJANGO_CACHE_BACKEND=redis")
+SESSION_ENGINE = SESSION_ENGINES[_session_engine]
+SESSION_COOKIE_AGE = int(os.environ.get('DJANGO_SESSION_COOKIE_AGE', 60 * 60 * 24 * 14))
+
+
+# Email
+# https://docs.djangoproject.com/en/5.2/topics/email/
+# Views queue emails in the database (storefront/outbox.py), run
+# `python manage.py send_outbox --loop` next to the web server to send them.
+
+EMAIL_BACKEND = os.environ.get('DJANGO_EMAIL_BACKEND', 'django.core.mail.backends.smtp.EmailBackend')
+EMAIL_HOST = os.environ.get('DJANGO_EMAIL_HOST', 'localhost')
+EMAIL_PORT = int(os.environ.get('DJANGO_EMAIL_PORT', 25))
+EMAIL_HOST_USER = os.environ.get('DJANGO_EMAIL_HOST_USER', '')
+EMAIL_HOST_PASSWORD = os.environ.get('DJANGO_EMAIL_HOST_PASSWORD', '')
+EMAIL_USE_TLS = os.environ.get('DJANGO_EMAIL_USE_TLS', '') == '1'
+EMAIL_TIMEOUT = 10
+# For the file based backend
+EMAIL_FILE_PATH = os.environ.get('DJANGO_EMAIL_FILE_PATH', str(os.path.join(BASE_DIR, 'sent_emails')))
+DEFAULT_FROM_EMAIL = os.environ.get('DJANGO_DEFAULT_FROM_EMAIL', 'Wavelength <noreply@wavelength.local>')
+# Receives the contact form notifications
+ADMIN_EMAIL = os.environ.get('DJANGO_ADMIN_EMAIL', 'admin@wavelength.local')
+
+
+# Performance instrumentation
+# DJANGO_PERF_TIMING=1 turns on storefront.middleware.PerformanceMiddleware,
+# which sends query, template and cache timings in a Server-Timing header
+# and logs them per request. DJANGO_PERF_PROFILE_SAMPLE (0 to 1) is the
+# share of requests also run under cProfile, whose profiles are kept in
+# DJANGO_PERF_PROFILE_DIR when slower than DJANGO_PERF_SLOW_REQUEST_MS.
+# Off, the middleware removes itself at startup.
+
+PERF_TIMING = os.environ.get('DJANGO_PERF_TIMING', '') == '1'
+PERF_PROFILE_SAMPLE = float(os.environ.get('DJANGO_PERF_PROFILE_SAMPLE', 0))
+PERF_SLOW_REQUEST_MS = float(os.environ.get('DJANGO_PERF_SLOW_REQUEST_MS', 500))
+PERF_PROFILE_DIR = os.environ.get('DJANGO_PERF_PROFILE_DIR', str(os.path.join(BASE_DIR, 'profiles')))
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'storefront': {
+            'handlers': ['console'],
+            'level': os.environ.get('DJANGO_LOG_LEVEL', 'INFO'),
+        },
+    },
+}
 
 
 # Password validation
@@ -147,8 +295,33 @@ STATICFILES_DIRS = [str(os.path.join(BASE_DIR, 'static/'))]
 
 # Where `collectstatic` will collect static files for production
 STATIC_ROOT = str(os.path.join(BASE_DIR, 'staticfiles'))
-# Use WhiteNoise storage for compressed files in production
-# STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
+
+# Pick how static and media files are served with DJANGO_ASSET_MODE:
+#   django      both through django.views.static.serve (the default)
+#   whitenoise  static files hashed and precompressed (gzip and brotli) by
+#               collectstatic and served by WhiteNoise with far-future cache
+#               headers, media through storefront.media.serve with ETags
+#               and range requests
+#   sendfile    as whitenoise, but media is handed off to the front end
+#               server with DJANGO_SENDFILE_HEADER, X-Accel-Redirect for
+#               nginx (to an internal location at DJANGO_SENDFILE_PREFIX)
+#               or X-Sendfile for Apache
+ASSET_MODE = os.environ.get('DJANGO_ASSET_MODE', 'django')
+if ASSET_MODE not in ('django', 'whitenoise', 'sendfile'):
+    raise ValueError(f"Unknown DJANGO_ASSET_MODE {ASSET_MODE!r}")
+
+if ASSET_MODE != 'django':
+    STORAGES = {
+        'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+        'staticfiles': {'BACKEND': 'whitenoise.storage.CompressedManifestStaticFilesStorage'},
+    }
+    # Hashed file names always get a year, this is for the rest
+    WHITENOISE_MAX_AGE = int(os.environ.get('DJANGO_STATIC_MAX_AGE', 3600))
+
+SENDFILE_HEADER = os.environ.get('DJANGO_SENDFILE_HEADER', 'X-Accel-Redirect')
+SENDFILE_PREFIX = os.environ.get('DJANGO_SENDFILE_PREFIX', '/internal-media/')
+# Media names aren't hashed, so they are revalidated with their ETag
+MEDIA_MAX_AGE = int(os.environ.get('DJANGO_MEDIA_MAX_AGE', 86400))
 
 
 print(BASE_DIR)
@@ -22,14 +22,24 @@ import os
 import sys
 
 from django.views.static import serve
+from storefront import media
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('', include('storefront.urls')),
     path('accounts/', include('django.contrib.auth.urls')),
-    re_path(r'^media/(?P<path>.*)$', serve,
-            {'document_root': settings.MEDIA_ROOT}),
-    re_path(r'^static/(?P<path>.*)$', serve,
-            {'document_root': settings.STATIC_ROOT}),
+]
 
-] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+if settings.ASSET_MODE == 'django':
+    urlpatterns += [
+        re_path(r'^media/(?P<path>.*)$', serve,
+                {'document_root': settings.MEDIA_ROOT}),
+        re_path(r'^static/(?P<path>.*)$', serve,
+                {'document_root': settings.STATIC_ROOT}),
+
+    ] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+else:
+    # WhiteNoise middleware answers /static/ before any view runs
+    urlpatterns += [
+        re_path(r'^media/(?P<path>.*)$', media.serve, name='media'),
+    ]
@@ -1,17 +1,43 @@
 from django.contrib import admin
 from .models import Customer, ProductCategory, ProductRange, Product
-from .models import Order, Review, OrderItem, ContactMessage
+from .models import RATING_SUMMARY_FIELDS
+from .models import Order, Review, OrderItem, ContactMessage, OutboundEmail
+from .models import Cart, CartItem, SalesRollup
+from .models import ProductRecommendation, RecommendationBuild
 from django.contrib.auth.models import User
 
 # Register your models here.
 admin.site.register(Customer)
 admin.site.register(ProductCategory)
 admin.site.register(ProductRange)
-admin.site.register(Product)
-admin.site.register(Order, readonly_fields=['date'])
-admin.site.register(OrderItem)
+admin.site.register(Product, readonly_fields=RATING_SUMMARY_FIELDS, search_fields=['name', 'sku'])
+admin.site.register(OrderItem, list_select_related=['order', 'product'])
 admin.site.register(Review, readonly_fields=['created_at'])
 admin.site.register(ContactMessage, readonly_fields=['created_at'])
+admin.site.register(CartItem, list_select_related=['cart', 'product'])
+admin.site.register(Cart, readonly_fields=['created_at', 'updated_at'])
+admin.site.register(OutboundEmail, list_display=['subject', 'status', 'attempts', 'next_attempt_at'],
+                    list_filter=['status'], readonly_fields=['created_at', 'sent_at'])
+admin.site.register(SalesRollup, list_display=['period', 'start', 'dimension', 'key', 'revenue', 'units', 'orders'],
+                    list_filter=['period', 'dimension'])
+admin.site.register(ProductRecommendation, list_display=['product', 'rank', 'recommended', 'score'],
+                    list_select_related=['product', 'recommended'], raw_id_fields=['product', 'recommended'])
+admin.site.register(RecommendationBuild, list_display=['finished_at', 'full', 'through_order', 'products', 'recommendations'])
+
+
+@admin.register(Order)
+class OrderAdmin(admin.ModelAdmin):
+    list_display = ("id", "user", "date", "status", "total_cost")
+    list_filter = ("status",)
+    list_select_related = ("user",)
+    readonly_fields = ["date"]
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).with_totals()
+
+    @admin.display(ordering="total_cost", description="Total")
+    def total_cost(self, obj):
+        return obj.total_cost
 
 
 class CustomerInline(admin.StackedInline):
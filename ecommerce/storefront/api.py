@@ -0,0 +1,289 @@
+"""
+    Versioned JSON API for headless clients, mounted under /api/v1/.
+
+    Catalogue responses carry an ETag derived from the same versioned cache
+    keys the HTML pages use (see caching.py), so checking one costs no
+    database query and a matching If-None-Match gets a 304. Product detail
+    also sends Last-Modified. Every catalogue endpoint takes ?fields=a,b to
+    return only the product fields a client renders.
+
+    The cart is the same one the HTML pages use and goes through carts.py,
+    so prices and totals are identical. POSTs need a CSRF
+    token like the rest of the site, GET /api/v1/cart/ sets the cookie.
+"""
+import functools
+import hashlib
+import json
+
+from django.http import Http404, JsonResponse
+from django.shortcuts import get_object_or_404
+from django.urls import reverse
+from django.views.decorators.csrf import ensure_csrf_cookie
+from django.views.decorators.http import condition, require_http_methods
+
+from . import caching, carts, images, listing
+from .models import OutOfStock, Product, Review
+from .views import REVIEW_KEYS, REVIEWS_PAGE_SIZE, _checkout_details, _place_order
+
+
+def _taxon(taxon):
+    return taxon and {"id": taxon.id, "name": taxon.name}
+
+
+# Field name -> value for a product
+PRODUCT_FIELDS = {
+    "id": lambda p: p.id,
+    "name": lambda p: p.name,
+    "tagline": lambda p: p.tagline,
+    "overview": lambda p: p.overview,
+    "description": lambda p: p.description,
+    "specifications": lambda p: p.specifications,
+    "price": lambda p: p.price,
+    "sale_price": lambda p: p.sale_price,
+    "discount": lambda p: p.discount,
+    "stock": lambda p: p.stock,
+    "image": lambda p: p.image.url if p.image else None,
+    "images": lambda p: {fmt: images.sources(p, fmt)
+                         for fmt in (p.image_variants or {}).get("formats", {})},
+    "category": lambda p: _taxon(p.category),
+    "range": lambda p: _taxon(p.range),
+    "rating": lambda p: p.rating_summary(),
+    "url": lambda p: reverse("product", args=[p.id]),
+}
+LISTING_FIELDS = ("id", "name", "tagline", "price", "sale_price", "discount",
+                  "stock", "image", "category", "range", "rating", "url")
+
+
+class BadRequest(Exception):
+    pass
+
+
+def _error(status, message, **extra):
+    return JsonResponse({"error": message, **extra}, status=status)
+
+
+def api_view(view):
+    """Turns BadRequest and Http404 raised by an API view into JSON errors."""
+    @functools.wraps(view)
+    def wrapped(request, *args, **kwargs):
+        try:
+            return view(request, *args, **kwargs)
+        except BadRequest as e:
+            return _error(400, str(e))
+        except Http404:
+            return _error(404, "Not found")
+    return wrapped
+
+
+def _fields(request, default):
+    """Returns the product fields asked for with ?fields=, or default."""
+    requested = request.GET.get("fields")
+    if not requested:
+        return default
+    fields = [f.strip() for f in requested.split(",") if f.strip()]
+    unknown = [f for f in fields if f not in PRODUCT_FIELDS]
+    if unknown:
+        raise BadRequest(f"Unknown fields: {', '.join(unknown)}")
+    return fields
+
+
+def _load_deferred(products, fields) -> None:
+    # Listings hold catalogue cards, read any long text fields asked for
+    # with one query rather than one per product
+    deferred = products and sorted(products[0].get_deferred_fields() & set(fields))
+    if not deferred:
+        return
+    rows = Product.objects.filter(pk__in=[p.pk for p in products]).values("pk", *deferred)
+    values = {row.pop("pk"): row for row in rows}
+    for product in products:
+        for field, value in values.get(product.pk, {}).items():
+            setattr(product, field, value)
+
+
+def _product_data(product, fields) -> dict:
+    return {field: PRODUCT_FIELDS[field](product) for field in fields}
+
+
+def _request_data(request):
+    """Reads a POST body sent as JSON or as a form."""
+    if request.content_type == "application/json":
+        try:
+            data = json.loads(request.body or b"{}")
+        except ValueError:
+            raise BadRequest("Malformed JSON body")
+        if not isinstance(data, dict):
+            raise BadRequest("Expected a JSON object")
+        return {key: "" if value is None else str(value) for key, value in data.items()}
+    return request.POST
+
+
+def _etag(key, request) -> str:
+    """Tags a response by its versioned cache key and the query string."""
+    return hashlib.md5(f"{key}?{request.GET.urlencode()}".encode()).hexdigest()
+
+
+# --------------------
+# Catalogue
+# --------------------
+def _products_etag(request):
+    return _etag(caching.listing_key(**listing.parse_params(request.GET)), request)
+
+
+@require_http_methods(["GET", "HEAD"])
+@condition(etag_func=_products_etag)
+@api_view
+def products(request):
+    """
+        Returns one page of products with the same search, sort, rating and
+        facet filters as the products page, sharing its cache entries.
+    """
+    fields = _fields(request, LISTING_FIELDS)
+    params = listing.parse_params(request.GET)
+    page = caching.get_or_set(caching.listing_key(**params),
+                              lambda: listing.build_listing(params))
+    _load_deferred(page["products"], fields)
+    return JsonResponse({
+        "count": page["count"],
+        "suggestion": page["suggestion"],
+        "next": page["next"],
+        "previous": page["previous"],
+        "facets": {"categories": page["facets"]["categories"],
+                   "ranges": page["facets"]["ranges"]},
+        "results": [_product_data(p, fields) for p in page["products"]],
+    })
+
+
+def _cached_product(pk):
+    def load():
+        return get_object_or_404(Product.objects.select_related("category", "range"),
+                                 pk=pk, display_item=True)
+    return caching.get_or_set(f"{caching.product_key(pk)}:api", load)
+
+
+def _product_etag(request, pk):
+    return _etag(caching.product_key(pk), request)
+
+
+def _product_last_modified(request, pk):
+    try:
+        return _cached_product(pk).updated_at
+    except Http404:
+        return None
+
+
+@require_http_methods(["GET", "HEAD"])
+@condition(etag_func=_product_etag, last_modified_func=_product_last_modified)
+@api_view
+def product(request, pk):
+    return JsonResponse(_product_data(_cached_product(pk),
+                                      _fields(request, list(PRODUCT_FIELDS))))
+
+
+@require_http_methods(["GET", "HEAD"])
+@condition(etag_func=_product_etag)
+@api_view
+def reviews(request, pk):
+    """Returns a product's reviews newest first, paged with ?after/?before cursors."""
+    after = listing.decode_cursor(request.GET.get("after"), REVIEW_KEYS, Review)
+    before = listing.decode_cursor(request.GET.get("before"), REVIEW_KEYS, Review)
+
+    def load():
+        product = _cached_product(pk)
+        queryset = Review.objects.filter(product=product).select_related("user")
+        page = listing.keyset_page(queryset, REVIEW_KEYS, after=after, before=before,
+                                   size=REVIEWS_PAGE_SIZE)
+        return {"summary": product.rating_summary(),
+                "next": page["next"],
+                "previous": page["previous"],
+                "results": [{"id": r.id,
+                             "rating": r.rating,
+                             "title": r.title,
+                             "body": r.body,
+                             "author": r.user.get_full_name() or r.user.username if r.user else None,
+                             "created_at": r.created_at}
+                            for r in page["items"]]}
+
+    key = f"{caching.product_key(pk)}:api:reviews:{caching.cursor_digest(after, before)}"
+    return JsonResponse(caching.get_or_set(key, load))
+
+
+# --------------------
+# Cart and checkout
+# --------------------
+def _cart_data(cart) -> dict:
+    items = carts.items(cart)
+    total, count = carts.totals(items)
+    return {"items": [{"product": _product_data(i["product"], ("id", "name", "image", "url")),
+                       "quantity": i["quantity"],
+                       "unit_price": i["unit_price"],
+                       "subtotal": i["subtotal"]}
+                      for i in items],
+            "total": total,
+            "count": count}
+
+
+@require_http_methods(["GET", "HEAD", "DELETE"])
+@ensure_csrf_cookie
+@api_view
+def cart(request):
+    """Returns the cart, or empties it on DELETE."""
+    cart = carts.get_cart(request)
+    if request.method == "DELETE":
+        carts.clear(cart)
+    return JsonResponse(_cart_data(cart))
+
+
+@require_http_methods(["POST"])
+@api_view
+def cart_items(request):
+    """Adds product_id with an optional qty (default 1) to the cart."""
+    data = _request_data(request)
+    try:
+        product_id, qty = int(data.get("product_id")), int(data.get("qty") or 1)
+    except (TypeError, ValueError):
+        raise BadRequest("product_id and qty must be integers")
+    product = get_object_or_404(Product, pk=product_id)
+    cart = carts.get_cart(request, create=True)
+    added = carts.add(cart, product, qty)
+    return JsonResponse({"added": added, **_cart_data(cart)})
+
+
+@require_http_methods(["DELETE"])
+@api_view
+def cart_item(request, product_id):
+    cart = carts.get_cart(request)
+    if not carts.remove(cart, product_id):
+        raise Http404
+    return JsonResponse(_cart_data(cart))
+
+
+@require_http_methods(["POST"])
+@api_view
+def checkout(request):
+    """
+        Places an order for the cart with the same fields as the checkout
+        form. Responds 201 with the order, 409 if stock ran out.
+    """
+    cart = carts.get_cart(request)
+    items = carts.items(cart)
+    if not items:
+        return _error(400, "Your cart is empty.")
+    details = _checkout_details(_request_data(request))
+    if details is None:
+        return _error(400, "Please complete all fields with valid details.")
+    shipping, payment = details
+
+    try:
+        order = _place_order(shipping, payment, items)
+    except OutOfStock as e:
+        return _error(409, "Out of stock for the quantity requested.",
+                      products=[p.id for p in e.short_products()])
+
+    total, count = carts.totals(items)
+    carts.clear(cart)
+    return JsonResponse({"order": order.id,
+                         "status": order.status,
+                         "total": total,
+                         "count": count,
+                         "url": reverse("checkoutsuccess", args=[order.id])},
+                        status=201)
@@ -1,6 +1,19 @@
 from django.apps import AppConfig
+from django.db import connections
+from django.db.models.signals import post_migrate
 
 
 class StorefrontConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'storefront'
+
+    def ready(self):
+        # Connects the cache invalidation, image variant and cart merge
+        # signal handlers
+        from . import caching, carts, images  # noqa: F401
+        post_migrate.connect(create_search_index, sender=self)
+
+
+def create_search_index(sender, using, **kwargs):
+    from .search import ensure_index
+    ensure_index(connections[using])
@@ -0,0 +1,201 @@
+"""
+    Caching for the catalogue pages.
+
+    Cached entries are never deleted one by one. Every key embeds version
+    numbers that model signals bump, so a change makes the old entries
+    unreachable and they simply expire:
+
+        catalogue       any product, review, category or range change,
+                        used by the product listing variants
+        taxonomy        category or range changes, used by product pages
+        product:<pk>    changes to that product or its reviews
+        cart:<owner>    changes to the items of that cart, see carts.py
+        recommendations a recommendations build, see recommendations.py
+
+    This works the same on the local-memory, file based and Redis backends
+    as it only needs get, set, add and incr.
+"""
+import hashlib
+import json
+import time
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+
+from .models import Product, ProductCategory, ProductRange, Review
+
+KEY_PREFIX = "storefront"
+STATS_KEYS = {"hits": f"{KEY_PREFIX}:stats:hits",
+              "misses": f"{KEY_PREFIX}:stats:misses"}
+
+_MISSING = object()
+
+# Hit and miss counts of the current request while PerformanceMiddleware
+# is timing it, see middleware.py
+request_counts = ContextVar("request_counts", default=None)
+
+
+# --------------------
+# Versions
+# --------------------
+def _version_key(name) -> str:
+    return f"{KEY_PREFIX}:version:{name}"
+
+
+def _get_version(name) -> int:
+    key = _version_key(name)
+    version = cache.get(key)
+    if version is None:
+        # Start from the clock rather than 1 so a version that was evicted
+        # can't come back as a number that old entries were stored under
+        cache.add(key, time.time_ns(), timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def _bump(name) -> None:
+    try:
+        cache.incr(_version_key(name))
+    except ValueError:
+        cache.add(_version_key(name), time.time_ns(), timeout=None)
+
+
+def _invalidate(*names) -> None:
+    def bump_all():
+        for name in names:
+            _bump(name)
+
+    # Bump now, and again once the transaction commits so a reader that
+    # refilled the cache from pre-commit data doesn't pin it
+    bump_all()
+    transaction.on_commit(bump_all)
+
+
+def invalidate_products(pks) -> None:
+    """For writes that bypass model signals, e.g. QuerySet.update()."""
+    _invalidate("catalogue", *(f"product:{pk}" for pk in pks))
+
+
+def invalidate_all() -> None:
+    _invalidate("catalogue", "taxonomy")
+
+
+def invalidate_cart(*owners) -> None:
+    _invalidate(*(f"cart:{owner}" for owner in owners))
+
+
+def invalidate_recommendations() -> None:
+    _invalidate("recommendations")
+
+
+# --------------------
+# Keys
+# --------------------
+def listing_key(**variant) -> str:
+    """Key for one variant (search query, sort, filters) of the listing."""
+    digest = hashlib.md5(json.dumps(variant, sort_keys=True, default=str)
+                         .encode()).hexdigest()
+    return f"{KEY_PREFIX}:listing:{_get_version('catalogue')}:{digest}"
+
+
+def cursor_digest(after, before) -> str:
+    """
+        Part of the key for one page read with decoded keyset cursors, so
+        query strings that decode to the same cursors, or to none at all,
+        share an entry whatever their text.
+    """
+    if after is None and before is None:
+        return "first"
+    return hashlib.md5(json.dumps([after, before], default=str).encode()).hexdigest()
+
+
+def product_key(pk) -> str:
+    return (f"{KEY_PREFIX}:product:{pk}:{_get_version(f'product:{pk}')}"
+            f":{_get_version('taxonomy')}")
+
+
+def also_bought_key(pk) -> str:
+    """
+        Key for a product's "customers also bought", which shows other
+        products and so also goes stale when any product changes.
+    """
+    return (f"{KEY_PREFIX}:also_bought:{pk}:{_get_version('recommendations')}"
+            f":{_get_version('catalogue')}")
+
+
+def cart_key(owner) -> str:
+    """Key for a cart's summary, which also goes stale when prices change."""
+    return (f"{KEY_PREFIX}:cart:{owner}:{_get_version(f'cart:{owner}')}"
+            f":{_get_version('catalogue')}")
+
+
+# --------------------
+# Lookups and counters
+# --------------------
+def get_or_set(key, factory, timeout=None):
+    """
+        Returns the cached value for key, or calls factory and caches its
+        result. Counts hits and misses for stats() with CACHE_STATS on.
+    """
+    value = cache.get(key, _MISSING)
+    if value is not _MISSING:
+        _count("hits")
+        return value
+    _count("misses")
+    value = factory()
+    if timeout is None:
+        cache.set(key, value)
+    else:
+        cache.set(key, value, timeout)
+    return value
+
+
+def _count(kind) -> None:
+    counts = request_counts.get()
+    if counts is not None:
+        counts[kind] += 1
+    # A cache write per lookup, only while measuring
+    if not settings.CACHE_STATS:
+        return
+    try:
+        cache.incr(STATS_KEYS[kind])
+    except ValueError:
+        if not cache.add(STATS_KEYS[kind], 1, timeout=None):
+            cache.incr(STATS_KEYS[kind])
+
+
+def stats() -> dict:
+    counts = {kind: cache.get(key) or 0 for kind, key in STATS_KEYS.items()}
+    lookups = counts["hits"] + counts["misses"]
+    counts["hit_ratio"] = counts["hits"] / lookups if lookups else 0.0
+    return counts
+
+
+def reset_stats() -> None:
+    cache.delete_many(list(STATS_KEYS.values()))
+
+
+# --------------------
+# Signals
+# --------------------
+def product_changed(sender, instance, **kwargs):
+    _invalidate("catalogue", f"product:{instance.pk}")
+
+
+def review_changed(sender, instance, **kwargs):
+    # The listing sorts and filters on ratings, so it goes stale too
+    _invalidate("catalogue", f"product:{instance.product_id}")
+
+
+def taxonomy_changed(sender, instance, **kwargs):
+    _invalidate("catalogue", "taxonomy")
+
+
+for signal in (post_save, post_delete):
+    signal.connect(product_changed, sender=Product)
+    signal.connect(review_changed, sender=Review)
+    signal.connect(taxonomy_changed, sender=ProductCategory)
+    signal.connect(taxonomy_changed, sender=ProductRange)
@@ -0,0 +1,210 @@
+"""
+    Shopping carts.
+
+    A cart is a Cart row with one CartItem per product rather than a dict
+    in the session, so adding an item is one UPDATE of its quantity with an
+    F() expression instead of a rewrite of the whole session row, and two
+    tabs adding at once can't lose each other's items. Signed in users have
+    one cart each. Anonymous visitors get a cart on their first add and
+    find it again from a signed cookie that CartCookieMiddleware sets, and
+    it is merged into their own cart when they log in.
+
+    The navbar badge reads summary(), cached per cart owner under
+    caching.cart_key(), so it costs no query until the cart or a price
+    changes.
+"""
+from decimal import Decimal
+
+from django.conf import settings
+from django.contrib.auth.signals import user_logged_in
+from django.db import IntegrityError, transaction
+from django.db.models import Case, DecimalField, F, Sum, When
+from django.db.models.functions import Coalesce, Least, Now
+
+from . import caching
+from .models import Cart, CartItem, Product
+
+COOKIE_NAME = "cart"
+COOKIE_SALT = "storefront.carts"
+COOKIE_MAX_AGE = 60 * 60 * 24 * 60  # 60 days
+
+EMPTY_SUMMARY = {"count": 0, "total": Decimal("0.00")}
+
+
+# --------------------
+# Finding carts
+# --------------------
+def _cookie_cart_id(request):
+    value = request.get_signed_cookie(COOKIE_NAME, default=None, salt=COOKIE_SALT,
+                                      max_age=COOKIE_MAX_AGE)
+    return int(value) if value and value.isdigit() else None
+
+
+def owner(cart) -> str:
+    """Who a cart belongs to, as used in its cache key."""
+    return f"user-{cart.user_id}" if cart.user_id else f"anonymous-{cart.pk}"
+
+
+def _request_owner(request):
+    if request.user.is_authenticated:
+        return f"user-{request.user.pk}"
+    cart_id = _cookie_cart_id(request)
+    return cart_id and f"anonymous-{cart_id}"
+
+
+def get_cart(request, create=False):
+    """
+        Returns the request's cart, or None if it has none and create is
+        False. A cart created for an anonymous visitor is remembered in
+        request.cart_cookie for CartCookieMiddleware to set.
+    """
+    if request.user.is_authenticated:
+        if create:
+            return Cart.objects.get_or_create(user=request.user)[0]
+        return Cart.objects.filter(user=request.user).first()
+
+    cart_id = _cookie_cart_id(request)
+    cart = cart_id and Cart.objects.filter(pk=cart_id, user=None).first()
+    if not cart and create:
+        cart = Cart.objects.create()
+        request.cart_cookie = cart.pk
+    elif not cart and cart_id:
+        # Merged or purged, stop sending it
+        request.cart_cookie = None
+    return cart or None
+
+
+def set_cookie(response, cart_id) -> None:
+    if cart_id is None:
+        response.delete_cookie(COOKIE_NAME, samesite="Lax")
+    else:
+        response.set_signed_cookie(COOKIE_NAME, str(cart_id), salt=COOKIE_SALT,
+                                   max_age=COOKIE_MAX_AGE, httponly=True, samesite="Lax",
+                                   secure=settings.SESSION_COOKIE_SECURE)
+
+
+# --------------------
+# Items
+# --------------------
+def _line(product, quantity) -> dict:
+    unit_price = product.sale_price if product.discount else product.price
+    return {"product": product, "quantity": quantity,
+            "unit_price": unit_price, "subtotal": quantity * unit_price}
+
+
+def items(cart) -> list:
+    """The cart's line items with their prices, in the order they were added."""
+    if cart is None:
+        return []
+    return [_line(item.product, item.quantity)
+            for item in cart.items.select_related("product").order_by("id")]
+
+
+def priced_items(quantities) -> list:
+    """Line items for a {product_id: quantity} mapping, for code without a cart."""
+    products = Product.objects.in_bulk(quantities)
+    return [_line(products[pk], int(qty)) for pk, qty in quantities.items() if pk in products]
+
+
+def totals(lines) -> tuple:
+    """Returns (total, count) of line items."""
+    total = sum(i["subtotal"] for i in lines)
+    count = sum(i["quantity"] for i in lines)
+    return total, count
+
+
+def _changed(cart) -> None:
+    # updated_at tells abandoned anonymous carts apart
+    Cart.objects.filter(pk=cart.pk).update(updated_at=Now())
+    caching.invalidate_cart(owner(cart))
+
+
+def add(cart, product, qty) -> int:
+    """
+        Adds qty of product to the cart, clamped to the stock available,
+        and returns the quantity actually added.
+    """
+    qty = max(1, int(qty))
+    if product.stock and qty > product.stock:
+        qty = product.stock
+
+    quantity = F("quantity") + qty
+    if product.stock:
+        quantity = Least(quantity, product.stock)
+    in_cart = CartItem.objects.filter(cart=cart, product=product)
+    if not in_cart.update(quantity=quantity):
+        try:
+            with transaction.atomic():
+                CartItem.objects.create(cart=cart, product=product, quantity=qty)
+        except IntegrityError:
+            # Another request added it first
+            in_cart.update(quantity=quantity)
+    _changed(cart)
+    return qty
+
+
+def remove(cart, product_id) -> bool:
+    """Removes a product from the cart, returns whether it was there."""
+    if cart is None:
+        return False
+    removed, _ = CartItem.objects.filter(cart=cart, product_id=product_id).delete()
+    if removed:
+        _changed(cart)
+    return bool(removed)
+
+
+def clear(cart) -> None:
+    if cart is not None:
+        cart.items.all().delete()
+        _changed(cart)
+
+
+# --------------------
+# Summary
+# --------------------
+def summary(request) -> dict:
+    """The count and total of the request's cart for the navbar badge."""
+    cart_owner = _request_owner(request)
+    if not cart_owner:
+        return EMPTY_SUMMARY
+
+    def load():
+        if request.user.is_authenticated:
+            lines = CartItem.objects.filter(cart__user=request.user)
+        else:
+            lines = CartItem.objects.filter(cart_id=_cookie_cart_id(request), cart__user=None)
+        unit_price = Case(When(product__discount=True, then=F("product__sale_price")),
+                          default=F("product__price"))
+        money = DecimalField(max_digits=10, decimal_places=2)
+        return lines.aggregate(
+            count=Coalesce(Sum("quantity"), 0),
+            total=Coalesce(Sum(unit_price * F("quantity"), output_field=money),
+                           Decimal("0.00"), output_field=money))
+
+    return caching.get_or_set(caching.cart_key(cart_owner), load)
+
+
+# --------------------
+# Signals
+# --------------------
+def merge_on_login(sender, request, user, **kwargs):
+    """Moves the anonymous cart the visitor filled into their own cart."""
+    cart_id = request is not None and _cookie_cart_id(request)
+    if not cart_id:
+        return
+    request.cart_cookie = None
+    anonymous = Cart.objects.filter(pk=cart_id, user=None).first()
+    if anonymous is None:
+        return
+    with transaction.atomic():
+        cart = Cart.objects.filter(user=user).first()
+        if cart is None:
+            Cart.objects.filter(pk=anonymous.pk).update(user=user)
+        else:
+            for item in anonymous.items.select_related("product"):
+                add(cart, item.product, item.quantity)
+            anonymous.delete()
+    caching.invalidate_cart(owner(anonymous), f"user-{user.pk}")
+
+
+user_logged_in.connect(merge_on_login)
@@ -0,0 +1,8 @@
+from django.utils.functional import SimpleLazyObject
+
+from . import carts
+
+
+def cart(request):
+    """The cart summary for the navbar badge, only looked up when rendered."""
+    return {"cart_summary": SimpleLazyObject(lambda: carts.summary(request))}
@@ -0,0 +1,334 @@
+"""
+    Catalogue feeds: products in and out as CSV or JSON Lines.
+
+    import_feed() streams a supplier feed a chunk of rows at a time. Each
+    chunk is matched to the catalogue with one query, by sku or else by
+    id, and only rows whose values differ are written, with bulk_create
+    and bulk_update in one short transaction per chunk. A feed can carry
+    any subset of FEED_FIELDS. Products keep the values of columns it
+    leaves out, and of required fields whose cells it leaves empty.
+    Categories and ranges are looked up by name in a map loaded once, and
+    names not seen before are created in the transaction of the first
+    chunk that writes a product with them. A row whose sku is another
+    product's than the one its id names is reported, not written.
+
+    export_feed() writes the catalogue in the same format, so an export
+    can be edited and imported again. See the import_catalogue and
+    export_catalogue commands.
+"""
+import csv
+import json
+from collections import Counter
+from decimal import Decimal
+
+from django.core.exceptions import ValidationError
+from django.db import models, transaction
+from django.db.models import BooleanField, Q
+from django.utils import timezone
+
+from . import caching
+from .models import DERIVED_PRODUCT_FIELDS, Product, ProductCategory, ProductRange
+
+FORMATS = ("csv", "jsonl")
+# Columns of a feed besides id, category and range are given by name
+FEED_FIELDS = ("sku", "name", "tagline", "overview", "description", "specifications",
+               "price", "discount", "sale_price", "stock", "display_item",
+               "category", "range")
+TAXONOMIES: dict[str, type[models.Model]] = {"category": ProductCategory, "range": ProductRange}
+# Needed by Product.refresh_derived_fields() on every matched product
+DERIVED_FROM = ("price", "discount", "stock", *DERIVED_PRODUCT_FIELDS)
+REQUIRED_FOR_NEW = ("name", "price")
+BOOLEANS = {"true": True, "yes": True, "1": True, "false": False, "no": False, "0": False}
+MAX_ERRORS = 50
+
+
+class FeedError(Exception):
+    """Raised for a feed that can't be read at all, e.g. unknown columns."""
+
+
+def format_for(path, default="csv") -> str:
+    """Guesses a feed's format from its file name."""
+    return "jsonl" if str(path).endswith((".jsonl", ".ndjson")) else default
+
+
+# --------------------
+# Reading
+# --------------------
+def _column_error(columns):
+    """What is wrong with a CSV header or a JSON Lines row's keys, if anything."""
+    unknown = set(columns) - {"id", *FEED_FIELDS}
+    if unknown:
+        return f"Unknown columns: {', '.join(sorted(unknown))}"
+    if "id" not in columns and "sku" not in columns:
+        return "A feed needs an id or sku column"
+    return None
+
+
+def read_rows(file, fmt):
+    """
+        Yields (line number, row dict) for each row of a feed file, with
+        None for a row that isn't one.
+    """
+    if fmt == "csv":
+        reader = csv.DictReader(file)
+        error = _column_error(reader.fieldnames or ())
+        if error:
+            raise FeedError(error)
+        for row in reader:
+            # More or fewer values than columns
+            malformed = None in row or None in row.values()
+            yield reader.line_num, None if malformed else row
+        return
+
+    for line_num, line in enumerate(file, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        yield line_num, row if isinstance(row, dict) else None
+
+
+def _parse(row) -> dict:
+    """
+        Cleans a row's values with the model fields' own validation and
+        returns them by attribute name. Category and range stay names.
+        Raises ValidationError naming the column at fault.
+    """
+    # Each JSON Lines row has its own columns
+    error = _column_error(row)
+    if error:
+        raise ValidationError(error)
+    values = {}
+    for column, value in row.items():
+        if column in TAXONOMIES:
+            values[column] = (value or "").strip() or None
+            continue
+        if column == "id":
+            try:
+                values["id"] = int(value) if value not in ("", None) else None
+            except (TypeError, ValueError):
+                raise ValidationError(f"id: {value!r} is not a number")
+            continue
+        field = Product._meta.get_field(column)
+        if value in ("", None) and not field.blank:
+            # An empty cell of a required field keeps its value
+            continue
+        if value == "" and field.null:
+            value = None
+        elif isinstance(field, BooleanField) and isinstance(value, str):
+            # Spreadsheets write TRUE and FALSE
+            value = BOOLEANS.get(value.strip().lower(), value)
+        try:
+            values[field.attname] = field.clean(value, None)
+        except ValidationError as e:
+            raise ValidationError(f"{column}: {' '.join(e.messages)}")
+    return values
+
+
+# --------------------
+# Importing
+# --------------------
+def _taxa(model) -> dict:
+    return dict(model.objects.values_list("name", "pk"))
+
+
+class _Import:
+    def __init__(self, dry_run):
+        self.dry_run = dry_run
+        self.written = False
+        self.taxa = {name: _taxa(model) for name, model in TAXONOMIES.items()}
+        self.report = {"created": 0, "updated": 0, "unchanged": 0, "invalid": 0,
+                       "new_categories": 0, "new_ranges": 0,
+                       "fields": Counter(), "errors": []}
+
+    def error(self, line_num, message) -> None:
+        self.report["invalid"] += 1
+        if len(self.report["errors"]) < MAX_ERRORS:
+            self.report["errors"].append((line_num, message))
+
+    def taxon_id(self, name, value):
+        # A name first seen gets a stand-in id that matches no product, so
+        # the change is still counted, until _create_taxa() creates it
+        if value is None:
+            return None
+        ids = self.taxa[name]
+        if value not in ids:
+            self.report[f"new_{'categories' if name == 'category' else 'ranges'}"] += 1
+            ids[value] = f"new:{value}"
+        return ids[value]
+
+    def _create_taxa(self, products) -> dict:
+        """
+            Creates the new categories and ranges the products name and
+            points the products at them. Returns the new ids by taxonomy
+            and name, for self.taxa once the transaction commits.
+        """
+        made = {}
+        for name, model in TAXONOMIES.items():
+            attname = f"{name}_id"
+            names = {getattr(p, attname)[4:] for p in products
+                     if isinstance(getattr(p, attname), str)}
+            if not names:
+                continue
+            made[name] = {t.name: t.pk for t in model.objects.bulk_create(
+                [model(name=n) for n in sorted(names)])}
+            for product in products:
+                value = getattr(product, attname)
+                if isinstance(value, str):
+                    setattr(product, attname, made[name][value[4:]])
+        return made
+
+    def chunk(self, rows) -> None:
+        parsed = []
+        for line_num, row in rows:
+            if row is None:
+                self.error(line_num, "malformed row")
+                continue
+            try:
+                values = _parse(row)
+            except ValidationError as e:
+                self.error(line_num, " ".join(e.messages))
+                continue
+            for name in TAXONOMIES:
+                if name in values:
+                    values[f"{name}_id"] = self.taxon_id(name, values.pop(name))
+            parsed.append((line_num, values))
+
+        skus = {v["sku"] for _, v in parsed if v.get("sku")}
+        ids = {v["id"] for _, v in parsed if v.get("id")}
+        loaded = {*DERIVED_FROM, "sku", *(k for _, v in parsed for k in v)} - {"id"}
+        existing = list(Product.objects.filter(Q(sku__in=skus) | Q(pk__in=ids))
+                        .only(*{name.removesuffix("_id") for name in loaded}))
+        by_sku = {p.sku: p for p in existing if p.sku}
+        by_id = {p.pk: p for p in existing}
+
+        created, updated, fields = [], {}, set()
+        now = timezone.now()
+        for line_num, values in parsed:
+            # A sku not seen before can be given to a product by its id
+            pk = values.pop("id", None)
+            product = by_sku.get(values.get("sku")) or by_id.get(pk)
+            if product is None and pk and not values.get("sku"):
+                self.error(line_num, f"no product with id {pk}")
+                continue
+            if pk and product is not None and product.pk != pk:
+                # Moving a sku between products (or swapping two) would
+                # break its unique constraint part way through the chunk
+                self.error(line_num, f"sku {values['sku']} belongs to another product")
+                continue
+
+            if product is None:
+                missing = [f for f in REQUIRED_FOR_NEW if values.get(f) is None]
+                if missing:
+                    self.error(line_num, f"new product needs {', '.join(missing)}")
+                    continue
+                product = Product(**values)
+                product.refresh_derived_fields()
+                if product.sale_price is None:
+                    self.error(line_num, "discounted new product needs sale_price")
+                    continue
+                created.append(product)
+                if product.sku:
+                    by_sku[product.sku] = product
+                continue
+            if product.pk is None:
+                # Created earlier in this chunk
+                for attname, value in values.items():
+                    setattr(product, attname, value)
+                product.refresh_derived_fields()
+                continue
+
+            changed = {a for a, v in values.items() if getattr(product, a) != v}
+            if not changed:
+                if product.pk not in updated:
+                    self.report["unchanged"] += 1
+                continue
+            derived = {f: getattr(product, f) for f in DERIVED_PRODUCT_FIELDS}
+            for attname in changed:
+                setattr(product, attname, values[attname])
+            if "sku" in changed and product.sku:
+                # Later rows with the new sku are this product's
+                by_sku[product.sku] = product
+            product.refresh_derived_fields()
+            changed |= {f for f, v in derived.items() if getattr(product, f) != v}
+            product.updated_at = now
+            self.report["fields"].update(a.removesuffix("_id") for a in changed)
+            fields |= changed
+            updated[product.pk] = product
+
+        self.report["created"] += len(created)
+        self.report["updated"] += len(updated)
+        if self.dry_run or not (created or updated):
+            return
+        with transaction.atomic():
+            made = self._create_taxa([*created, *updated.values()])
+            Product.objects.bulk_create(created)
+            if updated:
+                Product.objects.bulk_update(updated.values(), [*fields, "updated_at"])
+        for name, ids in made.items():
+            self.taxa[name].update(ids)
+        self.written = True
+
+
+def import_feed(file, fmt="csv", chunk_size=1000, dry_run=False) -> dict:
+    """
+        Creates and updates products from a feed, chunk_size rows per
+        transaction. Returns a report of what changed, and with dry_run
+        what would have, without writing anything. Invalid rows are
+        skipped and reported with their line numbers.
+    """
+    job = _Import(dry_run)
+    chunk = []
+    try:
+        for line_num, row in read_rows(file, fmt):
+            chunk.append((line_num, row))
+            if len(chunk) >= chunk_size:
+                job.chunk(chunk)
+                chunk = []
+        if chunk:
+            job.chunk(chunk)
+    finally:
+        # One bump for the whole feed instead of one per product, also when
+        # it stopped part way with earlier chunks already written
+        if job.written:
+            caching.invalidate_all()
+    return job.report
+
+
+# --------------------
+# Exporting
+# --------------------
+def _export_value(value, fmt):
+    if isinstance(value, Decimal):
+        return str(value)
+    if fmt == "csv" and isinstance(value, bool):
+        return "1" if value else "0"
+    if fmt == "csv" and value is None:
+        return ""
+    return value
+
+
+def export_feed(file, fmt="csv", chunk_size=2000) -> int:
+    """
+        Writes every product as a feed row, reading chunk_size rows at a
+        time with a server side cursor where the database has one.
+        Returns the number of rows written.
+    """
+    columns = ("id", *FEED_FIELDS)
+    lookups = [f"{c}__name" if c in TAXONOMIES else c for c in columns]
+    rows = Product.objects.order_by("pk").values_list(*lookups).iterator(chunk_size=chunk_size)
+
+    writer = csv.writer(file) if fmt == "csv" else None
+    if writer:
+        writer.writerow(columns)
+    count = 0
+    for row in rows:
+        values = [_export_value(value, fmt) for value in row]
+        if writer:
+            writer.writerow(values)
+        else:
+            file.write(json.dumps(dict(zip(columns, values))) + "\n")
+        count += 1
+    return count
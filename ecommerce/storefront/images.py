@@ -0,0 +1,169 @@
+"""
+    Resized variants of product images.
+
+    Each upload is resized to a few fixed widths, never larger than the
+    original, and saved as AVIF and WebP plus a JPEG (PNG when it has
+    transparency) fallback. The variant paths are stored on
+    Product.image_variants:
+
+        {"source": "uploads/products/pad.png", "width": 1200, "height": 800,
+         "formats": {"avif": [[175, "uploads/products/variants/..."], ...],
+                     "webp": [...], "png": [...]}}
+
+    so pages can pick a variant with srcset without touching storage. An
+    entry whose source isn't the current image name is stale; saving the
+    product regenerates it once the save commits, so the encoding doesn't
+    hold the database's write lock, and the generate_image_variants
+    command backfills existing products.
+"""
+import hashlib
+import io
+import logging
+import os
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from PIL import Image, ImageOps
+
+from . import caching
+from .models import Product
+
+logger = logging.getLogger(__name__)
+
+# Card, detail and 2x widths used by the templates
+WIDTHS = (175, 350, 500, 1000)
+VARIANT_DIR = "uploads/products/variants"
+# Format -> Pillow save options, modern formats in order of preference
+# (the slowest encoder settings are many times slower for a few percent)
+MODERN_FORMATS = {"avif": {"quality": 60, "speed": 8}, "webp": {"quality": 80, "method": 4}}
+FALLBACK_FORMATS = {"jpeg": {"quality": 82, "optimize": True, "progressive": True},
+                    "png": {}}
+MIME_TYPES = {"avif": "image/avif", "webp": "image/webp",
+              "jpeg": "image/jpeg", "png": "image/png"}
+
+
+def supported_formats() -> list:
+    Image.init()
+    return [f for f in MODERN_FORMATS if f.upper() in Image.SAVE]
+
+
+def is_current(product) -> bool:
+    variants = product.image_variants or {}
+    if not product.image:
+        return not variants
+    return variants.get("source") == product.image.name
+
+
+def _variant_name(source, width, fmt) -> str:
+    stem = os.path.splitext(os.path.basename(source))[0]
+    digest = hashlib.md5(source.encode()).hexdigest()[:8]
+    return f"{VARIANT_DIR}/{stem}-{digest}/{width}.{'jpg' if fmt == 'jpeg' else fmt}"
+
+
+def generate_variants(source, storage=default_storage) -> dict:
+    """
+        Writes the resized variants of the image stored at source and
+        returns the image_variants entry describing them.
+    """
+    with storage.open(source, "rb") as f:
+        image: Image.Image = Image.open(f)
+        image = ImageOps.exif_transpose(image)
+        image.load()
+
+    has_alpha = image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info
+    image = image.convert("RGBA" if has_alpha else "RGB")
+    fallback = "png" if has_alpha else "jpeg"
+    widths = sorted({min(width, image.width) for width in WIDTHS})
+
+    formats: dict[str, list] = {fmt: [] for fmt in (*supported_formats(), fallback)}
+    for width in widths:
+        height = max(1, round(image.height * width / image.width))
+        resized = image.resize((width, height), Image.Resampling.LANCZOS) if width != image.width else image
+        for fmt in formats:
+            options = MODERN_FORMATS.get(fmt) or FALLBACK_FORMATS[fmt]
+            buffer = io.BytesIO()
+            resized.save(buffer, format=fmt.upper(), **options)
+            name = _variant_name(source, width, fmt)
+            if storage.exists(name):
+                storage.delete(name)
+            formats[fmt].append([width, storage.save(name, ContentFile(buffer.getvalue()))])
+
+    return {"source": source, "width": image.width, "height": image.height,
+            "formats": formats}
+
+
+def delete_variants(variants, storage=default_storage) -> None:
+    for paths in (variants or {}).get("formats", {}).values():
+        for _, name in paths:
+            storage.delete(name)
+
+
+def build_variants(source) -> dict:
+    """
+        Like generate_variants(), but an image that can't be read gets an
+        entry with no variants and the templates fall back to the original.
+        Takes and returns only plain data so it can run in a process pool.
+    """
+    if not source:
+        return {}
+    try:
+        return generate_variants(source)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        logger.exception("Could not generate variants for %s", source)
+        return {"source": source, "formats": {}}
+
+
+def replace_variants(product, variants) -> None:
+    """Sets product.image_variants, deleting the files of a replaced image."""
+    old = product.image_variants
+    if old and old.get("source") != variants.get("source"):
+        delete_variants(old)
+    product.image_variants = variants
+
+
+def refresh_variants(product) -> bool:
+    """
+        Regenerates product.image_variants if it doesn't match the current
+        image and saves it with an UPDATE, returning whether it changed.
+    """
+    if is_current(product):
+        return False
+    replace_variants(product, build_variants(product.image.name if product.image else None))
+    Product.objects.filter(pk=product.pk).update(image_variants=product.image_variants)
+    return True
+
+
+def sources(product, fmt=None) -> list:
+    """Returns [(width, url), ...] of the variants in fmt, or the fallback."""
+    formats = (product.image_variants or {}).get("formats", {})
+    if fmt is None:
+        fmt = next((f for f in FALLBACK_FORMATS if f in formats), None)
+    return [(width, default_storage.url(name)) for width, name in formats.get(fmt, ())]
+
+
+# --------------------
+# Signals
+# --------------------
+def product_saved(sender, instance, raw=False, **kwargs):
+    if raw or is_current(instance):
+        return
+
+    def refresh():
+        # The row as committed, another save may have changed it since
+        product = Product.objects.only("id", "image", "image_variants").filter(
+            pk=instance.pk).first()
+        if product is not None and refresh_variants(product):
+            instance.image_variants = product.image_variants
+            caching.invalidate_products([product.pk])
+
+    transaction.on_commit(refresh, robust=True)
+
+
+def product_deleted(sender, instance, **kwargs):
+    delete_variants(instance.image_variants)
+
+
+post_save.connect(product_saved, sender=Product)
+post_delete.connect(product_deleted, sender=Product)
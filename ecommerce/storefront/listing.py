@@ -0,0 +1,217 @@
+"""
+    Product listing: search, sorting, keyset pagination and facet counts.
+
+    Pages use keyset (seek) pagination. A cursor holds the sort key values
+    of the row a page starts after (or ends before), and the next page is
+    read with a WHERE on those values instead of an OFFSET, so every page
+    costs the same however deep it is. The id is always the last sort key
+    to make the order total.
+"""
+import base64
+import json
+
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db.models import Count, FloatField, Q
+
+from . import search
+from .models import Product
+
+PAGE_SIZE = 24
+DEFAULT_SORT = "alphabetical"
+# Sort option -> ((field, descending), ...)
+SORTS = {
+    "alphabetical": (("name", False),),
+    "non-alphabetical": (("name", True),),
+    "lowest-price": (("sale_price", False),),
+    "highest-price": (("sale_price", True),),
+    "top-rated": (("average_rating", True), ("reviews_count", True), ("name", False)),
+    "relevance": (("search_rank", False), ("name", False)),
+}
+MIN_RATINGS = ("1", "2", "3", "4")
+
+
+# --------------------
+# Keyset pagination
+# --------------------
+def sort_keys(sort) -> tuple:
+    # The id breaks ties in the same direction as the last key, so the
+    # whole order can be read from one index
+    keys = SORTS.get(sort, SORTS[DEFAULT_SORT])
+    return (*keys, ("id", keys[-1][1]))
+
+
+def encode_cursor(values) -> str:
+    return base64.urlsafe_b64encode(json.dumps(values, default=str).encode()).decode()
+
+
+def decode_cursor(cursor, keys, model):
+    """
+        Returns the cursor's key values, converted by model's fields, or
+        None if it is missing or invalid, e.g. edited by hand.
+    """
+    if not cursor:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        return None
+    if not isinstance(values, list) or len(values) != len(keys):
+        return None
+    try:
+        return [_key_value(model, field, value) for (field, _), value in zip(keys, values)]
+    except (ValidationError, TypeError, ValueError):
+        return None
+
+
+def _key_value(model, name, value):
+    # A seek can't compare with NULL
+    if value is None:
+        raise ValueError(f"{name} can't be None")
+    try:
+        field = model._meta.get_field(name)
+    except FieldDoesNotExist:
+        # An annotation, search_rank is the only one
+        field = FloatField()
+    return field.to_python(value)
+
+
+def _seek(keys, values, forward) -> Q:
+    # (a, b) > (x, y) is expanded to a > x OR (a = x AND b > y)
+    condition = Q()
+    for i, (field, descending) in enumerate(keys):
+        lookup = "gt" if forward != descending else "lt"
+        clause = Q(**{f"{field}__{lookup}": values[i]})
+        for (prior, _), value in zip(keys[:i], values[:i]):
+            clause &= Q(**{prior: value})
+        condition |= clause
+    return condition
+
+
+def keyset_page(queryset, keys, after=None, before=None, size=PAGE_SIZE) -> dict:
+    """
+        Returns one page of queryset ordered by keys, starting after the
+        `after` cursor values or ending before the `before` ones, with
+        cursors for the neighbouring pages (None when there isn't one).
+    """
+    # Pages before a cursor are read in reverse order, then flipped back
+    forward = before is None
+    ordering = [f"-{field}" if descending == forward else field
+                for field, descending in keys]
+    if not forward:
+        queryset = queryset.filter(_seek(keys, before, forward=False))
+    elif after is not None:
+        queryset = queryset.filter(_seek(keys, after, forward=True))
+
+    rows = list(queryset.order_by(*ordering)[:size + 1])
+    more = len(rows) > size
+    rows = rows[:size]
+    if not forward:
+        rows.reverse()
+
+    def cursor(item):
+        return encode_cursor([getattr(item, field) for field, _ in keys])
+
+    has_next = more if forward else True
+    has_previous = (after is not None) if forward else more
+    return {"items": rows,
+            "next": cursor(rows[-1]) if rows and has_next else None,
+            "previous": cursor(rows[0]) if rows and has_previous else None}
+
+
+# --------------------
+# Facets
+# --------------------
+def facet_counts(queryset, category=None, range_=None) -> dict:
+    """
+        Counts products per category and per range with one grouped query.
+        Each facet's counts honour the other facet's selection but not its
+        own, so every option shows how many results picking it would give.
+    """
+    rows = (queryset.order_by()
+            .values("category_id", "category__name", "range_id", "range__name")
+            .annotate(count=Count("id")))
+    categories: dict[int, dict] = {}
+    ranges: dict[int, dict] = {}
+    total = 0
+    for row in rows:
+        in_category = category is None or row["category_id"] == category
+        in_range = range_ is None or row["range_id"] == range_
+        if in_range and row["category_id"] is not None:
+            entry = categories.setdefault(row["category_id"], {
+                "id": row["category_id"], "name": row["category__name"], "count": 0})
+            entry["count"] += row["count"]
+        if in_category and row["range_id"] is not None:
+            entry = ranges.setdefault(row["range_id"], {
+                "id": row["range_id"], "name": row["range__name"], "count": 0})
+            entry["count"] += row["count"]
+        if in_category and in_range:
+            total += row["count"]
+    return {"categories": sorted(categories.values(), key=lambda f: f["name"]),
+            "ranges": sorted(ranges.values(), key=lambda f: f["name"]),
+            "total": total}
+
+
+# --------------------
+# Listing
+# --------------------
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_params(params) -> dict:
+    """Normalises the listing's GET parameters."""
+    query = (params.get("search") or "").strip()
+    sort = params.get("sort") or ("relevance" if query else DEFAULT_SORT)
+    if sort not in SORTS or (sort == "relevance" and not query):
+        sort = DEFAULT_SORT
+    min_rating = params.get("min_rating")
+    return {"search": query,
+            "sort": sort,
+            "min_rating": min_rating if min_rating in MIN_RATINGS else "",
+            "category": _to_int(params.get("category")),
+            "range": _to_int(params.get("range")),
+            "after": params.get("after") or "",
+            "before": params.get("before") or ""}
+
+
+def build_listing(params, queryset=None, size=PAGE_SIZE) -> dict:
+    """
+        Returns one page of displayable products for parse_params() output,
+        with facet counts, the total and neighbouring page cursors. A search
+        that matches nothing is retried once with the closest spelling found
+        in the search index.
+    """
+    products = queryset if queryset is not None else (
+        Product.objects.filter(display_item=True).catalogue_cards())
+    if params["min_rating"]:
+        products = products.filter(average_rating__gte=int(params["min_rating"]))
+
+    query, suggestion = params["search"], None
+    matches = search.search_products(products, query) if query else products
+    facets = facet_counts(matches, params["category"], params["range"])
+    first_page = not params["after"] and not params["before"]
+    if query and not facets["total"] and first_page:
+        suggestion = search.suggest(query)
+        if suggestion:
+            matches = search.search_products(products, suggestion)
+            facets = facet_counts(matches, params["category"], params["range"])
+
+    if params["category"] is not None:
+        matches = matches.filter(category_id=params["category"])
+    if params["range"] is not None:
+        matches = matches.filter(range_id=params["range"])
+
+    keys = sort_keys(params["sort"])
+    page = keyset_page(matches, keys,
+                       after=decode_cursor(params["after"], keys, Product),
+                       before=decode_cursor(params["before"], keys, Product),
+                       size=size)
+    return {"products": page["items"],
+            "next": page["next"],
+            "previous": page["previous"],
+            "facets": facets,
+            "count": facets["total"],
+            "suggestion": suggestion}
@@ -0,0 +1,369 @@
+"""
+    Synthetic data and traffic for load testing.
+
+    seed() fills the database with a catalogue of any size using
+    bulk_create, and run() drives a weighted mix of the shopper flows
+    (listing, product page, add to cart, checkout and review) from several
+    threads. It runs either in process through the test client, which
+    counts every request's queries, or over HTTP against a running dev
+    server or gunicorn. See the seed_catalogue and loadtest commands.
+
+    Both take a random seed so a run can be repeated exactly.
+"""
+import http.cookiejar
+import math
+import random
+import re
+import statistics
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+from decimal import Decimal
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import connection, connections, transaction
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from . import caching, listing
+from .models import (OUT_OF_STOCK_TAGLINE, RATING_SUMMARY_FIELDS, STAR_VALUES, Order,
+                     OrderItem, OutboundEmail, Product, ProductCategory, ProductRange,
+                     Review)
+
+# Marks the rows seed() writes, so clear() can find them again
+SEED_DESCRIPTION = "Synthetic product seeded for load testing."
+USERNAME_PREFIX = "loadtest-"
+PASSWORD = "loadtest-password"
+
+BRANDS = ("Apex", "Nova", "Pulse", "Vertex", "Orbit", "Quantum", "Zenith", "Echo")
+NOUNS = ("Controller", "Headset", "Keyboard", "Mouse", "Gamepad", "Joystick", "Wheel", "Pad")
+CATEGORIES = ("Controllers", "Headsets", "Keyboards", "Mice")
+RANGES = ("Pro", "Lite", "Elite")
+# Most reviews are good ones
+RATING_WEIGHTS = {5: 40, 4: 30, 3: 15, 2: 8, 1: 7}
+
+# Share of requests per flow
+MIX = {"products": 40, "product": 30, "add_to_cart": 15, "checkout": 5, "add_review": 10}
+
+
+# --------------------
+# Seeding
+# --------------------
+def seed(products, reviews, users, orders, rng, batch_size=1000) -> dict:
+    """
+        Writes a synthetic catalogue: products spread over the categories
+        and ranges, users who can log in with PASSWORD, reviews (with the
+        rating summaries they imply) and orders. Returns the row counts.
+    """
+    categories = list(ProductCategory.objects.all()) or ProductCategory.objects.bulk_create(
+        [ProductCategory(name=name) for name in CATEGORIES])
+    ranges = list(ProductRange.objects.all()) or ProductRange.objects.bulk_create(
+        [ProductRange(name=name) for name in RANGES])
+    start = User.objects.filter(username__startswith=USERNAME_PREFIX).count()
+
+    with transaction.atomic():
+        catalogue = Product.objects.bulk_create(
+            [_product(i, rng, categories, ranges) for i in range(products)], batch_size=batch_size)
+
+        # One hash for everyone, hashing is what makes creating users slow.
+        # bulk_create skips the signal that makes a Customer profile.
+        password = make_password(PASSWORD)
+        shoppers = User.objects.bulk_create(
+            [User(username=f"{USERNAME_PREFIX}{i}", password=password, first_name="Load",
+                  last_name=f"Tester{i}", email=f"{USERNAME_PREFIX}{i}@example.com")
+             for i in range(start, start + users)], batch_size=batch_size)
+
+        written = Review.objects.bulk_create(
+            [_review(rng, catalogue, shoppers) for _ in range(reviews if catalogue else 0)],
+            batch_size=batch_size)
+        _count_ratings(catalogue, written, batch_size)
+
+        placed = Order.objects.bulk_create(
+            [Order(user=rng.choice(shoppers), address=f"{rng.randint(1, 999)} Load Test St",
+                   status=rng.choice(("Processing", "Shipped", "Delivered")))
+             for _ in range(orders if shoppers and catalogue else 0)], batch_size=batch_size)
+        OrderItem.objects.bulk_create(
+            [OrderItem(order=order, product=product, quantity=rng.randint(1, 3),
+                       unit_price=product.sale_price)
+             for order in placed
+             for product in rng.sample(catalogue, min(len(catalogue), rng.randint(1, 4)))],
+            batch_size=batch_size)
+
+    caching.invalidate_all()
+    return {"products": len(catalogue), "users": len(shoppers),
+            "reviews": len(written), "orders": len(placed)}
+
+
+def _product(i, rng, categories, ranges) -> Product:
+    price = Decimal(rng.randint(1000, 30000)) / 100
+    discount = rng.random() < 0.2
+    stock = 0 if rng.random() < 0.05 else rng.randint(1, 200)
+    return Product(
+        name=f"{rng.choice(BRANDS)} {rng.choice(NOUNS)} {i}",
+        overview=f"A {rng.choice(RANGES).lower()} grade {rng.choice(NOUNS).lower()}.",
+        description=SEED_DESCRIPTION, price=price, discount=discount,
+        sale_price=(price * Decimal("0.8")).quantize(Decimal("0.01")) if discount else price,
+        stock=stock, tagline=OUT_OF_STOCK_TAGLINE if stock == 0 else "",
+        display_item=rng.random() < 0.95,
+        category=rng.choice(categories), range=rng.choice(ranges))
+
+
+def _review(rng, catalogue, shoppers) -> Review:
+    # A few products get most of the reviews
+    product = rng.choice(catalogue[:max(1, len(catalogue) // 10)] if rng.random() < 0.5
+                         else catalogue)
+    rating = rng.choices(list(RATING_WEIGHTS), weights=RATING_WEIGHTS.values())[0]
+    return Review(product=product, user=rng.choice(shoppers) if shoppers else None,
+                  rating=rating, title=f"{rating} stars",
+                  body="Seeded review written for load testing purposes.")
+
+
+def _count_ratings(catalogue, reviews, batch_size) -> None:
+    # bulk_create skips Review.save(), which keeps the summaries up to date
+    stars: defaultdict[int, dict[int, int]] = defaultdict(lambda: dict.fromkeys(STAR_VALUES, 0))
+    for review in reviews:
+        stars[review.product_id][review.rating] += 1
+    for product in catalogue:
+        counts = stars.get(product.pk)
+        if counts:
+            product.reviews_count = sum(counts.values())
+            product.rating_sum = sum(star * n for star, n in counts.items())
+            product.average_rating = product.rating_sum / product.reviews_count
+            for star, n in counts.items():
+                setattr(product, f"rating_{star}_count", n)
+    Product.objects.bulk_update([p for p in catalogue if p.pk in stars],
+                                RATING_SUMMARY_FIELDS, batch_size=batch_size)
+
+
+def clear() -> int:
+    """
+        Deletes everything seed() wrote, with the orders, reviews, carts and
+        queued order confirmations that reference it. Returns the number of
+        rows deleted.
+    """
+    with transaction.atomic():
+        users, _ = User.objects.filter(username__startswith=USERNAME_PREFIX).delete()
+        products, _ = Product.objects.filter(description=SEED_DESCRIPTION).delete()
+        emails, _ = OutboundEmail.objects.filter(to__0__startswith=USERNAME_PREFIX).delete()
+    caching.invalidate_all()
+    return users + products + emails
+
+
+# --------------------
+# Clients
+# --------------------
+class InProcessClient:
+    """Sends requests through the test client and counts their queries."""
+
+    def __init__(self):
+        self.client = Client()
+
+    def login(self, username, password) -> bool:
+        return self.client.login(username=username, password=password)
+
+    def request(self, method, path, data=None) -> tuple:
+        with CaptureQueriesContext(connection) as ctx:
+            response = getattr(self.client, method.lower())(path, data or {})
+        return response.status_code, len(ctx)
+
+
+class HttpClient:
+    """
+        Sends requests to a running server, keeping cookies like a browser.
+        Query counts are read from the Server-Timing header of a server
+        started with DJANGO_PERF_TIMING=1, and are None without it.
+    """
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip("/")
+        self.cookies = http.cookiejar.CookieJar()
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(self.cookies), _NoRedirect())
+
+    def _csrf_token(self):
+        token = next((c.value for c in self.cookies if c.name == settings.CSRF_COOKIE_NAME), None)
+        if token is None:
+            self.request("GET", reverse("api_cart"))
+            token = next((c.value for c in self.cookies
+                          if c.name == settings.CSRF_COOKIE_NAME), "")
+        return token
+
+    def login(self, username, password) -> bool:
+        status, _ = self.request("POST", reverse("login"),
+                                 {"username": username, "password": password})
+        return status == 302
+
+    def request(self, method, path, data=None) -> tuple:
+        url = self.base_url + path
+        body, headers = None, {}
+        if method == "GET" and data:
+            url += "?" + urllib.parse.urlencode(data)
+        elif method == "POST":
+            body = urllib.parse.urlencode(data or {}).encode()
+            headers = {"X-CSRFToken": self._csrf_token(), "Referer": url,
+                       "Content-Type": "application/x-www-form-urlencoded"}
+        request = urllib.request.Request(url, data=body, headers=headers, method=method)
+        try:
+            with self.opener.open(request, timeout=30) as response:
+                response.read()
+                return response.status, _queries(response.headers)
+        except urllib.error.HTTPError as e:
+            return e.code, _queries(e.headers)
+
+
+_SERVER_TIMING_QUERIES = re.compile(r'db;[^,]*desc="(\d+) queries"')
+
+
+def _queries(headers):
+    match = _SERVER_TIMING_QUERIES.search(headers.get("Server-Timing", ""))
+    return int(match.group(1)) if match else None
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    # Time each request on its own, like the test client
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+# --------------------
+# Shoppers
+# --------------------
+class Shopper:
+    """One virtual visitor choosing flows from MIX at random."""
+
+    def __init__(self, client, rng, catalogue, categories, user=None):
+        self.client, self.rng = client, rng
+        self.catalogue, self.categories = catalogue, categories
+        self.user = user
+        self.cart_filled = False
+
+    def pick_product(self) -> int:
+        # Half the traffic goes to the most popular tenth of the catalogue
+        hot = self.catalogue[:max(1, len(self.catalogue) // 10)]
+        return self.rng.choice(hot if self.rng.random() < 0.5 else self.catalogue)
+
+    def step(self) -> tuple:
+        """Runs one flow, returns (flow, status, seconds, queries)."""
+        flow = self.rng.choices(list(MIX), weights=MIX.values())[0]
+        if flow == "checkout" and not self.user:
+            # Guest checkouts each create a user, leave them to the seeded ones
+            flow = "product"
+        elif flow == "checkout" and not self.cart_filled:
+            flow = "add_to_cart"
+        method, path, data = getattr(self, flow)()
+        started = time.perf_counter()
+        status, queries = self.client.request(method, path, data)
+        return flow, status, time.perf_counter() - started, queries
+
+    def products(self):
+        params = {"sort": self.rng.choice([s for s in listing.SORTS if s != "relevance"])}
+        roll = self.rng.random()
+        if roll < 0.3:
+            params = {"search": self.rng.choice(NOUNS).lower()}
+        elif roll < 0.5 and self.categories:
+            params["category"] = self.rng.choice(self.categories)
+        return "GET", reverse("products"), params
+
+    def product(self):
+        return "GET", reverse("product", args=[self.pick_product()]), None
+
+    def add_to_cart(self):
+        self.cart_filled = True
+        return ("POST", reverse("add_to_cart", args=[self.pick_product()]),
+                {"qty": self.rng.randint(1, 2)})
+
+    def checkout(self):
+        self.cart_filled = False
+        user = self.user
+        return "POST", reverse("checkout"), {
+            "first_name": user["first_name"], "last_name": user["last_name"],
+            "email": user["email"], "phone": "0400000000", "address": "1 Load Test St",
+            "card_name": "Load Tester", "card_number": "4111111111111111",
+            "card_exp": "12/30", "card_cvc": "123"}
+
+    def add_review(self):
+        rating = self.rng.choices(list(RATING_WEIGHTS), weights=RATING_WEIGHTS.values())[0]
+        return "POST", reverse("add_review", args=[self.pick_product()]), {
+            "title": f"{rating} stars", "rating": rating,
+            "body": "Written by the load test to exercise the review form."}
+
+
+# --------------------
+# Running
+# --------------------
+def run(threads, requests, rng_seed, base_url=None) -> dict:
+    """
+        Runs `requests` flows on each of `threads` shoppers, in process or
+        against base_url. Returns the samples and the wall clock time.
+    """
+    catalogue = list(Product.objects.filter(display_item=True, stock__gt=0)
+                     .order_by("-reviews_count", "pk").values_list("pk", flat=True))
+    if not catalogue:
+        raise ValueError("No products in stock, run seed_catalogue first.")
+    categories = list(ProductCategory.objects.values_list("pk", flat=True))
+    users = list(User.objects.filter(username__startswith=USERNAME_PREFIX)
+                 .order_by("pk").values("username", "first_name", "last_name", "email")[:threads])
+    samples, errors = [], []
+    lock = threading.Lock()
+
+    def worker(index):
+        rng = random.Random(f"{rng_seed}-{index}")
+        client = HttpClient(base_url) if base_url else InProcessClient()
+        user = users[index] if index < len(users) else None
+        try:
+            if user and not client.login(user["username"], PASSWORD):
+                user = None
+            shopper = Shopper(client, rng, catalogue, categories, user)
+            for _ in range(requests):
+                try:
+                    sample = shopper.step()
+                except OSError as e:
+                    with lock:
+                        errors.append(str(e))
+                    continue
+                with lock:
+                    samples.append(sample)
+        finally:
+            connections.close_all()
+
+    hosts = [*settings.ALLOWED_HOSTS, "testserver"]
+    with override_settings(ALLOWED_HOSTS=hosts):
+        workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+        started = time.perf_counter()
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        elapsed = time.perf_counter() - started
+    return {"samples": samples, "errors": errors, "elapsed": elapsed}
+
+
+def percentile(values, p):
+    """Nearest rank percentile of sorted values."""
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def summarise(result) -> dict:
+    """Latency percentiles, error counts and queries per request for each flow."""
+    flows = defaultdict(list)
+    for flow, status, seconds, queries in result["samples"]:
+        flows[flow].append((status, seconds, queries))
+    summary = {}
+    for flow, rows in sorted(flows.items()):
+        latencies = sorted(seconds for _, seconds, _ in rows)
+        counted = [queries for _, _, queries in rows if queries is not None]
+        summary[flow] = {
+            "requests": len(rows),
+            "errors": sum(status >= 400 for status, _, _ in rows),
+            "p50": percentile(latencies, 50), "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "queries": statistics.mean(counted) if counted else None,
+            "max_queries": max(counted) if counted else None,
+        }
+    return summary
@@ -0,0 +1,31 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand
+
+from storefront import rollups
+
+
+class Command(BaseCommand):
+    help = ("Rebuilds the daily and weekly sales rollups from the order history, "
+            "aggregating each window of weeks with NumPy. Checkout keeps them "
+            "up to date afterwards; run this once, after bulk imports of "
+            "orders, or at night to repair a range. The current week is left "
+            "to checkout unless --include-current-week, which is only safe "
+            "while no orders are being placed.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--start", type=date.fromisoformat,
+                            help="First day to rebuild, YYYY-MM-DD. The oldest order by default.")
+        parser.add_argument("--end", type=date.fromisoformat,
+                            help="Last day to rebuild, YYYY-MM-DD. The newest order by default.")
+        parser.add_argument("--window-weeks", type=int, default=4,
+                            help="Weeks of orders read and replaced per transaction.")
+        parser.add_argument("--include-current-week", action="store_true",
+                            help="Also rebuild this week, e.g. for the first backfill "
+                                 "before the shop opens.")
+
+    def handle(self, *args, **options):
+        written = rollups.backfill(options["start"], options["end"],
+                                   window_weeks=max(1, options["window_weeks"]),
+                                   include_current_week=options["include_current_week"])
+        self.stdout.write(self.style.SUCCESS(f"Wrote {written} sales rollups."))
@@ -0,0 +1,157 @@
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+from storefront import rollups
+from storefront.carts import priced_items
+from storefront.models import Order, OutboundEmail, Product
+from storefront.views import _place_order
+
+# Django's SQLite defaults before WAL: rollback journal, deferred
+# transactions and a 5 second busy timeout
+LEGACY_SQLITE_OPTIONS = {
+    "timeout": 5,
+    "init_command": "PRAGMA journal_mode=DELETE; PRAGMA synchronous=FULL;",
+}
+
+
+def _reset_connection():
+    """Drops this thread's connection so the next query reads the settings again."""
+    connections[DEFAULT_DB_ALIAS].close()
+    del connections[DEFAULT_DB_ALIAS]
+
+
+@contextmanager
+def _without_rollups():
+    """Skips the sales rollup upserts, removing the orders wouldn't undo them."""
+    record_order = rollups.record_order
+    rollups.record_order = lambda order, items: None
+    try:
+        yield
+    finally:
+        rollups.record_order = record_order
+
+
+class Command(BaseCommand):
+    help = ("Measures the throughput of concurrent checkouts. On SQLite it runs "
+            "against a copy of the database, once with the configured settings "
+            "and once with Django's defaults for comparison. Other databases "
+            "are benchmarked as configured, without the sales rollup updates, "
+            "and the rows it writes are removed.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--threads", type=int, default=8)
+        parser.add_argument("--orders", type=int, default=50,
+                            help="Checkouts per thread.")
+        parser.add_argument("--items", type=int, default=3,
+                            help="Products per order.")
+        parser.add_argument("--products", type=int, default=10,
+                            help="Products the orders pick from, fewer means more contention.")
+
+    def handle(self, *args, **options):
+        settings_dict = connections.settings[DEFAULT_DB_ALIAS]
+        if settings_dict["ENGINE"] != "django.db.backends.sqlite3":
+            with _without_rollups():
+                self._report("configured", self._run(options))
+            return
+        configs = (("configured", settings_dict["OPTIONS"]),
+                   ("django defaults", LEGACY_SQLITE_OPTIONS))
+        for name, db_options in configs:
+            with self._sqlite_copy(settings_dict, db_options):
+                self._report(name, self._run(options))
+
+    @contextmanager
+    def _sqlite_copy(self, settings_dict, db_options):
+        """Points the default database at a throwaway copy with db_options."""
+        original = dict(settings_dict)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "bench.sqlite3")
+            source, target = sqlite3.connect(original["NAME"]), sqlite3.connect(path)
+            with source, target:
+                source.backup(target)
+            source.close()
+            target.close()
+            _reset_connection()
+            settings_dict.update(NAME=path, OPTIONS=db_options)
+            try:
+                yield
+            finally:
+                _reset_connection()
+                settings_dict.clear()
+                settings_dict.update(original)
+
+    def _run(self, options) -> dict:
+        tag = uuid.uuid4().hex[:8]
+        Product.objects.bulk_create([
+            Product(name=f"bench-{tag}-{i}", price=Decimal("10.00"),
+                    sale_price=Decimal("10.00"), stock=10**9, display_item=False)
+            for i in range(options["products"])])
+        # bulk_create skips the signal that makes a Customer profile
+        user = User.objects.bulk_create([User(username=f"bench-{tag}", first_name="Bench",
+                                              last_name=tag, email=f"bench-{tag}@example.com")])[0]
+        user = User.objects.get(username=user.username)
+        shipping = {"first_name": user.first_name, "last_name": user.last_name,
+                    "email": user.email, "phone": "", "address": "1 Bench St"}
+        payment = {"provider": "demo", "brand": "visa", "last4": "1111",
+                   "exp_month": 12, "exp_year": 2030, "status": "succeeded"}
+        pks = [p.pk for p in Product.objects.filter(name__startswith=f"bench-{tag}-")]
+
+        latencies, errors = [], []
+        lock = threading.Lock()
+
+        def worker(seed):
+            rng = random.Random(seed)
+            try:
+                for _ in range(options["orders"]):
+                    cart = {pk: rng.randint(1, 3)
+                            for pk in rng.sample(pks, min(options["items"], len(pks)))}
+                    started = time.perf_counter()
+                    try:
+                        _place_order(shipping, payment, priced_items(cart))
+                    except DatabaseError as e:
+                        with lock:
+                            errors.append(str(e))
+                        continue
+                    with lock:
+                        latencies.append(time.perf_counter() - started)
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(options["threads"])]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        Order.objects.filter(user=user).delete()
+        # Order confirmations, or the outbox worker would send them
+        OutboundEmail.objects.filter(to__0=user.email).delete()
+        Product.objects.filter(pk__in=pks).delete()
+        user.delete()
+        return {"elapsed": elapsed, "latencies": sorted(latencies), "errors": errors}
+
+    def _report(self, name, result) -> None:
+        latencies = result["latencies"]
+        self.stdout.write(self.style.MIGRATE_HEADING(f"{name}:"))
+        self.stdout.write(f"  orders:     {len(latencies)} in {result['elapsed']:.2f}s "
+                          f"({len(latencies) / result['elapsed']:.1f}/s)")
+        if latencies:
+            p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+            self.stdout.write(f"  latency:    p50 {statistics.median(latencies) * 1000:.1f}ms, "
+                              f"p95 {p95 * 1000:.1f}ms")
+        if result["errors"]:
+            self.stdout.write(self.style.WARNING(
+                f"  failed:     {len(result['errors'])} ({result['errors'][0]})"))
@@ -0,0 +1,109 @@
+import math
+import resource
+import time
+from collections import Counter, defaultdict
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from storefront import recommendations
+
+# Products near an order's first pick are likelier in it, so pairs repeat
+NEIGHBOURHOOD = 50
+
+
+def synthetic_baskets(items, products, rng):
+    """
+        Orders of 1 to 8 products, about items line items in all, with
+        popularity falling off like a real catalogue's. Returns order and
+        product id arrays as recommendations._baskets() does.
+    """
+    sizes = np.minimum(1 + rng.poisson(1.5, size=items), 8)
+    sizes = sizes[:np.searchsorted(np.cumsum(sizes), items) + 1]
+    popularity = 1 / np.arange(10, products + 10)
+    popularity /= popularity.sum()
+    firsts = rng.choice(products, size=len(sizes), p=popularity)
+    orders = np.repeat(np.arange(1, len(sizes) + 1), sizes)
+    near = (np.repeat(firsts, sizes) + rng.integers(0, NEIGHBOURHOOD, size=len(orders))) % products
+    anywhere = rng.choice(products, size=len(orders), p=popularity)
+    picked = np.where(rng.random(len(orders)) < 0.7, near, anywhere) + 1
+    return recommendations.distinct(np, orders, picked)
+
+
+def python_similar(orders, products, top_k, min_orders) -> dict:
+    """The same scores with dicts and Counters, to check and compare against."""
+    baskets = defaultdict(list)
+    for order, product in zip(orders.tolist(), products.tolist()):
+        baskets[order].append(product)
+    counts: Counter[int] = Counter()
+    together: Counter[tuple[int, int]] = Counter()
+    for basket in baskets.values():
+        counts.update(basket)
+        together.update((a, b) for a in basket for b in basket if a != b)
+    scored = defaultdict(list)
+    for (a, b), n in together.items():
+        if n >= min_orders:
+            scored[a].append((-n / math.sqrt(counts[a] * counts[b]), -n, b))
+    return {a: [b for _, _, b in sorted(pairs)[:top_k]] for a, pairs in scored.items()}
+
+
+class Command(BaseCommand):
+    help = ("Times the recommendations scoring (co-occurrence counts, cosine "
+            "similarity and top-K) on synthetic order histories of millions "
+            "of line items, in memory, and checks it against a plain Python "
+            "version on a sample. Database reads and writes are not included.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--items", type=int, nargs="+", default=[100_000, 1_000_000, 3_000_000],
+                            help="Line items of each history benchmarked.")
+        parser.add_argument("--products", type=int, default=20_000)
+        parser.add_argument("--top", type=int, default=recommendations.TOP_K)
+        parser.add_argument("--min-orders", type=int, default=recommendations.MIN_ORDERS)
+        parser.add_argument("--sample", type=int, default=100_000,
+                            help="Line items the Python version runs on, 0 to skip it.")
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = np.random.default_rng(options["seed"])
+        top_k, min_orders = max(1, options["top"]), max(1, options["min_orders"])
+        if options["sample"]:
+            self._compare(synthetic_baskets(options["sample"], options["products"], rng),
+                          top_k, min_orders)
+        for items in options["items"]:
+            orders, products = synthetic_baskets(items, options["products"], rng)
+            started = time.perf_counter()
+            rows = recommendations.similar(np, orders, products, top_k=top_k,
+                                           min_orders=min_orders)
+            elapsed = time.perf_counter() - started
+            self.stdout.write(self.style.MIGRATE_HEADING(f"{len(products):,} line items:"))
+            self.stdout.write(f"  orders:     {len(np.unique(orders)):,}")
+            self.stdout.write(f"  scored:     {elapsed:.2f}s "
+                              f"({len(products) / elapsed / 1e6:.2f}M line items/s)")
+            self.stdout.write(f"  written:    {len(rows[0]):,} recommendations for "
+                              f"{len(np.unique(rows[0])):,} products")
+        # ru_maxrss is in kilobytes on Linux
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        self.stdout.write(f"Peak memory: {peak:.0f}MB")
+
+    def _compare(self, baskets, top_k, min_orders) -> None:
+        orders, products = baskets
+        started = time.perf_counter()
+        product, recommended, _, _ = recommendations.similar(np, orders, products, top_k=top_k,
+                                                             min_orders=min_orders)
+        vectorized = time.perf_counter() - started
+        started = time.perf_counter()
+        expected = python_similar(orders, products, top_k, min_orders)
+        plain = time.perf_counter() - started
+
+        got = defaultdict(list)
+        for a, b in zip(product.tolist(), recommended.tolist()):
+            got[a].append(b)
+        self.stdout.write(self.style.MIGRATE_HEADING(f"{len(orders):,} line items, "
+                                                     "NumPy against plain Python:"))
+        self.stdout.write(f"  numpy:      {vectorized:.2f}s")
+        self.stdout.write(f"  python:     {plain:.2f}s ({plain / vectorized:.0f}x slower)")
+        if got == expected:
+            self.stdout.write(self.style.SUCCESS("  results:    identical"))
+        else:
+            self.stdout.write(self.style.ERROR(
+                f"  results:    differ for {sum(got.get(a) != b for a, b in expected.items())} products"))
@@ -0,0 +1,75 @@
+import statistics
+import time
+from importlib import import_module
+
+from django.conf import settings
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.http import HttpResponse
+from django.test import RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
+
+
+def _read(request):
+    request.session.get("visits")
+    return HttpResponse()
+
+
+def _write(request):
+    request.session["visits"] = request.session.get("visits", 0) + 1
+    return HttpResponse()
+
+
+class Command(BaseCommand):
+    help = ("Measures the per request cost of each session engine in "
+            "settings.SESSION_ENGINES: time spent in SessionMiddleware, database "
+            "queries and cookie size, for requests that only read the session "
+            "and requests that change it. Runs against the configured database "
+            "and cache, and deletes the session it creates.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=500,
+                            help="Requests per engine and kind.")
+        parser.add_argument("--engines", nargs="*", choices=list(settings.SESSION_ENGINES),
+                            help="Engines to compare, all of them by default.")
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"cache: {settings.CACHES['default']['BACKEND']}")
+        for name in options["engines"] or settings.SESSION_ENGINES:
+            with override_settings(SESSION_ENGINE=settings.SESSION_ENGINES[name]):
+                self._report(name, self._run(max(1, options["requests"])))
+
+    def _run(self, count) -> dict:
+        factory = RequestFactory()
+        cookie, results = None, {}
+        # Writes first, the first of them creates the session
+        for kind, view in (("write", _write), ("read", _read)):
+            middleware = SessionMiddleware(view)
+            timings, queries = [], 0
+            for _ in range(count):
+                request = factory.get("/")
+                if cookie:
+                    request.COOKIES[settings.SESSION_COOKIE_NAME] = cookie
+                with CaptureQueriesContext(connection) as ctx:
+                    started = time.perf_counter()
+                    response = middleware(request)
+                    timings.append(time.perf_counter() - started)
+                queries += len(ctx)
+                if settings.SESSION_COOKIE_NAME in response.cookies:
+                    cookie = response.cookies[settings.SESSION_COOKIE_NAME].value
+            results[kind] = {"timings": sorted(timings), "queries": queries / count,
+                             "cookie": len(cookie or "")}
+
+        import_module(settings.SESSION_ENGINE).SessionStore(session_key=cookie).delete()
+        return results
+
+    def _report(self, name, results) -> None:
+        self.stdout.write(self.style.MIGRATE_HEADING(f"{name}:"))
+        for kind, result in results.items():
+            timings = result["timings"]
+            p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+            self.stdout.write(f"  {kind:<6} mean {statistics.mean(timings) * 1e6:7.0f}µs, "
+                              f"p95 {p95 * 1e6:7.0f}µs, "
+                              f"{result['queries']:.2f} queries, "
+                              f"cookie {result['cookie']} bytes")
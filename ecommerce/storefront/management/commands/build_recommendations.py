@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from storefront import recommendations
+
+
+class Command(BaseCommand):
+    help = ("Refreshes the \"customers also bought\" recommendations of the "
+            "products ordered since the last run, or rebuilds every product's "
+            "from the whole order history with --full. Run it every few "
+            "minutes to an hour, and --full nightly.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--full", action="store_true",
+                            help="Rebuild every product, the first run always does.")
+        parser.add_argument("--top", type=int, default=recommendations.TOP_K,
+                            help="Recommendations kept per product.")
+        parser.add_argument("--min-orders", type=int, default=recommendations.MIN_ORDERS,
+                            help="Orders two products must share to be recommended together.")
+
+    def handle(self, *args, **options):
+        job = recommendations.build if options["full"] else recommendations.refresh
+        result = job(top_k=max(1, options["top"]), min_orders=max(1, options["min_orders"]))
+        self.stdout.write(self.style.SUCCESS(
+            f"Wrote {result['recommendations']} recommendations for {result['products']} "
+            f"products, through order {result['through_order']}."))
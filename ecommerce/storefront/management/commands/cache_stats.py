@@ -0,0 +1,24 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from storefront import caching
+
+
+class Command(BaseCommand):
+    help = "Shows the catalogue cache hit and miss counters."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--reset", action="store_true",
+                            help="Zero the counters after showing them.")
+
+    def handle(self, *args, **options):
+        if not settings.CACHE_STATS:
+            self.stdout.write(self.style.WARNING(
+                "Counting is off, set DJANGO_CACHE_STATS=1 on the web processes."))
+        stats = caching.stats()
+        self.stdout.write(f"Hits:      {stats['hits']}")
+        self.stdout.write(f"Misses:    {stats['misses']}")
+        self.stdout.write(f"Hit ratio: {stats['hit_ratio']:.1%}")
+        if options["reset"]:
+            caching.reset_stats()
+            self.stdout.write(self.style.SUCCESS("Counters reset."))
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from storefront import feeds
+
+
+class Command(BaseCommand):
+    help = ("Writes every product as CSV or JSON Lines in the format "
+            "import_catalogue reads, streaming rows from the database.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", nargs="?", default="-",
+                            help="Output file, standard output by default.")
+        parser.add_argument("--format", choices=feeds.FORMATS,
+                            help="Output format, by default guessed from the file name.")
+        parser.add_argument("--chunk-size", type=int, default=2000,
+                            help="Rows read from the database at a time.")
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        fmt = options["format"] or feeds.format_for(path)
+        chunk_size = max(1, options["chunk_size"])
+        if path == "-":
+            feeds.export_feed(self.stdout, fmt, chunk_size)
+            return
+        try:
+            with open(path, "w", newline="", encoding="utf-8") as file:
+                count = feeds.export_feed(file, fmt, chunk_size)
+        except OSError as e:
+            raise CommandError(e)
+        self.stdout.write(self.style.SUCCESS(f"Exported {count} products to {path}."))
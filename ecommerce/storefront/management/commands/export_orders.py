@@ -0,0 +1,40 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+
+from storefront import exports
+
+
+class Command(BaseCommand):
+    help = ("Writes orders with their items and payments as CSV, one row per "
+            "item, or JSON Lines, one object per order, streaming them from the "
+            "database so any number of orders fits in memory.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", nargs="?", default="-",
+                            help="Output file, standard output by default.")
+        parser.add_argument("--format", choices=exports.FORMATS,
+                            help="Output format, by default guessed from the file name.")
+        parser.add_argument("--start", type=date.fromisoformat,
+                            help="First day of orders to export, YYYY-MM-DD.")
+        parser.add_argument("--end", type=date.fromisoformat,
+                            help="Last day of orders to export, YYYY-MM-DD.")
+        parser.add_argument("--status", help="Only export orders with this status.")
+        parser.add_argument("--chunk-size", type=int, default=exports.CHUNK_SIZE,
+                            help="Orders read from the database at a time.")
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        fmt = options["format"] or ("jsonl" if path.endswith(".jsonl") else "csv")
+        orders = exports.orders(options["start"], options["end"], options["status"])
+        lines = exports.lines(orders, fmt, chunk_size=max(1, options["chunk_size"]))
+        if path == "-":
+            for line in lines:
+                self.stdout.write(line)
+            return
+        try:
+            with open(path, "w", newline="", encoding="utf-8") as file:
+                file.writelines(lines)
+        except OSError as e:
+            raise CommandError(e)
+        self.stdout.write(self.style.SUCCESS(f"Exported orders to {path}."))
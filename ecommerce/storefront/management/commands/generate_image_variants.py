@@ -0,0 +1,50 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+
+from storefront import caching, images
+from storefront.models import Product
+
+
+class Command(BaseCommand):
+    help = ("Generates the resized AVIF, WebP and fallback variants of product "
+            "images that don't have current ones, using a pool of processes.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+        parser.add_argument("--batch-size", type=int, default=100,
+                            help="Products resized and saved per round.")
+        parser.add_argument("--force", action="store_true",
+                            help="Regenerate variants that are already current.")
+
+    def handle(self, *args, **options):
+        products = Product.objects.only("id", "image", "image_variants").order_by("pk")
+        stale = [p for p in products if options["force"] or not images.is_current(p)]
+        if not stale:
+            self.stdout.write(self.style.SUCCESS("All product image variants are current."))
+            return
+
+        # Workers only touch storage, don't let them inherit open connections
+        connections.close_all()
+        size = options["batch_size"]
+        done = 0
+        # images imports the models, so a spawned worker (the default on
+        # macOS and Windows) has to set Django up before it can load it
+        with ProcessPoolExecutor(max_workers=max(1, options["workers"]),
+                                 initializer=django.setup) as pool:
+            for start in range(0, len(stale), size):
+                batch = stale[start:start + size]
+                names = [p.image.name if p.image else None for p in batch]
+                for product, variants in zip(batch, pool.map(images.build_variants, names)):
+                    images.replace_variants(product, variants)
+                with transaction.atomic():
+                    Product.objects.bulk_update(batch, ["image_variants"])
+                done += len(batch)
+                self.stdout.write(f"{done}/{len(stale)} products")
+
+        caching.invalidate_products(p.pk for p in stale)
+        self.stdout.write(self.style.SUCCESS(
+            f"Generated image variants for {len(stale)} products."))
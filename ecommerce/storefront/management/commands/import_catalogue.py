@@ -0,0 +1,51 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from storefront import feeds
+
+
+class Command(BaseCommand):
+    help = ("Creates and updates products from a supplier feed in CSV or JSON "
+            "Lines, matched by sku or id. The feed is streamed and only changed "
+            "rows are written, in bulk, one short transaction per chunk. Columns "
+            "the feed leaves out are kept.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="Feed file, or - for standard input.")
+        parser.add_argument("--format", choices=feeds.FORMATS,
+                            help="Feed format, by default guessed from the file name.")
+        parser.add_argument("--chunk-size", type=int, default=1000,
+                            help="Rows compared and written per transaction.")
+        parser.add_argument("--dry-run", action="store_true",
+                            help="Report what would change without writing anything.")
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        fmt = options["format"] or feeds.format_for(path)
+        try:
+            if path == "-":
+                report = self._import(sys.stdin, fmt, options)
+            else:
+                with open(path, newline="", encoding="utf-8") as file:
+                    report = self._import(file, fmt, options)
+        except (OSError, feeds.FeedError) as e:
+            raise CommandError(e)
+
+        for line_num, message in report["errors"]:
+            self.stderr.write(f"Line {line_num}: {message}")
+        if report["fields"]:
+            self.stdout.write("Changed " + ", ".join(
+                f"{name} on {n}" for name, n in report["fields"].most_common()) + ".")
+        summary = (f"{report['created']} products created, {report['updated']} updated and "
+                   f"{report['unchanged']} unchanged, {report['invalid']} invalid rows, "
+                   f"{report['new_categories']} new categories and "
+                   f"{report['new_ranges']} new ranges.")
+        if options["dry_run"]:
+            summary = f"Dry run, nothing written: {summary}"
+        style = self.style.WARNING if report["invalid"] else self.style.SUCCESS
+        self.stdout.write(style(summary))
+
+    def _import(self, file, fmt, options) -> dict:
+        return feeds.import_feed(file, fmt, chunk_size=max(1, options["chunk_size"]),
+                                 dry_run=options["dry_run"])
@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from storefront import loadtest
+
+
+class Command(BaseCommand):
+    help = ("Drives a mix of browse, product, cart, checkout and review requests "
+            "from concurrent shoppers and reports latency percentiles, throughput "
+            "and queries per request. Runs in process unless --url points it at a "
+            "running server. Writes orders and reviews, use a seeded database.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--url", help="Base URL of a running server, e.g. http://127.0.0.1:8000")
+        parser.add_argument("--threads", type=int, default=4)
+        parser.add_argument("--requests", type=int, default=200,
+                            help="Requests per thread.")
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        try:
+            result = loadtest.run(max(1, options["threads"]), options["requests"],
+                                  options["seed"], base_url=options["url"])
+        except ValueError as e:
+            raise CommandError(e)
+
+        summary = loadtest.summarise(result)
+        total = sum(flow["requests"] for flow in summary.values())
+        self.stdout.write(f"{'flow':<12} {'requests':>8} {'errors':>6} {'p50':>8} "
+                          f"{'p95':>8} {'p99':>8} {'queries':>8} {'max':>4}")
+        for name, flow in summary.items():
+            queries = ("-", "-") if flow["queries"] is None else (
+                f"{flow['queries']:.1f}", flow["max_queries"])
+            self.stdout.write(
+                f"{name:<12} {flow['requests']:>8} {flow['errors']:>6} "
+                + " ".join(f"{flow[p] * 1000:>6.1f}ms" for p in ("p50", "p95", "p99"))
+                + f" {queries[0]:>8} {queries[1]:>4}")
+        self.stdout.write(self.style.SUCCESS(
+            f"{total} requests in {result['elapsed']:.2f}s "
+            f"({total / result['elapsed']:.1f}/s)"))
+        if result["errors"]:
+            self.stdout.write(self.style.WARNING(
+                f"{len(result['errors'])} requests failed to connect ({result['errors'][0]})"))
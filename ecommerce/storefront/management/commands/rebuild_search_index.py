@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from storefront import search
+
+
+class Command(BaseCommand):
+    help = ("Creates the product full-text search index if missing and "
+            "repopulates it from the product table.")
+
+    def handle(self, *args, **options):
+        if not search.is_indexed():
+            self.stdout.write(f"No search index on {connection.vendor}, search "
+                              "falls back to matching the product fields directly.")
+            return
+        if not search.ensure_index():
+            search.rebuild_index()
+        self.stdout.write(self.style.SUCCESS("Rebuilt the product search index."))
@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from storefront import caching
+from storefront.models import RATING_SUMMARY_FIELDS, STAR_VALUES, Product, Review
+
+
+class Command(BaseCommand):
+    help = ("Recomputes the denormalised rating summary on every product from "
+            "its reviews and repairs any that have drifted.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500)
+        parser.add_argument("--dry-run", action="store_true",
+                            help="Report drifted products without fixing them.")
+
+    def handle(self, *args, **options):
+        # One grouped aggregate for every product that has reviews
+        expected = {row["product"]: row
+                    for row in Review.objects.all().summaries_by_product()}
+
+        drifted = []
+        products = Product.objects.only("id", *RATING_SUMMARY_FIELDS).order_by("pk")
+        for product in products.iterator(chunk_size=options["batch_size"]):
+            row = expected.get(product.pk)
+            count = row["count"] if row else 0
+            total = row["total"] if row else 0
+            values = {"reviews_count": count,
+                      "rating_sum": total,
+                      "average_rating": total / count if count else 0.0,
+                      **{f"rating_{star}_count": row[f"star_{star}"] if row else 0
+                         for star in STAR_VALUES}}
+            if any(getattr(product, field) != value for field, value in values.items()):
+                for field, value in values.items():
+                    setattr(product, field, value)
+                drifted.append(product)
+
+        if drifted and not options["dry_run"]:
+            with transaction.atomic():
+                Product.objects.bulk_update(drifted, RATING_SUMMARY_FIELDS,
+                                            batch_size=options["batch_size"])
+            caching.invalidate_products(p.pk for p in drifted)
+
+        verb = "Found" if options["dry_run"] else "Repaired"
+        self.stdout.write(self.style.SUCCESS(
+            f"{verb} {len(drifted)} products with a drifted rating summary."))
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F
+
+from storefront import caching
+from storefront.models import OUT_OF_STOCK_TAGLINE, Product
+
+
+class Command(BaseCommand):
+    help = ("Backfills the fields Product.save() derives (sale price and the "
+            "out of stock tagline) for rows written before it did so.")
+
+    def handle(self, *args, **options):
+        # Two set-based UPDATEs, independent of catalogue size
+        with transaction.atomic():
+            prices = (Product.objects.filter(discount=False)
+                      .exclude(sale_price=F("price"))
+                      .update(sale_price=F("price")))
+            taglines = (Product.objects.filter(stock=0)
+                        .exclude(tagline=OUT_OF_STOCK_TAGLINE)
+                        .update(tagline=OUT_OF_STOCK_TAGLINE))
+        if prices or taglines:
+            caching.invalidate_all()
+        self.stdout.write(self.style.SUCCESS(
+            f"Updated sale price on {prices} and tagline on {taglines} products."))
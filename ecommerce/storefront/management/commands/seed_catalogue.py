@@ -0,0 +1,31 @@
+import random
+
+from django.core.management.base import BaseCommand
+
+from storefront import loadtest
+
+
+class Command(BaseCommand):
+    help = ("Seeds a synthetic catalogue for load testing: products, users who "
+            "log in with the load test password, reviews and orders, written "
+            "with bulk inserts so large catalogues take seconds.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--products", type=int, default=1000)
+        parser.add_argument("--reviews", type=int, default=5000)
+        parser.add_argument("--users", type=int, default=50)
+        parser.add_argument("--orders", type=int, default=500)
+        parser.add_argument("--seed", type=int, default=0,
+                            help="Random seed, the same seed writes the same catalogue.")
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument("--clear", action="store_true",
+                            help="Delete previously seeded rows first.")
+
+    def handle(self, *args, **options):
+        if options["clear"]:
+            self.stdout.write(f"Deleted {loadtest.clear()} previously seeded rows.")
+        counts = loadtest.seed(options["products"], options["reviews"], options["users"],
+                               options["orders"], random.Random(options["seed"]),
+                               batch_size=max(1, options["batch_size"]))
+        self.stdout.write(self.style.SUCCESS(
+            "Seeded " + ", ".join(f"{n} {name}" for name, n in counts.items()) + "."))
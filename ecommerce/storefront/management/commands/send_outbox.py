@@ -0,0 +1,34 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from storefront import outbox
+
+
+class Command(BaseCommand):
+    help = ("Sends the queued outbound emails in batches over one mail "
+            "connection. Runs once, or keeps polling with --loop.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=outbox.BATCH_SIZE)
+        parser.add_argument("--loop", action="store_true",
+                            help="Keep running and poll the queue.")
+        parser.add_argument("--interval", type=float, default=5.0,
+                            help="Seconds between polls with --loop.")
+
+    def handle(self, *args, **options):
+        while True:
+            try:
+                sent, failed = outbox.drain(options["batch_size"])
+            except OSError as e:
+                # Mail server unreachable, the batch is retried once its claim expires
+                self.stderr.write(f"Could not connect to the mail server: {e}")
+                sent = failed = 0
+            if sent or failed or not options["loop"]:
+                self.stdout.write(self.style.SUCCESS(f"Sent {sent} emails, {failed} failed."))
+            if not options["loop"]:
+                return
+            try:
+                time.sleep(options["interval"])
+            except KeyboardInterrupt:
+                return
@@ -0,0 +1,113 @@
+"""
+    Serves uploaded media in the whitenoise and sendfile asset modes (see
+    ASSET_MODE in settings).
+
+    Files are streamed from MEDIA_ROOT with an ETag, Last-Modified and a
+    Cache-Control max-age, answer conditional requests with 304 and honour
+    single byte range requests. In sendfile mode the file isn't read at
+    all: the response only names it in SENDFILE_HEADER and the front end
+    server sends it.
+"""
+import mimetypes
+import os
+import re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+from django.views.decorators.http import require_http_methods
+
+RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def _file_path(path) -> str:
+    try:
+        full_path = safe_join(settings.MEDIA_ROOT, path)
+    except SuspiciousFileOperation:
+        raise Http404
+    if not os.path.isfile(full_path):
+        raise Http404
+    return full_path
+
+
+def _byte_range(header, size):
+    """
+        Returns (start, end) inclusive for a single range Range header,
+        None to send the whole file (no header, or one that is invalid or
+        we don't support), or False if the range starts past the end.
+    """
+    match = RANGE_PATTERN.match(header or "")
+    if not match or not any(match.groups()):
+        return None
+    first, last = match.groups()
+    if not first:
+        # Suffix range, the last N bytes
+        start, end = max(0, size - int(last)), size - 1
+    elif last and int(last) < int(first):
+        # Invalid, e.g. bytes=5-3, which RFC 9110 says to ignore
+        return None
+    else:
+        start, end = int(first), min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        return False
+    return start, end
+
+
+def _sendfile_response(path, full_path, content_type) -> HttpResponse:
+    response = HttpResponse(content_type=content_type)
+    if settings.SENDFILE_HEADER == "X-Accel-Redirect":
+        response["X-Accel-Redirect"] = quote(settings.SENDFILE_PREFIX.rstrip("/") + "/" + path)
+    else:
+        response[settings.SENDFILE_HEADER] = full_path
+    return response
+
+
+@require_http_methods(["GET", "HEAD"])
+def serve(request, path):
+    full_path = _file_path(path)
+    content_type = mimetypes.guess_type(full_path)[0] or "application/octet-stream"
+    if settings.ASSET_MODE == "sendfile":
+        return _sendfile_response(path, full_path, content_type)
+
+    stat = os.stat(full_path)
+    etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+    last_modified = int(stat.st_mtime)
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        byte_range = None
+        if "HTTP_IF_RANGE" not in request.META or request.META["HTTP_IF_RANGE"] == etag:
+            byte_range = _byte_range(request.META.get("HTTP_RANGE"), stat.st_size)
+        if byte_range is False:
+            response = HttpResponse(status=416)
+            response["Content-Range"] = f"bytes */{stat.st_size}"
+            return response
+
+        f = open(full_path, "rb")
+        if byte_range is None:
+            response = FileResponse(f, content_type=content_type)
+        else:
+            start, end = byte_range
+            f.seek(start)
+            response = StreamingHttpResponse(_read_range(f, end - start + 1),
+                                             content_type=content_type, status=206)
+            response["Content-Range"] = f"bytes {start}-{end}/{stat.st_size}"
+            response["Content-Length"] = end - start + 1
+    response["ETag"] = etag
+    response["Last-Modified"] = http_date(last_modified)
+    response["Accept-Ranges"] = "bytes"
+    patch_cache_control(response, public=True, max_age=settings.MEDIA_MAX_AGE)
+    return response
+
+
+def _read_range(f, length, chunk_size=FileResponse.block_size):
+    with f:
+        while length > 0:
+            chunk = f.read(min(chunk_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
@@ -0,0 +1,161 @@
+import cProfile
+import functools
+import logging
+import os
+import random
+import re
+import time
+from collections import Counter
+from contextlib import ExitStack
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.template.backends.django import Template
+
+from . import caching, carts
+
+logger = logging.getLogger("storefront.performance")
+
+# The timings of the request being handled, None outside PerformanceMiddleware
+_current = ContextVar("request_timings", default=None)
+
+
+class CartCookieMiddleware:
+    """
+        Sets the signed cookie of an anonymous cart a view just created, or
+        deletes it once the cart was merged on login. See carts.py.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        if hasattr(request, "cart_cookie"):
+            carts.set_cookie(response, request.cart_cookie)
+        return response
+
+
+# --------------------
+# Performance
+# --------------------
+class RequestTimings:
+    """What one request spent its time on, in seconds."""
+
+    def __init__(self):
+        self.queries = 0
+        self.db = 0.0
+        self.template = 0.0
+        self.rendering = False
+        self.cache = Counter(hits=0, misses=0)
+
+    def __call__(self, execute, sql, params, many, context):
+        # A connection.execute_wrapper(), times every query
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db += time.perf_counter() - started
+            self.queries += 1
+
+
+def _timed_render(render):
+    @functools.wraps(render)
+    def wrapper(self, context=None, request=None):
+        timings = _current.get()
+        # Only the outermost render, templates can render others
+        if timings is None or timings.rendering:
+            return render(self, context, request)
+        timings.rendering = True
+        started = time.perf_counter()
+        try:
+            return render(self, context, request)
+        finally:
+            timings.template += time.perf_counter() - started
+            timings.rendering = False
+
+    wrapper.timed = True
+    return wrapper
+
+
+class PerformanceMiddleware:
+    """
+        Times each request when PERF_TIMING is on: database queries and
+        their time, template rendering (which includes queries run while
+        rendering), catalogue cache hits and misses, and the total. They are
+        sent in a Server-Timing header, which browser dev tools show, and
+        logged as one key=value line on the storefront.performance logger.
+
+        With PERF_PROFILE_SAMPLE above 0 that share of requests also runs
+        under cProfile, and the profiles of those slower than
+        PERF_SLOW_REQUEST_MS are saved to PERF_PROFILE_DIR for pstats or
+        snakeviz.
+
+        When PERF_TIMING is off Django drops the middleware at startup, so
+        it costs nothing.
+    """
+
+    def __init__(self, get_response):
+        if not settings.PERF_TIMING:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        if not getattr(Template.render, "timed", False):
+            Template.render = _timed_render(Template.render)
+
+    def __call__(self, request):
+        timings = RequestTimings()
+        token = _current.set(timings)
+        counts_token = caching.request_counts.set(timings.cache)
+        profiler = None
+        if settings.PERF_PROFILE_SAMPLE and random.random() < settings.PERF_PROFILE_SAMPLE:
+            profiler = cProfile.Profile()
+        started = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(timings))
+                if profiler:
+                    profiler.enable()
+                try:
+                    response = self.get_response(request)
+                finally:
+                    if profiler:
+                        profiler.disable()
+        finally:
+            _current.reset(token)
+            caching.request_counts.reset(counts_token)
+        total = time.perf_counter() - started
+
+        response["Server-Timing"] = server_timing(timings, total)
+        logger.info(
+            "method=%s path=%s status=%s total_ms=%.1f db_queries=%d db_ms=%.1f "
+            "template_ms=%.1f cache_hits=%d cache_misses=%d",
+            request.method, request.path, response.status_code, total * 1000,
+            timings.queries, timings.db * 1000, timings.template * 1000,
+            timings.cache["hits"], timings.cache["misses"])
+        if profiler and total * 1000 >= settings.PERF_SLOW_REQUEST_MS:
+            self._save_profile(profiler, request, total)
+        return response
+
+    def _save_profile(self, profiler, request, total) -> None:
+        os.makedirs(settings.PERF_PROFILE_DIR, exist_ok=True)
+        slug = re.sub(r"[^\w]+", "-", request.path).strip("-") or "root"
+        path = os.path.join(settings.PERF_PROFILE_DIR,
+                            f"{time.strftime('%Y%m%d-%H%M%S')}-{request.method}-{slug}"
+                            f"-{total * 1000:.0f}ms.prof")
+        profiler.dump_stats(path)
+        logger.warning("Slow request %s %s took %.0fms, profile saved to %s",
+                       request.method, request.path, total * 1000, path)
+
+
+def server_timing(timings, total) -> str:
+    """The Server-Timing header value for a request's timings."""
+    cache = timings.cache
+    return ", ".join([
+        f'db;dur={timings.db * 1000:.1f};desc="{timings.queries} queries"',
+        f"template;dur={timings.template * 1000:.1f}",
+        f'cache;desc="{cache["hits"]} hits, {cache["misses"]} misses"',
+        f"total;dur={total * 1000:.1f}",
+    ])
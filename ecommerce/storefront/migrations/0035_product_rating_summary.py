@@ -0,0 +1,68 @@
+# Generated by Django 5.2.18 on 2026-10-17 22:53
+
+from django.db import migrations, models
+
+
+def backfill_rating_summary(apps, schema_editor):
+    Product = apps.get_model('storefront', 'Product')
+    Review = apps.get_model('storefront', 'Review')
+    stats = (Review.objects.order_by().values('product')
+             .annotate(count=models.Count('id'), total=models.Sum('rating'),
+                       **{f'star_{i}': models.Count('id', filter=models.Q(rating=i))
+                          for i in range(1, 6)}))
+    for row in stats:
+        Product.objects.filter(pk=row['product']).update(
+            reviews_count=row['count'], rating_sum=row['total'],
+            average_rating=row['total'] / row['count'],
+            **{f'rating_{i}_count': row[f'star_{i}'] for i in range(1, 6)})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storefront', '0034_payment'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='average_rating',
+            field=models.FloatField(default=0.0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_1_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_2_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_3_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_4_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_5_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_sum',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='reviews_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_rating_summary, migrations.RunPython.noop),
+    ]
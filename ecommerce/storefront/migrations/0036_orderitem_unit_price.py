@@ -0,0 +1,31 @@
+from django.db import migrations, models
+
+
+def snapshot_unit_prices(apps, schema_editor):
+    # Best effort for existing orders, the price paid was never recorded
+    OrderItem = apps.get_model('storefront', 'OrderItem')
+    Product = apps.get_model('storefront', 'Product')
+    OrderItem.objects.filter(unit_price__isnull=True).update(
+        unit_price=models.Subquery(
+            Product.objects.filter(pk=models.OuterRef('product_id')).values('sale_price')[:1]))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storefront', '0035_product_rating_summary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='orderitem',
+            name='unit_price',
+            field=models.DecimalField(decimal_places=2, max_digits=8, null=True),
+        ),
+        migrations.RunPython(snapshot_unit_prices, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='orderitem',
+            name='unit_price',
+            field=models.DecimalField(decimal_places=2, max_digits=8),
+        ),
+    ]
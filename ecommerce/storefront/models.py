@@ -1,8 +1,12 @@
 """Django data models for the ecommerce storefront application."""
+from decimal import Decimal
+
 from django.core.validators import MinValueValidator, MaxValueValidator
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import User
-from django.db.models.signals import post_save
+from django.db.models.functions import Cast, Coalesce, Now, NullIf
+from django.db.models.signals import post_delete, post_save
+from django.utils import timezone
 
 # --------------------
 # Customer
@@ -43,6 +47,20 @@ post_save.connect(create_customer, sender=User)
 # --------------------
 # Catalogue
 # --------------------
+OUT_OF_STOCK_TAGLINE = "Out of Stock"
+# Fields Product.save() derives from the others, see refresh_derived_fields()
+DERIVED_PRODUCT_FIELDS = ("sale_price", "tagline")
+STAR_VALUES = range(5, 0, -1)
+# Denormalised review statistics, only ever written by adjust_ratings() and
+# the recompute_ratings command
+RATING_SUMMARY_FIELDS = ("reviews_count", "rating_sum", "average_rating",
+                         *(f"rating_{star}_count" for star in STAR_VALUES))
+# The columns a catalogue card reads, see ProductQuerySet.catalogue_cards()
+CARD_FIELDS = ("name", "tagline", "price", "sale_price", "discount", "stock",
+               "image", "image_variants", "category__name", "range__name",
+               *RATING_SUMMARY_FIELDS)
+
+
 class ProductCategory(models.Model):
 
 
@@ -70,9 +88,88 @@ class ProductRange(models.Model):
         return f"{self.name}"
     
 
+class OutOfStock(Exception):
+    """Raised by ProductQuerySet.reserve_stock() when stock runs short."""
+
+    def __init__(self, quantities):
+        super().__init__("Insufficient stock")
+        self.quantities = quantities
+
+    def short_products(self) -> list:
+        """Returns the products that can't cover the requested quantity."""
+        return [p for p in Product.objects.filter(pk__in=self.quantities)
+                if p.stock < self.quantities[p.pk]]
+
+
+class ProductQuerySet(models.QuerySet):
+
+    def catalogue_cards(self):
+        """
+            Products as listings show them, with category and range joined
+            and only the CARD_FIELDS columns loaded. The long overview,
+            description and specifications are left out, so a page reads
+            a fraction of the bytes and caches a fraction of the objects.
+        """
+        return self.select_related("category", "range").only(*CARD_FIELDS)
+
+    def reserve_stock(self, quantities) -> None:
+        """
+            Takes {product id: quantity} out of stock with one conditional
+            UPDATE that only matches rows with enough stock left. Raises
+            OutOfStock if any row didn't match, so callers must run this
+            inside transaction.atomic() to roll back the partial update.
+        """
+        if not quantities:
+            return
+        enough = models.Q()
+        for pk, qty in quantities.items():
+            enough |= models.Q(pk=pk, stock__gte=qty)
+        updated = self.filter(enough).update(
+            stock=models.Case(
+                *(models.When(pk=pk, then=models.F("stock") - qty)
+                  for pk, qty in quantities.items()),
+                default=models.F("stock"),
+                output_field=models.PositiveIntegerField()),
+            # Same as refresh_derived_fields() for rows this sells out
+            tagline=models.Case(
+                *(models.When(pk=pk, stock=qty, then=models.Value(OUT_OF_STOCK_TAGLINE))
+                  for pk, qty in quantities.items()),
+                default=models.F("tagline")),
+            updated_at=Now())
+        if updated != len(quantities):
+            raise OutOfStock(quantities)
+
+    def adjust_ratings(self, added=(), removed=()) -> int:
+        """
+            Applies reviews being added and/or removed to the rating summary
+            of the products in this queryset with a single UPDATE, so
+            concurrent reviews never overwrite each other's counts.
+        """
+        count = len(added) - len(removed)
+        total = sum(added) - sum(removed)
+        if not count and not total:
+            return 0
+        new_count = models.F("reviews_count") + count
+        new_total = models.F("rating_sum") + total
+        updates = {
+            "reviews_count": new_count,
+            "rating_sum": new_total,
+            "average_rating": Coalesce(
+                Cast(new_total, models.FloatField()) / NullIf(new_count, 0),
+                models.Value(0.0)),
+            "updated_at": Now(),
+        }
+        for star in {*added, *removed}:
+            field = f"rating_{star}_count"
+            updates[field] = models.F(field) + list(added).count(star) - list(removed).count(star)
+        return self.update(**updates)
+
+
 class Product(models.Model):
 
     name = models.CharField(max_length=128)
+    # The supplier's code, matches feed rows to products, see feeds.py
+    sku = models.CharField(max_length=64, unique=True, null=True, blank=True)
     tagline = models.CharField(max_length=64, default="", blank=True)
     overview = models.TextField(max_length=512, default="One of the finest product.")
     description = models.TextField(max_length=2048, default="No description")
@@ -85,6 +182,38 @@ class Product(models.Model):
     range = models.ForeignKey(ProductRange, on_delete=models.CASCADE, null=True)
     discount = models.BooleanField(default=False)
     sale_price = models.DecimalField(max_digits=8, decimal_places=2)
+    # Rating summary, see RATING_SUMMARY_FIELDS
+    reviews_count = models.PositiveIntegerField(default=0)
+    rating_sum = models.PositiveIntegerField(default=0)
+    average_rating = models.FloatField(default=0.0)
+    rating_5_count = models.PositiveIntegerField(default=0)
+    rating_4_count = models.PositiveIntegerField(default=0)
+    rating_3_count = models.PositiveIntegerField(default=0)
+    rating_2_count = models.PositiveIntegerField(default=0)
+    rating_1_count = models.PositiveIntegerField(default=0)
+    # Resized copies of image, maintained by images.py
+    image_variants = models.JSONField(default=dict, blank=True, editable=False)
+    # Also set by the ProductQuerySet updates, for Last-Modified headers
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = ProductQuerySet.as_manager()
+
+    class Meta:
+        # Partial indexes over displayable products, one per listing sort
+        # (see listing.SORTS) so pages are read in index order
+        indexes = [
+            models.Index(fields=["name", "id"], condition=models.Q(display_item=True),
+                         name="product_display_name_idx"),
+            models.Index(fields=["sale_price", "id"], condition=models.Q(display_item=True),
+                         name="product_display_price_idx"),
+            models.Index(fields=["-average_rating", "-reviews_count", "name", "id"],
+                         condition=models.Q(display_item=True),
+                         name="product_display_rating_idx"),
+            models.Index(fields=["category", "name", "id"], condition=models.Q(display_item=True),
+                         name="product_display_category_idx"),
+            models.Index(fields=["range", "name", "id"], condition=models.Q(display_item=True),
+                         name="product_display_range_idx"),
+        ]
 
     def is_in_stock(self) -> bool:
 
@@ -93,7 +222,7 @@ class Product(models.Model):
     def check_stock(self) -> None:
 
         if not self.is_in_stock():
-            self.tagline = "Out of Stock"
+            self.tagline = OUT_OF_STOCK_TAGLINE
             self.save()
 
     def update_sale_price(self) -> None:
@@ -102,6 +231,48 @@ class Product(models.Model):
             self.sale_price = self.price
         self.save()
 
+    def refresh_derived_fields(self) -> None:
+        """
+            Derives sale price and the out of stock tagline from price,
+            discount and stock. Run on every save so the catalogue pages
+            can read both values without writing anything back.
+        """
+        if not self.discount:
+            self.sale_price = self.price
+        if not self.is_in_stock():
+            self.tagline = OUT_OF_STOCK_TAGLINE
+
+    def rating_summary(self) -> dict:
+        """
+            Returns the stored rating summary in the same shape as
+            ReviewQuerySet.summary().
+        """
+        return {"count": self.reviews_count,
+                "average": self.average_rating,
+                "histogram": {star: getattr(self, f"rating_{star}_count")
+                              for star in STAR_VALUES}}
+
+    def save(self, *args, **kwargs) -> None:
+        """
+            Saving a product that was loaded or saved before writes every
+            field except the rating summary, and like any update_fields
+            save raises DatabaseError if its row was deleted meanwhile.
+            Copies (pk set to None), force_insert and force_update saves
+            write every field.
+        """
+        self.refresh_derived_fields()
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None:
+            kwargs["update_fields"] = {*update_fields, *DERIVED_PRODUCT_FIELDS, "updated_at"}
+        elif not (self._state.adding or self.pk is None
+                  or kwargs.get("force_insert") or kwargs.get("force_update")):
+            # Never write back a possibly stale rating summary, reviews
+            # maintain it with in-place updates
+            kwargs["update_fields"] = [
+                f.name for f in self._meta.concrete_fields
+                if not f.primary_key and f.name not in RATING_SUMMARY_FIELDS]
+        super().save(*args, **kwargs)
+
     def __str__(self) -> str:
         if self.discount:
             striked_price = "".join([f'{c}\u0336' for c in f"${self.price}"])
@@ -113,19 +284,48 @@ class Product(models.Model):
 # --------------------
 # Orders
 # --------------------
+def _order_total_expression():
+    return Coalesce(
+        models.Sum(models.F("orderitem__unit_price") * models.F("orderitem__quantity")),
+        models.Value(Decimal("0.00")),
+        output_field=models.DecimalField(max_digits=10, decimal_places=2))
+
+
+class OrderQuerySet(models.QuerySet):
+
+    def with_totals(self):
+        """
+            Annotates each order with total_cost, summed from the unit
+            prices paid, so listing orders needs no per-order queries.
+        """
+        return self.annotate(total_cost=_order_total_expression())
+
+
 class Order(models.Model):
 
-    user = models.ForeignKey(User, on_delete=models.CASCADE, null=True)
+    # Indexed by order_user_id_idx
+    user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, db_index=False)
     address = models.CharField(max_length=256)
     date = models.DateTimeField(auto_now_add=True)
     status = models.CharField(max_length=32, default="Processing")
 
-    def get_total_cost(self):
-        total = 0.0
-        order_items = OrderItem.objects.filter(order=self)
-        for item in order_items:
-            total += float(item.product.sale_price) * int(item.quantity)
-        return total
+    objects = OrderQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # A customer's orders, oldest first, on the account page
+            models.Index(fields=["user", "id"], name="order_user_id_idx"),
+            # Date ranges of orders, with or without a status, for exports.py
+            models.Index(fields=["date", "id"], name="order_date_idx"),
+            models.Index(fields=["status", "date", "id"], name="order_status_date_idx"),
+        ]
+
+    def get_total_cost(self) -> Decimal:
+        # Use the with_totals() annotation when present, else one aggregate
+        if hasattr(self, "total_cost"):
+            return self.total_cost
+        return Order.objects.filter(pk=self.pk).aggregate(
+            total=_order_total_expression())["total"]
 
     def __str__(self) -> str:
         try:
@@ -139,13 +339,101 @@ class OrderItem(models.Model):
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
     order = models.ForeignKey(Order, on_delete=models.CASCADE)
     quantity = models.PositiveIntegerField(default=1)
+    # Price paid per unit, snapshotted from the product at checkout
+    unit_price = models.DecimalField(max_digits=8, decimal_places=2)
+
+    def get_subtotal(self) -> Decimal:
+        return self.unit_price * self.quantity
 
     def __str__(self) -> str:
-        return f"Order {self.order.pk} of {self.product.name}: {self.product.price} x {self.quantity} = ${self.product.price * self.quantity}"
+        return f"Order {self.order_id} of {self.product.name}: {self.unit_price} x {self.quantity} = ${self.get_subtotal()}"
+
+# --------------------
+# Carts
+# --------------------
+class Cart(models.Model):
+    """
+        A shopping cart, owned by a user or, for anonymous visitors, found
+        from a signed cookie. See carts.py.
+    """
+
+    user = models.OneToOneField(User, on_delete=models.CASCADE, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        # Finding abandoned anonymous carts to purge
+        indexes = [models.Index(fields=["updated_at"], condition=models.Q(user__isnull=True),
+                                name="cart_anonymous_idx")]
+
+    def __str__(self):
+        return f"Cart {self.pk} of {self.user or 'anonymous'}"
+
+
+class CartItem(models.Model):
+
+    # Indexed by cartitem_cart_product_unique
+    cart = models.ForeignKey(Cart, on_delete=models.CASCADE, related_name="items", db_index=False)
+    product = models.ForeignKey(Product, on_delete=models.CASCADE)
+    quantity = models.PositiveIntegerField(default=1)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=["cart", "product"],
+                                               name="cartitem_cart_product_unique")]
+
+    def __str__(self):
+        return f"{self.quantity} x {self.product_id} in cart {self.cart_id}"
+
 
 # --------------------
 # Reviews
 # --------------------
+
+def star_icons(rating) -> list:
+    """
+        Returns the Font Awesome classes for five stars showing the rating
+        rounded to the nearest half star.
+    """
+    stars = []
+    counter = round(rating * 2) / 2
+    for _ in range(5):
+        if counter - 1 >= 0:
+            stars.append("fas fa-star"); counter -= 1
+        elif counter - 0.5 == 0:
+            stars.append("fas fa-star-half-alt"); counter -= 0.5
+        else:
+            stars.append("far fa-star")
+    return stars
+
+
+class ReviewQuerySet(models.QuerySet):
+
+    def summary(self) -> dict:
+        """
+            Returns the review count, average rating and per-star histogram
+            for the reviews in this queryset using one aggregate query.
+        """
+        stats = self.order_by().aggregate(**_summary_aggregates())
+        return {"count": stats["count"],
+                "average": stats["total"] / stats["count"] if stats["count"] else 0,
+                "histogram": {star: stats[f"star_{star}"] for star in STAR_VALUES}}
+
+    def summaries_by_product(self):
+        """
+            Returns the same statistics as summary() grouped per product, as
+            dictionaries keyed by the aggregate names plus "product".
+        """
+        return (self.order_by().values("product")
+                .annotate(**_summary_aggregates()))
+
+
+def _summary_aggregates() -> dict:
+    return {"count": models.Count("id"),
+            "total": models.Sum("rating"),
+            **{f"star_{star}": models.Count("id", filter=models.Q(rating=star))
+               for star in STAR_VALUES}}
+
+
 class Review(models.Model):
     product = models.ForeignKey('Product', on_delete=models.CASCADE, related_name='reviews')
     user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)
@@ -154,8 +442,20 @@ class Review(models.Model):
     body = models.TextField(max_length=2000, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    objects = ReviewQuerySet.as_manager()
+
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            # Product page and API review pages, newest first
+            models.Index(fields=["product", "-created_at", "-id"], name="review_product_recent_idx"),
+            # Covers the rating summary aggregates
+            models.Index(fields=["product", "rating"], name="review_product_rating_idx"),
+        ]
+        constraints = [
+            models.CheckConstraint(condition=models.Q(rating__gte=1, rating__lte=5),
+                                   name="review_rating_1_to_5"),
+        ]
 
     def get_reviewer_username(self):
         try:
@@ -166,20 +466,49 @@ class Review(models.Model):
         return "Anonymous"
 
     def star_list(self):
-        stars = []
-        counter = round(self.rating * 2) / 2
-        for _ in range(5):
-            if counter - 1 >= 0:
-                stars.append("fas fa-star"); counter -= 1
-            elif counter - 0.5 == 0:
-                stars.append("fas fa-star-half-alt"); counter -= 0.5
+        return star_icons(self.rating)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember what the product rating summary counted for this review
+        # so an edit can take it back out
+        if "product_id" in instance.__dict__ and "rating" in instance.__dict__:
+            instance._counted = (instance.product_id, instance.rating)
+        return instance
+
+    def save(self, *args, **kwargs):
+        counted = getattr(self, "_counted", None)
+        with transaction.atomic():
+            if counted is None and not self._state.adding:
+                counted = Review.objects.filter(pk=self.pk).values_list(
+                    "product_id", "rating").first()
+            super().save(*args, **kwargs)
+            current = (self.product_id, int(self.rating))
+            if counted is None:
+                Product.objects.filter(pk=self.product_id).adjust_ratings(
+                    added=[current[1]])
+            elif counted[0] == current[0]:
+                Product.objects.filter(pk=self.product_id).adjust_ratings(
+                    added=[current[1]], removed=[counted[1]])
             else:
-                stars.append("far fa-star")
-        return stars
+                Product.objects.filter(pk=counted[0]).adjust_ratings(
+                    removed=[counted[1]])
+                Product.objects.filter(pk=self.product_id).adjust_ratings(
+                    added=[current[1]])
+        self._counted = current
 
     def __str__(self):
         return f"{self.get_reviewer_username()} reviewed {self.product.name} at {self.rating}/5 - {self.title}"
 
+
+def uncount_review(sender, instance, **kwargs):
+    # Sent for admin and queryset deletes too, inside the delete transaction
+    Product.objects.filter(pk=instance.product_id).adjust_ratings(
+        removed=[instance.rating])
+
+post_delete.connect(uncount_review, sender=Review)
+
 # --------------------
 # Contact
 # --------------------
@@ -189,10 +518,15 @@ class ContactMessage(models.Model):
     subject = models.CharField(max_length=200)
     message = models.TextField()
     created_at = models.DateTimeField(auto_now_add=True)
-
+    is_read = models.BooleanField(default=False)
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=["created_at"], name="contact_created_idx"),
+            # The inbox's unread filter, and covers its total and unread counts
+            models.Index(fields=["is_read", "created_at"], name="contact_read_created_idx"),
+        ]
 
     def __str__(self):
         return f"{self.name} - {self.subject}"
@@ -209,3 +543,122 @@ class Payment(models.Model):
 
     def __str__(self):
         return f"Payment {self.id} — {self.provider} (****{self.last4})"
+
+
+# --------------------
+# Outbox
+# --------------------
+class OutboundEmail(models.Model):
+    """An email waiting to be sent by the outbox worker, see outbox.py"""
+
+    PENDING = "pending"
+    SENT = "sent"
+    FAILED = "failed"
+    STATUS_CHOICES = [(PENDING, "Pending"), (SENT, "Sent"), (FAILED, "Failed")]
+
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    from_email = models.CharField(max_length=254)
+    to = models.JSONField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # What the worker polls for
+            models.Index(fields=["next_attempt_at"], condition=models.Q(status="pending"),
+                         name="outbox_due_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.subject} -> {', '.join(self.to)} ({self.status})"
+
+
+# --------------------
+# Reporting
+# --------------------
+class SalesRollup(models.Model):
+    """
+        Revenue, units and orders of one day or week, for one product,
+        category or range or for the whole shop. Kept up to date by
+        rollups.py as orders are placed, so reports never read orders.
+    """
+
+    DAY = "day"
+    WEEK = "week"
+    PERIOD_CHOICES = [(DAY, "Day"), (WEEK, "Week")]
+    ALL = "all"
+    PRODUCT = "product"
+    CATEGORY = "category"
+    RANGE = "range"
+    DIMENSION_CHOICES = [(ALL, "All"), (PRODUCT, "Product"), (CATEGORY, "Category"),
+                         (RANGE, "Range")]
+
+    period = models.CharField(max_length=4, choices=PERIOD_CHOICES)
+    # The day, or the Monday of the week, in the shop's time zone
+    start = models.DateField()
+    dimension = models.CharField(max_length=8, choices=DIMENSION_CHOICES)
+    # Id of the product, category or range, 0 for the whole shop or none
+    key = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=Decimal("0.00"))
+    units = models.PositiveIntegerField(default=0)
+    orders = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        # Also what the dashboard reads, one period and dimension by date
+        constraints = [models.UniqueConstraint(fields=["period", "dimension", "start", "key"],
+                                               name="salesrollup_unique")]
+
+    def __str__(self):
+        return f"{self.get_period_display()} {self.start} {self.dimension} {self.key}: ${self.revenue}"
+
+
+# --------------------
+# Recommendations
+# --------------------
+class ProductRecommendation(models.Model):
+    """
+        One of the products most often bought together with product, by
+        rank. Written by recommendations.py from the order history and
+        read by the product page's "Customers also bought".
+    """
+
+    # Indexed by the unique constraint below, which leads with it
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, db_index=False,
+                                related_name="recommendations")
+    recommended = models.ForeignKey(Product, on_delete=models.CASCADE,
+                                    related_name="recommended_for")
+    # 0 for the best match
+    rank = models.PositiveSmallIntegerField()
+    # Cosine similarity of the two products' orders, from 0 to 1
+    score = models.FloatField()
+
+    class Meta:
+        # The product page reads one product's rows in rank order from it
+        constraints = [models.UniqueConstraint(fields=["product", "rank"],
+                                               name="recommendation_rank")]
+
+    def __str__(self):
+        return f"{self.product_id} #{self.rank}: {self.recommended_id} ({self.score:.3f})"
+
+
+class RecommendationBuild(models.Model):
+    """A run of recommendations.build() or refresh(), the next refresh starts after it."""
+
+    # When it read the newest order id, see recommendations.RESCAN
+    started_at = models.DateTimeField(default=timezone.now)
+    finished_at = models.DateTimeField(auto_now_add=True)
+    # Id of the newest order it read
+    through_order = models.PositiveIntegerField(default=0)
+    full = models.BooleanField(default=True)
+    # Products whose recommendations it replaced, and the rows it wrote
+    products = models.PositiveIntegerField(default=0)
+    recommendations = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        kind = "Full build" if self.full else "Refresh"
+        return f"{kind} through order {self.through_order} at {self.finished_at:%Y-%m-%d %H:%M}"
@@ -0,0 +1,110 @@
+"""
+    Durable outgoing email.
+
+    Views never talk to the mail server. They enqueue() an OutboundEmail
+    row in the same transaction as the change it reports, so an email is
+    queued if and only if that change commits, and the request doesn't
+    wait on SMTP. The send_outbox command drains the queue in batches over
+    one reused mail connection. A failed send is retried with exponential
+    backoff until MAX_ATTEMPTS, then left as failed for the admin to see.
+
+    Each batch is claimed by pushing its next attempt past CLAIM_TIMEOUT,
+    so several workers can drain the same queue without sending an email
+    twice, and the batch of a worker that died is picked up again later.
+"""
+import logging
+import random
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.utils import timezone
+
+from .models import OutboundEmail
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 50
+MAX_ATTEMPTS = 6
+BACKOFF_BASE = timedelta(seconds=30)
+BACKOFF_MAX = timedelta(hours=2)
+CLAIM_TIMEOUT = timedelta(minutes=5)
+
+
+def enqueue(subject, body, to, from_email=None) -> OutboundEmail:
+    """Queues an email, callers should be inside the transaction it belongs to."""
+    return OutboundEmail.objects.create(
+        subject=subject[:255], body=body, to=list(to),
+        from_email=from_email or settings.DEFAULT_FROM_EMAIL)
+
+
+def backoff(attempts) -> timedelta:
+    """Delay before retry number `attempts`, doubling each time, with jitter."""
+    delay = min(BACKOFF_BASE * 2 ** (attempts - 1), BACKOFF_MAX)
+    return delay * random.uniform(0.8, 1.2)
+
+
+def claim_batch(size=BATCH_SIZE) -> list:
+    """Claims up to size due emails for this worker and returns them."""
+    now = timezone.now()
+    with transaction.atomic():
+        batch = list(OutboundEmail.objects.select_for_update(skip_locked=True)
+                     .filter(status=OutboundEmail.PENDING, next_attempt_at__lte=now)
+                     .order_by("next_attempt_at")[:size])
+        OutboundEmail.objects.filter(pk__in=[e.pk for e in batch]).update(
+            next_attempt_at=now + CLAIM_TIMEOUT)
+    return batch
+
+
+def send_batch(batch, connection) -> tuple:
+    """
+        Sends a claimed batch over an open connection and records each
+        result. Returns (sent, failed) counts.
+    """
+    sent, failed = [], []
+    for email in batch:
+        message = EmailMessage(email.subject, email.body, email.from_email, email.to,
+                               connection=connection)
+        try:
+            message.send()
+        except Exception as e:
+            logger.warning("Sending outbound email %s failed: %s", email.pk, e)
+            # Reconnect for the next one in case the connection broke
+            connection.close()
+            email.attempts += 1
+            email.last_error = f"{type(e).__name__}: {e}"
+            if email.attempts >= MAX_ATTEMPTS:
+                email.status = OutboundEmail.FAILED
+            else:
+                email.next_attempt_at = timezone.now() + backoff(email.attempts)
+            failed.append(email)
+        else:
+            email.attempts += 1
+            email.status = OutboundEmail.SENT
+            email.sent_at = timezone.now()
+            sent.append(email)
+
+    OutboundEmail.objects.bulk_update(sent, ["status", "attempts", "sent_at"])
+    OutboundEmail.objects.bulk_update(
+        failed, ["status", "attempts", "last_error", "next_attempt_at"])
+    return len(sent), len(failed)
+
+
+def drain(batch_size=BATCH_SIZE, connection=None) -> tuple:
+    """
+        Sends every email that is due, one batch at a time over a single
+        mail connection. Returns (sent, failed) totals.
+    """
+    totals = [0, 0]
+    batch = claim_batch(batch_size)
+    if not batch:
+        # Don't connect to the mail server just to find nothing to send
+        return tuple(totals)
+    connection = connection or get_connection()
+    with connection:
+        while batch:
+            for i, count in enumerate(send_batch(batch, connection)):
+                totals[i] += count
+            batch = claim_batch(batch_size)
+    return tuple(totals)
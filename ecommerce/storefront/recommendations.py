@@ -0,0 +1,233 @@
+"""
+    "Customers also bought": the products most often ordered together.
+
+    build() reads which products each order contains and counts, for every
+    pair of products, the orders they share: a sparse item-item
+    co-occurrence matrix. Each pair is scored by cosine similarity,
+
+        orders with a and b / sqrt(orders with a * orders with b)
+
+    so best sellers don't become everyone's match, and the TOP_K best of
+    each product are stored as ProductRecommendation rows. The matrix is
+    built in NumPy as (row, column, count) arrays, the coordinate form of
+    a sparse matrix, never a dense products x products one, so millions of
+    order items take seconds; see the bench_recommendations command.
+
+    refresh() only redoes the products in orders placed since the last
+    build, reading just the orders that contain them. Order ids are taken
+    before commit, so it also rereads the orders placed in the RESCAN
+    before the last build started, in case one committed after it read
+    them. Other products' scores
+    drift a little as the products they match keep selling, which the
+    next full build corrects. See the build_recommendations command.
+
+    The product page reads a product's rows with one query on the
+    (product, rank) index, through also_bought().
+"""
+import itertools
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Count, Max, Q
+from django.utils import timezone
+
+from . import caching
+from .models import OrderItem, Product, ProductRecommendation, RecommendationBuild
+
+TOP_K = 10
+# Pairs bought together less often than this are noise
+MIN_ORDERS = 2
+# Products whose rows are replaced per transaction
+WRITE_BATCH = 500
+# Shown on the product page
+SHOWN = 4
+# Longer than any checkout transaction: an order with an id below the
+# newest a build read can still be uncommitted, and unseen, until then
+RESCAN = timedelta(minutes=10)
+
+
+# --------------------
+# Scoring
+# --------------------
+def _baskets(np, items):
+    """
+        The distinct (order, product) pairs of an OrderItem queryset as two
+        int64 arrays, sorted by order.
+    """
+    ids = items.values_list("order_id", "product_id").iterator(chunk_size=10000)
+    pairs = np.fromiter(itertools.chain.from_iterable(ids), dtype=np.int64).reshape(-1, 2)
+    return distinct(np, pairs[:, 0], pairs[:, 1])
+
+
+def distinct(np, orders, products):
+    """Drops repeated (order, product) pairs and sorts them by order."""
+    # One int64 per pair: order in the high bits, product in the low
+    keys = np.unique((orders << 32) | products)
+    return keys >> 32, keys & 0xFFFFFFFF
+
+
+def _pairs(np, orders, products):
+    """
+        Every ordered pair (a, b) of different products in the same order,
+        for orders sorted by order as _baskets() returns them.
+    """
+    # Where each order's run of products starts, and how long it is
+    starts = np.flatnonzero(np.r_[True, orders[1:] != orders[:-1]])
+    sizes = np.diff(np.r_[starts, len(orders)])
+    # Each product is paired with every product of its order, itself too
+    per_item = np.repeat(sizes, sizes)
+    left = np.repeat(np.arange(len(orders)), per_item)
+    offsets = np.arange(len(left)) - np.repeat(np.cumsum(per_item) - per_item, per_item)
+    right = np.repeat(np.repeat(starts, sizes), per_item) + offsets
+    keep = left != right
+    return products[left[keep]], products[right[keep]]
+
+
+def similar(np, orders, products, counts=None, only=None, top_k=TOP_K,
+            min_orders=MIN_ORDERS):
+    """
+        Scores the products bought together in the baskets (orders and
+        products as _baskets() returns them) and keeps the top_k of each.
+        counts[pk] is the number of orders with product pk, counted from
+        the baskets when not given. With only, an array of product ids,
+        just those products get recommendations.
+
+        Returns arrays of product, recommended, rank and score, sorted by
+        product and rank.
+    """
+    if counts is None:
+        counts = np.bincount(products, minlength=int(products.max(initial=0)) + 1)
+    left, right = _pairs(np, orders, products)
+    if only is not None:
+        wanted = np.isin(left, only)
+        left, right = left[wanted], right[wanted]
+    # The sparse co-occurrence matrix: one entry per pair bought together
+    width = max(len(counts), int(right.max(initial=0)) + 1)
+    cells, together = np.unique(left * width + right, return_counts=True)
+    frequent = together >= min_orders
+    cells, together = cells[frequent], together[frequent]
+    left, right = cells // width, cells % width
+    score = together / np.sqrt(counts[left].astype(np.float64) * counts[right])
+
+    # Best first within each product, ties to the pair bought more, then the lower id
+    best = np.lexsort((right, -together, -score, left))
+    left, right, score = left[best], right[best], score[best]
+    starts = np.flatnonzero(np.r_[True, left[1:] != left[:-1]])
+    rank = np.arange(len(left)) - np.repeat(starts, np.diff(np.r_[starts, len(left)]))
+    top = rank < top_k
+    return left[top], right[top], rank[top], score[top]
+
+
+# --------------------
+# Building
+# --------------------
+def _write(np, rows, replace) -> int:
+    """
+        Replaces the recommendations of the products in replace, a sorted
+        array of ids, with rows from similar(). WRITE_BATCH products per
+        transaction, so the page never sees a product without any.
+    """
+    product, recommended, rank, score = rows
+    written = 0
+    for i in range(0, len(replace), WRITE_BATCH):
+        batch = replace[i:i + WRITE_BATCH]
+        # Rows are sorted by product, the batch's are one slice of them
+        lo = np.searchsorted(product, batch[0], side="left")
+        hi = np.searchsorted(product, batch[-1], side="right")
+        picked = np.isin(product[lo:hi], batch)
+        objs = [ProductRecommendation(product_id=int(p), recommended_id=int(r),
+                                      rank=int(k), score=float(s))
+                for p, r, k, s in zip(product[lo:hi][picked], recommended[lo:hi][picked],
+                                      rank[lo:hi][picked], score[lo:hi][picked])]
+        with transaction.atomic():
+            ProductRecommendation.objects.filter(product_id__in=batch.tolist()).delete()
+            ProductRecommendation.objects.bulk_create(objs)
+        written += len(objs)
+    return written
+
+
+def _newest_order():
+    """The time and id of the newest order line, where a build starts reading."""
+    return timezone.now(), OrderItem.objects.aggregate(newest=Max("order_id"))["newest"] or 0
+
+
+def _finish(started, through, full, products, written) -> dict:
+    RecommendationBuild.objects.create(started_at=started, through_order=through, full=full,
+                                       products=products, recommendations=written)
+    caching.invalidate_recommendations()
+    return {"products": products, "recommendations": written, "through_order": through}
+
+
+def build(top_k=TOP_K, min_orders=MIN_ORDERS) -> dict:
+    """
+        Rebuilds every product's recommendations from the whole order
+        history. Returns the number of products refreshed, recommendations
+        written and the newest order read.
+    """
+    # Only the jobs need NumPy, keep it out of the web processes
+    import numpy as np
+
+    # Orders placed while this runs are left to the next refresh
+    started, through = _newest_order()
+    orders, products = _baskets(np, OrderItem.objects.filter(order_id__lte=through))
+    rows = similar(np, orders, products, top_k=top_k, min_orders=min_orders)
+    # Every product, so ones that no longer match anything lose their rows
+    replace = np.fromiter(Product.objects.order_by("pk").values_list("pk", flat=True)
+                          .iterator(chunk_size=10000), dtype=np.int64)
+    return _finish(started, through, True, len(replace), _write(np, rows, replace))
+
+
+def refresh(top_k=TOP_K, min_orders=MIN_ORDERS) -> dict:
+    """
+        Rebuilds the recommendations of the products ordered since the last
+        build or refresh, or of every product if there wasn't one. Returns
+        what build() does.
+
+        Orders placed in the RESCAN before the last one started are read
+        again: one with a lower id than it read may have committed later.
+    """
+    import numpy as np
+
+    last = RecommendationBuild.objects.order_by("-pk").first()
+    if last is None:
+        return build(top_k, min_orders)
+    started, through = _newest_order()
+    history = OrderItem.objects.filter(order_id__lte=through)
+    ordered = (history.filter(Q(order_id__gt=last.through_order)
+                              | Q(order__date__gte=last.started_at - RESCAN))
+               .values("product_id").distinct())
+    affected = np.unique(np.fromiter(ordered.values_list("product_id", flat=True),
+                                     dtype=np.int64))
+    if not len(affected):
+        return _finish(started, through, False, 0, 0)
+
+    # Every order holding an affected product, old ones included, which
+    # is all the matrix rows of those products need
+    baskets = history.filter(order_id__in=history.filter(product_id__in=ordered)
+                             .values("order_id"))
+    orders, products = _baskets(np, baskets)
+    # The products in those orders are scored by all their orders, counted
+    # for them alone so a refresh doesn't read the whole history
+    totals = (history.filter(product_id__in=baskets.values("product_id"))
+              .values("product_id").annotate(orders=Count("order_id", distinct=True))
+              .values_list("product_id", "orders"))
+    totals = np.fromiter(itertools.chain.from_iterable(totals), dtype=np.int64).reshape(-1, 2)
+    counts = np.zeros(int(max(totals[:, 0].max(initial=0), products.max(initial=0))) + 1,
+                      dtype=np.int64)
+    counts[totals[:, 0]] = totals[:, 1]
+    rows = similar(np, orders, products, counts=counts, only=affected,
+                   top_k=top_k, min_orders=min_orders)
+    return _finish(started, through, False, len(affected), _write(np, rows, affected))
+
+
+# --------------------
+# Reading
+# --------------------
+def also_bought(pk, limit=SHOWN) -> list:
+    """
+        The products most often bought with product pk, best first, as
+        catalogue cards. Hidden products are skipped.
+    """
+    return list(Product.objects.catalogue_cards()
+                .filter(recommended_for__product_id=pk, display_item=True)
+                .order_by("recommended_for__rank")[:limit])
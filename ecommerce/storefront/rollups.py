@@ -0,0 +1,235 @@
+"""
+    Sales rollups: revenue, units and orders per day and per week for
+    every product, category and range and for the whole shop, stored as
+    SalesRollup rows.
+
+    record_order() adds an order to its day and week with one upsert once
+    the checkout has committed, so concurrent checkouts don't queue on the
+    shop-wide rows. backfill() rebuilds them from the OrderItem history
+    with NumPy, for orders placed before the rollups existed or written by
+    bulk inserts. It leaves the current week to checkout unless told
+    otherwise. The staff sales dashboard reads only the rollups, through
+    series() and top(), so reports never scan orders.
+"""
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+
+from django.db import connection, models, transaction
+from django.db.models import F, Max, Min, Sum, Value
+from django.db.models.functions import Coalesce, Round, TruncDate
+from django.utils import timezone
+
+from .models import Order, OrderItem, Product, ProductCategory, ProductRange, SalesRollup
+
+COLUMNS = ("period", "start", "dimension", "key", "revenue", "units", "orders")
+# Rows per INSERT, well under SQLite's 999 parameters
+UPSERT_BATCH = 100
+NAMED: dict[str, type[models.Model]] = {
+    SalesRollup.PRODUCT: Product, SalesRollup.CATEGORY: ProductCategory,
+    SalesRollup.RANGE: ProductRange}
+
+
+def week_start(day):
+    """The Monday of day's week."""
+    return day - timedelta(days=day.weekday())
+
+
+def _periods(day):
+    return ((SalesRollup.DAY, day), (SalesRollup.WEEK, week_start(day)))
+
+
+def _keys(product):
+    return ((SalesRollup.ALL, 0), (SalesRollup.PRODUCT, product.pk),
+            (SalesRollup.CATEGORY, product.category_id or 0),
+            (SalesRollup.RANGE, product.range_id or 0))
+
+
+# --------------------
+# Incremental updates
+# --------------------
+def _upsert(rows) -> None:
+    """
+        Adds each row's revenue, units and orders to its rollup, creating
+        the rollups that don't exist yet. Concurrent checkouts can't lose
+        each other's sales as the addition happens in the database.
+    """
+    table = connection.ops.quote_name(SalesRollup._meta.db_table)
+    columns = [connection.ops.quote_name(c) for c in COLUMNS]
+    conflict = ", ".join(columns[:4])
+    updates = ", ".join(f"{c} = {table}.{c} + excluded.{c}" for c in columns[4:])
+    with connection.cursor() as cursor:
+        for i in range(0, len(rows), UPSERT_BATCH):
+            batch = rows[i:i + UPSERT_BATCH]
+            values = ", ".join(["(%s, %s, %s, %s, %s, %s, %s)"] * len(batch))
+            params = [value for row in batch for value in (
+                row[0], connection.ops.adapt_datefield_value(row[1]), row[2], row[3],
+                connection.ops.adapt_decimalfield_value(row[4], 14, 2), row[5], row[6])]
+            cursor.execute(f"INSERT INTO {table} ({', '.join(columns)}) VALUES {values} "
+                           f"ON CONFLICT ({conflict}) DO UPDATE SET {updates}", params)
+
+
+def record_order(order, items) -> None:
+    """
+        Adds a new order's line items (as carts.items() returns them) to
+        the rollups of its day and week, with one statement run after the
+        current transaction commits. Every checkout updates the same
+        shop-wide rows, and holding their locks until the checkout commits
+        would make checkouts wait on each other. If the upsert fails the
+        order stands and is logged, backfill() can repair the rollups.
+    """
+    totals: defaultdict[tuple, list] = defaultdict(lambda: [Decimal("0.00"), 0])
+    for item in items:
+        for key in _keys(item["product"]):
+            totals[key][0] += item["unit_price"] * item["quantity"]
+            totals[key][1] += item["quantity"]
+    day = timezone.localdate(order.date)
+    rows = [(period, start, dimension, key, revenue, units, 1)
+            for period, start in _periods(day)
+            for (dimension, key), (revenue, units) in totals.items()]
+    transaction.on_commit(lambda: _upsert(rows), robust=True)
+
+
+# --------------------
+# Backfill
+# --------------------
+def _midnight(day):
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+def _group(np, starts, keys, orders, units, cents):
+    """
+        Sums units and cents and counts distinct orders per (start, key),
+        all vectorized. Returns the starts, keys, cents, units and order
+        counts of each group.
+    """
+    # One int64 per group: day number in the high bits, key in the low
+    group_ids = (starts << 32) | keys
+    groups, inverse = np.unique(group_ids, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    revenue = np.bincount(inverse, weights=cents, minlength=len(groups))
+    unit_sums = np.bincount(inverse, weights=units, minlength=len(groups))
+    # An order counts once per group however many of its items fall in it
+    pairs = np.unique((inverse.astype(np.int64) << 32) | orders)
+    order_counts = np.bincount(pairs >> 32, minlength=len(groups))
+    return groups >> 32, groups & 0xFFFFFFFF, revenue, unit_sums, order_counts
+
+
+def _window_rollups(np, first, last) -> list:
+    items = (OrderItem.objects
+             .filter(order__date__gte=_midnight(first),
+                     order__date__lt=_midnight(last + timedelta(days=1)))
+             .values_list("order_id", TruncDate("order__date"), "product_id",
+                          Coalesce("product__category_id", Value(0)),
+                          Coalesce("product__range_id", Value(0)),
+                          "quantity", Round(F("unit_price") * F("quantity") * 100)))
+    rows = list(items)
+    if not rows:
+        return []
+    order_ids, days, product_ids, category_ids, range_ids, units, cents = zip(*rows)
+    orders = np.array(order_ids, dtype=np.int64)
+    units = np.array(units, dtype=np.int64)
+    cents = np.rint(np.array(cents, dtype=np.float64))
+    day_numbers = np.array(days, dtype="datetime64[D]").astype(np.int64)
+    # 1970-01-01 was a Thursday, so Mondays are 3 days before (n + 3) % 7 == 0
+    week_numbers = day_numbers - (day_numbers + 3) % 7
+    epoch = np.datetime64("1970-01-01", "D")
+
+    rollups = []
+    dimensions = ((SalesRollup.ALL, np.zeros_like(orders)),
+                  (SalesRollup.PRODUCT, np.array(product_ids, dtype=np.int64)),
+                  (SalesRollup.CATEGORY, np.array(category_ids, dtype=np.int64)),
+                  (SalesRollup.RANGE, np.array(range_ids, dtype=np.int64)))
+    for period, starts in ((SalesRollup.DAY, day_numbers), (SalesRollup.WEEK, week_numbers)):
+        for dimension, keys in dimensions:
+            for start, key, revenue, unit_sum, order_count in zip(
+                    *_group(np, starts, keys, orders, units, cents)):
+                rollups.append(SalesRollup(
+                    period=period, start=(epoch + int(start)).item(), dimension=dimension,
+                    key=int(key), revenue=Decimal(int(revenue)).scaleb(-2),
+                    units=int(unit_sum), orders=int(order_count)))
+    return rollups
+
+
+def backfill(first=None, last=None, window_weeks=4, batch_size=1000,
+             include_current_week=False) -> int:
+    """
+        Rebuilds the rollups of the weeks from first to last, by default
+        every week with orders or rollups, replacing what is stored. Works
+        through window_weeks at a time, each read and written in its own
+        transaction. Returns the number of rollups written.
+
+        The current week is skipped unless include_current_week: checkout
+        keeps adding to it, and an upsert committed while its window is
+        rebuilt would be lost. Only include it while no orders are placed.
+    """
+    # Only the backfill needs NumPy, keep it out of the web processes
+    import numpy as np
+
+    if first is None or last is None:
+        # Both ends of order_date_idx, and of stored rollups whose orders
+        # may since have been deleted
+        dates = Order.objects.aggregate(oldest=Min("date"), newest=Max("date"))
+        stored = SalesRollup.objects.aggregate(oldest=Min("start"), newest=Max("start"))
+        days = ([timezone.localdate(d) for d in dates.values() if d]
+                + [d for d in stored.values() if d])
+        if not days:
+            return 0
+        first = first or min(days)
+        last = last or max(days)
+    if not include_current_week:
+        last = min(last, week_start(timezone.localdate()) - timedelta(days=1))
+    # Whole weeks, the week rollups of last's week need all its days
+    stop = week_start(last) + timedelta(days=6)
+
+    written = 0
+    window = week_start(first)
+    while window <= stop:
+        window_last = min(window + timedelta(weeks=window_weeks, days=-1), stop)
+        with transaction.atomic():
+            # Read after the delete, which on SQLite takes the write lock,
+            # so no checkout commits between the read and the write
+            SalesRollup.objects.filter(start__range=(window, window_last)).delete()
+            rollups = _window_rollups(np, window, window_last)
+            SalesRollup.objects.bulk_create(rollups, batch_size=batch_size)
+        written += len(rollups)
+        window = window_last + timedelta(days=1)
+    return written
+
+
+# --------------------
+# Reading
+# --------------------
+def series(period, first, last) -> list:
+    """
+        The whole shop's revenue, units and orders for each period from
+        first to last, periods without sales included as zeros.
+    """
+    stored = {r.start: r for r in SalesRollup.objects.filter(
+        period=period, dimension=SalesRollup.ALL, key=0, start__range=(first, last))}
+    step = timedelta(days=1 if period == SalesRollup.DAY else 7)
+    rows, start = [], first
+    while start <= last:
+        rows.append(stored.get(start) or SalesRollup(period=period, start=start,
+                                                     dimension=SalesRollup.ALL))
+        start += step
+    return rows
+
+
+def top(period, dimension, first, last, limit=10) -> list:
+    """
+        The products, categories or ranges that sold the most from first
+        to last, with their names, as dicts of key, name, revenue, units
+        and orders.
+    """
+    rows = list(SalesRollup.objects
+                .filter(period=period, dimension=dimension, start__range=(first, last))
+                .values("key")
+                .annotate(revenue=Sum("revenue"), units=Sum("units"), orders=Sum("orders"))
+                .order_by("-revenue", "key")[:limit])
+    # Key 0 is "none", an empty id list runs no query
+    names = dict(NAMED[dimension].objects.filter(pk__in=[r["key"] for r in rows if r["key"]])
+                 .values_list("pk", "name"))
+    for row in rows:
+        row["name"] = names.get(row["key"], "(deleted)" if row["key"] else "(none)")
+    return rows
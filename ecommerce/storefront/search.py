@@ -0,0 +1,152 @@
+"""
+    Full-text product search.
+
+    On SQLite the product text fields are indexed in an FTS5 table kept in
+    sync by triggers, so bulk writes are indexed too and matching doesn't
+    scan the product table. Searches join the index once and rank results
+    with bm25 from that join, weighting the name highest. Other databases fall back to case-insensitive matching on
+    the same fields.
+"""
+import difflib
+import re
+
+from django.db import connection
+from django.db.models import FloatField, Q, Value
+from django.db.models.expressions import RawSQL
+
+FTS_TABLE = "storefront_product_fts"
+VOCAB_TABLE = "storefront_product_fts_vocab"
+PRODUCT_TABLE = "storefront_product"
+SEARCH_FIELDS = ("name", "tagline", "overview", "description", "specifications")
+# bm25 column weights, in SEARCH_FIELDS order
+FIELD_WEIGHTS = (10.0, 4.0, 2.0, 1.0, 1.0)
+# Indexed terms suggest() compares a misspelt word with, most used first
+SUGGEST_CANDIDATES = 500
+# difflib's ratio cutoff for a suggestion
+SUGGEST_CUTOFF = 0.75
+
+
+def is_indexed(conn=connection) -> bool:
+    return conn.vendor == "sqlite"
+
+
+def _index_sql() -> list:
+    columns = ", ".join(SEARCH_FIELDS)
+    new_values = ", ".join(f"new.{f}" for f in SEARCH_FIELDS)
+    old_values = ", ".join(f"old.{f}" for f in SEARCH_FIELDS)
+    delete_old = (f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, {columns}) "
+                  f"VALUES ('delete', old.id, {old_values});")
+    insert_new = (f"INSERT INTO {FTS_TABLE}(rowid, {columns}) "
+                  f"VALUES (new.id, {new_values});")
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+        f"{columns}, content='{PRODUCT_TABLE}', content_rowid='id', "
+        f"tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {VOCAB_TABLE} "
+        f"USING fts5vocab({FTS_TABLE}, 'row')",
+        f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ai AFTER INSERT ON {PRODUCT_TABLE} "
+        f"BEGIN {insert_new} END",
+        f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ad AFTER DELETE ON {PRODUCT_TABLE} "
+        f"BEGIN {delete_old} END",
+        f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_au AFTER UPDATE OF {columns} "
+        f"ON {PRODUCT_TABLE} BEGIN {delete_old} {insert_new} END",
+    ]
+
+
+def ensure_index(conn=connection) -> bool:
+    """
+        Creates the index and its triggers if any are missing and rebuilds
+        it when it had to, returning whether it did. Migrations that remake
+        the product table drop its triggers, so this runs after every
+        migrate.
+    """
+    if not is_indexed(conn):
+        return False
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT count(*) FROM sqlite_master WHERE name IN (%s, %s, %s, %s, %s)",
+            [FTS_TABLE, VOCAB_TABLE, *(f"{FTS_TABLE}_{t}" for t in ("ai", "ad", "au"))])
+        if cursor.fetchone()[0] == 5:
+            return False
+        for statement in _index_sql():
+            cursor.execute(statement)
+    rebuild_index(conn)
+    return True
+
+
+def rebuild_index(conn=connection) -> None:
+    """Repopulates the whole index from the product table."""
+    if is_indexed(conn):
+        with conn.cursor() as cursor:
+            cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+
+
+def match_expression(query) -> str:
+    """
+        Turns free text into an FTS5 query matching every word as a prefix,
+        e.g. 'mech keyb' -> '"mech"* "keyb"*'.
+    """
+    words = re.findall(r"\w+", query.lower())
+    return " ".join(f'"{word}"*' for word in words)
+
+
+def search_products(queryset, query):
+    """
+        Filters a product queryset to those matching query and annotates
+        search_rank, lower being more relevant.
+    """
+    if not is_indexed():
+        matches = Q()
+        for field in SEARCH_FIELDS:
+            matches |= Q(**{f"{field}__icontains": query})
+        return queryset.filter(matches).annotate(
+            search_rank=Value(0.0, output_field=FloatField()))
+
+    expression = match_expression(query)
+    if not expression:
+        return queryset.none()
+    # The index is a virtual table with no model to join it through, so
+    # it is added to FROM by hand; bm25() reads the row that matched
+    weights = ", ".join(str(w) for w in FIELD_WEIGHTS)
+    return queryset.extra(
+        tables=[FTS_TABLE],
+        where=[f"{FTS_TABLE}.rowid = {PRODUCT_TABLE}.id", f"{FTS_TABLE} MATCH %s"],
+        params=[expression],
+    ).annotate(search_rank=RawSQL(f"bm25({FTS_TABLE}, {weights})", (),
+                                  output_field=FloatField()))
+
+
+def _similar_lengths(word) -> tuple:
+    # difflib's ratio is 2 * matches / (len(a) + len(b)), and there can't be
+    # more matches than letters in the shorter word
+    return (int(len(word) * SUGGEST_CUTOFF / (2 - SUGGEST_CUTOFF)) or 1,
+            int(len(word) * (2 - SUGGEST_CUTOFF) / SUGGEST_CUTOFF))
+
+
+def suggest(query):
+    """
+        Returns query with each word that isn't in the index replaced by the
+        closest indexed term, or None if nothing could be corrected. Only
+        the SUGGEST_CANDIDATES most used terms sharing the word's first
+        letter, of a length that could be close enough, are considered.
+    """
+    if not is_indexed():
+        return None
+    words = re.findall(r"\w+", query.lower())
+    corrected = []
+    with connection.cursor() as cursor:
+        for word in words:
+            cursor.execute(f"SELECT 1 FROM {VOCAB_TABLE} WHERE term >= %s AND term < %s LIMIT 1",
+                           [word, word[:-1] + chr(ord(word[-1]) + 1)])
+            if cursor.fetchone():
+                corrected.append(word)
+                continue
+            cursor.execute(
+                f"SELECT term FROM {VOCAB_TABLE} WHERE term >= %s AND term < %s "
+                f"AND length(term) BETWEEN %s AND %s ORDER BY doc DESC LIMIT %s",
+                [word[0], chr(ord(word[0]) + 1), *_similar_lengths(word), SUGGEST_CANDIDATES])
+            terms = [row[0] for row in cursor.fetchall()]
+            close = difflib.get_close_matches(word, terms, n=1, cutoff=SUGGEST_CUTOFF)
+            corrected.append(close[0] if close else word)
+    suggestion = " ".join(corrected)
+    return suggestion if suggestion != " ".join(words) else None
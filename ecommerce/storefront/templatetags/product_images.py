@@ -0,0 +1,45 @@
+from django import template
+from django.forms.utils import flatatt
+from django.utils.html import format_html, format_html_join
+
+from storefront import images
+
+register = template.Library()
+
+
+def _srcset(sources) -> str:
+    return ", ".join(f"{url} {width}w" for width, url in sources)
+
+
+@register.simple_tag
+def product_picture(product, width, sizes=None, **attrs):
+    """
+        Renders product's image displayed width CSS pixels wide as a
+        <picture> offering its AVIF and WebP variants with a srcset, so the
+        browser downloads the smallest file that is sharp enough. Images
+        without variants are rendered from the original file. Extra keyword
+        arguments become <img> attributes, e.g. loading="eager".
+
+            {% product_picture product 175 %}
+    """
+    if not product.image:
+        return ""
+    variants = product.image_variants or {}
+    attrs = {"alt": product.name, "width": width,
+             "loading": "lazy", "decoding": "async", **attrs}
+    fallback = images.sources(product)
+    if not fallback:
+        return format_html("<img src=\"{}\"{}>", product.image.url, flatatt(attrs))
+
+    sizes = sizes or f"{width}px"
+    attrs["height"] = round(width * variants["height"] / variants["width"])
+    # The smallest variant at least twice the displayed width, for browsers
+    # that ignore srcset
+    src = next((url for w, url in fallback if w >= width * 2), fallback[-1][1])
+    modern = [(images.MIME_TYPES[fmt], _srcset(sources))
+              for fmt in images.MODERN_FORMATS if (sources := images.sources(product, fmt))]
+    return format_html(
+        "<picture>{}<img src=\"{}\" srcset=\"{}\" sizes=\"{}\"{}></picture>",
+        format_html_join("", "<source type=\"{}\" srcset=\"{}\" sizes=\"{}\">",
+                         ((mime, srcset, sizes) for mime, srcset in modern)),
+        src, _srcset(fallback), sizes, flatatt(attrs))
@@ -1,13 +1,61 @@
 # storefront/tests.py
+from datetime import timedelta
 from decimal import Decimal
+from io import BytesIO, StringIO
+import csv
+import difflib
+import json
+import os
+import pstats
+import random
+import re
+import smtplib
+import tempfile
+import unittest
 
-from django.test import TestCase, Client
+from django.test import TestCase, Client, RequestFactory, override_settings
 from django.urls import reverse
 from django.contrib.messages import get_messages
+from django.contrib.sessions.models import Session
 from django.contrib.auth import get_user_model
 from django.conf import settings
-from .models import Product, Customer, Order, OrderItem, ContactMessage
+from django.http import HttpRequest, HttpResponse
+from django.core import mail
+from django.core.cache import cache
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.mail.backends.base import BaseEmailBackend
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import DatabaseError, connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from .models import Product, Customer, Order, OrderItem, ContactMessage, Review
+from .models import Cart, CartItem, OutboundEmail, Payment, ProductCategory, ProductRange, SalesRollup
+from .models import ProductRecommendation, RecommendationBuild
+from .models import star_icons
+from . import caching, carts, exports, feeds, images, listing, loadtest, media, outbox
+from . import recommendations, rollups, search, views
 from .forms import ContactForm
+from .middleware import PerformanceMiddleware
+from PIL import Image
+
+def seed_cart(client, lines):
+    """Gives the client an anonymous cart holding (product, quantity) lines."""
+    cart = Cart.objects.create()
+    CartItem.objects.bulk_create([CartItem(cart=cart, product=p, quantity=qty) for p, qty in lines])
+    response = HttpResponse()
+    carts.set_cookie(response, cart.pk)
+    client.cookies.update(response.cookies)
+    return cart
+
+
+def cart_quantities(client):
+    request = HttpRequest()
+    request.COOKIES = {k: v.value for k, v in client.cookies.items()}
+    cart_id = carts._cookie_cart_id(request)
+    return dict(CartItem.objects.filter(cart_id=cart_id).values_list("product_id", "quantity"))
+
 
 class StorefrontTests(TestCase):
     def setUp(self):
@@ -55,10 +103,8 @@ class StorefrontTests(TestCase):
         )
         self.assertRedirects(resp, reverse("cart"))
 
-        # Session should have qty == stock
-        session = self.client.session
-        self.assertIn("cart", session)
-        self.assertEqual(int(session["cart"].get(str(self.p2.id))), 2)
+        # Cart should have qty == stock
+        self.assertEqual(cart_quantities(self.client), {self.p2.id: 2})
 
         # Message is present
         messages = [m.message for m in get_messages(resp.wsgi_request)]
@@ -70,37 +116,29 @@ class StorefrontTests(TestCase):
             data={"qty": 0},  # should be treated as 1
         )
         self.assertRedirects(resp, reverse("cart"))
-        session = self.client.session
-        self.assertEqual(int(session["cart"].get(str(self.p1.id))), 1)
+        self.assertEqual(cart_quantities(self.client), {self.p1.id: 1})
 
     def test_remove_from_cart(self):
         # Seed cart
-        session = self.client.session
-        session["cart"] = {str(self.p1.id): 3}
-        session.save()
+        seed_cart(self.client, [(self.p1, 3)])
 
         resp = self.client.post(reverse("remove_from_cart", args=[self.p1.id]))
         self.assertRedirects(resp, reverse("cart"))
 
-        session = self.client.session
-        self.assertNotIn(str(self.p1.id), session.get("cart", {}))
+        self.assertNotIn(self.p1.id, cart_quantities(self.client))
 
     def test_clear_cart(self):
-        session = self.client.session
-        session["cart"] = {str(self.p1.id): 2, str(self.p2.id): 1}
-        session.save()
+        seed_cart(self.client, [(self.p1, 2), (self.p2, 1)])
 
         resp = self.client.post(reverse("clear_cart"))
         self.assertRedirects(resp, reverse("cart"))
 
-        self.assertEqual(self.client.session.get("cart"), {})
+        self.assertEqual(cart_quantities(self.client), {})
 
     def test_cart_view_totals(self):
         # p1: 2 * 10.00 = 20.00
         # p2 (discounted): 1 * 15.00 = 15.00
-        session = self.client.session
-        session["cart"] = {str(self.p1.id): 2, str(self.p2.id): 1}
-        session.save()
+        seed_cart(self.client, [(self.p1, 2), (self.p2, 1)])
 
         resp = self.client.get(reverse("cart"))
         self.assertEqual(resp.status_code, 200)
@@ -114,9 +152,7 @@ class StorefrontTests(TestCase):
         self.assertRedirects(resp, reverse("home"))
 
     def test_checkout_get_with_items_renders(self):
-        session = self.client.session
-        session["cart"] = {str(self.p1.id): 1}
-        session.save()
+        seed_cart(self.client, [(self.p1, 1)])
 
         resp = self.client.get(reverse("checkout"))
         self.assertEqual(resp.status_code, 200)
@@ -562,4 +598,1880 @@ class ContactFormFieldTestCase(TestCase):
         self.assertEqual(
             form.fields['message'].widget.attrs['class'],
             'form-textarea'
-        )
\ No newline at end of file
+        )
+
+
+class ProductListingTests(TestCase):
+    """The catalogue page reads derived fields instead of writing them"""
+
+    def setUp(self):
+        cache.clear()
+
+    def _make_products(self, n, **kwargs):
+        Product.objects.bulk_create([
+            Product(name=f"Item {i}", price=Decimal("9.99"),
+                    sale_price=Decimal("9.99"), stock=3, **kwargs)
+            for i in range(n)])
+
+    def _capture_products_page(self):
+        # bulk_create doesn't invalidate the listing cache, measure a miss
+        cache.clear()
+        with CaptureQueriesContext(connection) as ctx:
+            resp = self.client.get(reverse("products"))
+        self.assertEqual(resp.status_code, 200)
+        return ctx.captured_queries
+
+    def test_save_derives_sale_price_and_tagline(self):
+        product = Product.objects.create(name="Pad", price=Decimal("12.00"),
+                                         tagline="New", stock=0)
+        self.assertEqual(product.sale_price, Decimal("12.00"))
+        self.assertEqual(product.tagline, "Out of Stock")
+
+    def test_save_with_update_fields_keeps_derived_fields_in_sync(self):
+        product = Product.objects.create(name="Pad", price=Decimal("12.00"),
+                                         tagline="New", stock=1)
+        product.stock = 0
+        product.save(update_fields=["stock"])
+        product.refresh_from_db()
+        self.assertEqual(product.tagline, "Out of Stock")
+
+    def test_listing_only_reads(self):
+        self._make_products(5)
+        queries = self._capture_products_page()
+        self.assertFalse([q for q in queries
+                          if not q["sql"].lstrip().upper().startswith("SELECT")])
+
+    def test_listing_query_count_is_independent_of_catalogue_size(self):
+        self._make_products(2)
+        small = len(self._capture_products_page())
+        self.assertGreater(small, 0)
+        self._make_products(30)
+        self.assertEqual(len(self._capture_products_page()), small)
+
+    def test_listing_loads_catalogue_cards(self):
+        ranged = ProductRange.objects.create(name="Limited Edition")
+        self._make_products(3, range=ranged, description="x" * 2048)
+        with self.assertNumQueries(2):
+            resp = self.client.get(reverse("products"))
+        self.assertContains(resp, "limited-edition-badge", count=3)
+        deferred = resp.context["products"][0].get_deferred_fields()
+        self.assertTrue({"overview", "description", "specifications"} <= deferred)
+        queries = self._capture_products_page()
+        self.assertNotIn('"description"', " ".join(q["sql"] for q in queries))
+
+    def test_refresh_products_backfills_in_bulk(self):
+        # bulk_create skips save(), like rows written before it derived fields
+        self._make_products(3, tagline="New")
+        Product.objects.update(price=Decimal("20.00"), stock=0)
+        call_command("refresh_products", stdout=StringIO())
+        self.assertFalse(Product.objects.exclude(sale_price=Decimal("20.00")).exists())
+        self.assertFalse(Product.objects.exclude(tagline="Out of Stock").exists())
+
+
+class ProductReviewSummaryTests(TestCase):
+    """Review statistics on the product page come from a single aggregate"""
+
+    def setUp(self):
+        cache.clear()
+        self.product = Product.objects.create(name="Pad", price=Decimal("12.00"),
+                                              stock=3)
+        for rating in (5, 5, 4, 2):
+            Review.objects.create(product=self.product, rating=rating,
+                                  title="Title", body="A review body.")
+
+    def test_summary_counts_average_and_histogram(self):
+        summary = Review.objects.filter(product=self.product).summary()
+        self.assertEqual(summary["count"], 4)
+        self.assertEqual(summary["average"], 4)
+        self.assertEqual(summary["histogram"], {5: 2, 4: 1, 3: 0, 2: 1, 1: 0})
+
+    def test_summary_of_no_reviews(self):
+        summary = Review.objects.none().summary()
+        self.assertEqual(summary["count"], 0)
+        self.assertEqual(summary["average"], 0)
+
+    def test_star_icons_rounds_to_half_stars(self):
+        self.assertEqual(star_icons(3.6), ["fas fa-star"] * 3 +
+                         ["fas fa-star-half-alt", "far fa-star"])
+        self.assertEqual(Review(rating=2).star_list(), star_icons(2))
+
+    def test_product_page_review_context(self):
+        # The product, its reviews and its "customers also bought"
+        with self.assertNumQueries(3):
+            resp = self.client.get(reverse("product", args=[self.product.id]))
+        self.assertEqual(resp.context["review_count"], 4)
+        self.assertEqual(resp.context["review_per_star"][5], [2, "50%"])
+        self.assertEqual(resp.context["overall_review"][0], 4.0)
+
+    def test_product_page_pages_reviews_newest_first(self):
+        Review.objects.bulk_create([Review(product=self.product, rating=3, title=f"Later {i}")
+                                    for i in range(views.REVIEWS_PAGE_SIZE)])
+        resp = self.client.get(reverse("product", args=[self.product.id]))
+        self.assertEqual(len(resp.context["reviews"]), views.REVIEWS_PAGE_SIZE)
+        self.assertIsNone(resp.context["reviews_previous_url"])
+        older = self.client.get(resp.context["reviews_next_url"])
+        self.assertEqual([r.title for r in older.context["reviews"]], ["Title"] * 4)
+        self.assertIsNone(older.context["reviews_next_url"])
+        self.assertContains(older, "Newer reviews")
+
+
+class ProductRatingSummaryTests(TestCase):
+    """The stored rating summary follows every review write"""
+
+    def setUp(self):
+        cache.clear()
+        self.pad = Product.objects.create(name="Pad", price=Decimal("12.00"), stock=3)
+        self.mouse = Product.objects.create(name="Mouse", price=Decimal("8.00"), stock=3)
+
+    def _review(self, product, rating):
+        return Review.objects.create(product=product, rating=rating,
+                                     title="Title", body="A review body.")
+
+    def assertSummaryMatchesReviews(self, product):
+        product.refresh_from_db()
+        expected = Review.objects.filter(product=product).summary()
+        self.assertEqual(product.rating_summary(), expected)
+
+    def test_create_updates_summary(self):
+        self._review(self.pad, 5)
+        self._review(self.pad, 2)
+        self.pad.refresh_from_db()
+        self.assertEqual(self.pad.reviews_count, 2)
+        self.assertEqual(self.pad.rating_sum, 7)
+        self.assertEqual(self.pad.average_rating, 3.5)
+        self.assertSummaryMatchesReviews(self.pad)
+
+    def test_edit_moves_rating_between_stars_and_products(self):
+        review = self._review(self.pad, 5)
+        review = Review.objects.get(pk=review.pk)
+        review.rating = 3
+        review.save()
+        self.assertSummaryMatchesReviews(self.pad)
+        review.product = self.mouse
+        review.save()
+        self.assertSummaryMatchesReviews(self.pad)
+        self.assertSummaryMatchesReviews(self.mouse)
+
+    def test_single_and_bulk_delete_update_summary(self):
+        first = self._review(self.pad, 4)
+        for rating in (1, 3, 5):
+            self._review(self.pad, rating)
+        first.delete()
+        self.assertSummaryMatchesReviews(self.pad)
+        Review.objects.filter(product=self.pad, rating__gte=3).delete()
+        self.assertSummaryMatchesReviews(self.pad)
+        self.assertEqual(self.pad.reviews_count, 1)
+
+    def test_product_save_does_not_overwrite_summary(self):
+        stale = Product.objects.get(pk=self.pad.pk)
+        self._review(self.pad, 4)
+        stale.price = Decimal("11.00")
+        stale.save()
+        self.assertSummaryMatchesReviews(self.pad)
+
+    def test_copies_and_forced_saves_write_every_field(self):
+        copy = Product.objects.get(pk=self.pad.pk)
+        copy.pk = None
+        copy.save()
+        self.assertNotEqual(copy.pk, self.pad.pk)
+        Product.objects.filter(pk=copy.pk).delete()
+        copy.save(force_insert=True)
+        self.assertTrue(Product.objects.filter(pk=copy.pk).exists())
+
+    def test_recompute_ratings_repairs_drift(self):
+        self._review(self.pad, 4)
+        self._review(self.mouse, 2)
+        Review.objects.filter(product=self.pad).update(rating=1)
+        Product.objects.filter(pk=self.mouse.pk).update(reviews_count=9)
+        out = StringIO()
+        call_command("recompute_ratings", stdout=out)
+        self.assertIn("Repaired 2", out.getvalue())
+        self.assertSummaryMatchesReviews(self.pad)
+        self.assertSummaryMatchesReviews(self.mouse)
+
+    def test_listing_sorts_and_filters_by_rating(self):
+        self._review(self.pad, 2)
+        self._review(self.mouse, 5)
+        resp = self.client.get(reverse("products"), {"sort": "top-rated"})
+        self.assertEqual([p.name for p in resp.context["products"]], ["Mouse", "Pad"])
+        resp = self.client.get(reverse("products"), {"sort": "alphabetical",
+                                                     "min_rating": "4"})
+        self.assertEqual([p.name for p in resp.context["products"]], ["Mouse"])
+
+
+class OrderTotalTests(TestCase):
+    """Order totals use the snapshotted unit price and never loop per item"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="buyer", password="pw-12345")
+        self.pad = Product.objects.create(name="Pad", price=Decimal("12.00"), stock=9)
+
+    def _order(self, *lines):
+        order = Order.objects.create(user=self.user, address="1 Street")
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product=self.pad, quantity=qty, unit_price=price)
+            for qty, price in lines])
+        return order
+
+    def test_total_uses_price_paid(self):
+        order = self._order((2, Decimal("10.00")), (1, Decimal("12.00")))
+        self.pad.price = Decimal("99.00")
+        self.pad.save()
+        with self.assertNumQueries(1):
+            self.assertEqual(order.get_total_cost(), Decimal("32.00"))
+
+    def test_with_totals_annotates_every_order(self):
+        self._order((1, Decimal("5.00")))
+        self._order((3, Decimal("2.50")), (1, Decimal("1.00")))
+        Order.objects.create(user=self.user, address="Empty")
+        with self.assertNumQueries(1):
+            totals = [o.get_total_cost() for o in Order.objects.with_totals().order_by("id")]
+        self.assertEqual(totals, [Decimal("5.00"), Decimal("8.50"), Decimal("0.00")])
+
+    def test_account_page_query_count_is_independent_of_order_count(self):
+        self.client.login(username="buyer", password="pw-12345")
+        self._order((1, Decimal("5.00")))
+        # Caches the cart badge
+        self.client.get(reverse("account"))
+        with CaptureQueriesContext(connection) as few:
+            self.client.get(reverse("account"))
+        for _ in range(10):
+            self._order((1, Decimal("5.00")), (2, Decimal("3.00")))
+        with CaptureQueriesContext(connection) as many:
+            resp = self.client.get(reverse("account"))
+        self.assertEqual(len(many), len(few))
+        self.assertContains(resp, "11.00")
+
+
+class CheckoutTests(TestCase):
+    """Checkout writes the whole order atomically and never oversells"""
+
+    form = {
+        "first_name": "Jane",
+        "last_name": "Doe",
+        "email": "jane@example.com",
+        "phone": "0400000000",
+        "address": "123 Street, City",
+        "card_name": "Jane Doe",
+        "card_number": "4111 1111 1111 1111",
+        "card_exp": "12/30",
+        "card_cvc": "123",
+    }
+
+    def setUp(self):
+        self.products = [
+            Product.objects.create(name=f"Item {i}", price=Decimal("10.00"), stock=5)
+            for i in range(5)]
+
+    def test_checkout_creates_order_and_reserves_stock(self):
+        seed_cart(self.client, [(self.products[0], 3), (self.products[1], 5)])
+        resp = self.client.post(reverse("checkout"), data=self.form)
+        order = Order.objects.get()
+        self.assertRedirects(resp, reverse("checkoutsuccess", args=[order.id]))
+        self.assertEqual(order.get_total_cost(), Decimal("80.00"))
+        self.assertEqual(Payment.objects.get(order=order).last4, "1111")
+        self.products[0].refresh_from_db()
+        self.products[1].refresh_from_db()
+        self.assertEqual(self.products[0].stock, 2)
+        self.assertEqual(self.products[1].stock, 0)
+        self.assertEqual(self.products[1].tagline, "Out of Stock")
+        self.assertEqual(cart_quantities(self.client), {})
+
+    def test_short_stock_rolls_back_everything(self):
+        seed_cart(self.client, [(self.products[0], 2), (self.products[1], 6)])
+        resp = self.client.post(reverse("checkout"), data=self.form)
+        self.assertRedirects(resp, reverse("cart"))
+        self.assertFalse(Order.objects.exists())
+        self.assertFalse(OrderItem.objects.exists())
+        self.assertFalse(Payment.objects.exists())
+        self.assertEqual(sorted(Product.objects.values_list("stock", flat=True)), [5] * 5)
+        messages = [m.message for m in get_messages(resp.wsgi_request)]
+        self.assertTrue(any("Item 1" in m and "out of stock" in m for m in messages))
+        self.assertEqual(len(cart_quantities(self.client)), 2)
+
+    def test_sqlite_connections_are_tuned_for_concurrent_writers(self):
+        if connection.vendor != "sqlite":
+            self.skipTest("SQLite only")
+        with connection.cursor() as cursor:
+            cursor.execute("PRAGMA synchronous")
+            self.assertEqual(cursor.fetchone()[0], 1)  # NORMAL
+            cursor.execute("PRAGMA busy_timeout")
+            self.assertGreaterEqual(cursor.fetchone()[0], 5000)
+        self.assertEqual(connection.transaction_mode, "IMMEDIATE")
+
+    def test_write_path_is_independent_of_cart_size(self):
+        # The first checkout also creates the guest user, so compare the next two
+        counts = []
+        for cart in ([(self.products[0], 1)], [(self.products[0], 1)],
+                     [(p, 1) for p in self.products]):
+            seed_cart(self.client, cart)
+            with CaptureQueriesContext(connection) as ctx:
+                self.client.post(reverse("checkout"), data=self.form)
+            counts.append(len(ctx))
+        self.assertEqual(counts[1], counts[2])
+
+
+class CartTests(TestCase):
+    """Carts are rows updated in place, merged on login and summarised from cache"""
+
+    def setUp(self):
+        cache.clear()
+        self.pad = Product.objects.create(name="Pad", price=Decimal("10.00"), stock=5)
+        self.stick = Product.objects.create(name="Stick", price=Decimal("20.00"), discount=True,
+                                            sale_price=Decimal("15.00"), stock=9)
+        self.user = User.objects.create_user("carter", password="pw-12345!")
+
+    def test_adding_increments_without_touching_the_session(self):
+        resp = self.client.post(reverse("add_to_cart", args=[self.pad.id]), {"qty": 2})
+        self.assertIn(carts.COOKIE_NAME, resp.cookies)
+        self.assertNotIn(settings.SESSION_COOKIE_NAME, resp.cookies)
+        with CaptureQueriesContext(connection) as ctx:
+            resp = self.client.post(reverse("add_to_cart", args=[self.pad.id]), {"qty": 4})
+        self.assertNotIn(carts.COOKIE_NAME, resp.cookies)
+        self.assertFalse([q for q in ctx.captured_queries if "django_session" in q["sql"]])
+        self.assertEqual(cart_quantities(self.client), {self.pad.id: 5})
+        self.assertEqual(Cart.objects.count(), 1)
+
+    def test_forged_cookie_is_ignored(self):
+        cart = seed_cart(self.client, [(self.pad, 1)])
+        self.client.cookies[carts.COOKIE_NAME] = str(cart.pk)
+        self.assertEqual(self.client.get(reverse("cart")).context["count"], 0)
+
+    def test_anonymous_cart_merges_on_login(self):
+        seed_cart(self.client, [(self.pad, 4), (self.stick, 1)])
+        own = Cart.objects.create(user=self.user)
+        CartItem.objects.create(cart=own, product=self.pad, quantity=3)
+
+        resp = self.client.post(reverse("login"), {"username": "carter", "password": "pw-12345!"})
+        self.assertEqual(resp.cookies[carts.COOKIE_NAME].value, "")
+        self.assertEqual(Cart.objects.get(), own)
+        self.assertEqual(dict(own.items.values_list("product_id", "quantity")),
+                         {self.pad.id: 5, self.stick.id: 1})
+        self.assertEqual(self.client.get(reverse("cart")).context["total"], Decimal("65.00"))
+
+    def test_anonymous_cart_is_adopted_when_user_has_none(self):
+        cart = seed_cart(self.client, [(self.stick, 2)])
+        self.client.post(reverse("login"), {"username": "carter", "password": "pw-12345!"})
+        cart.refresh_from_db()
+        self.assertEqual(cart.user, self.user)
+
+    def test_badge_summary_is_cached_until_the_cart_or_prices_change(self):
+        self.assertEqual(self.client.get(reverse("about")).context["cart_summary"]["count"], 0)
+        self.client.post(reverse("add_to_cart", args=[self.stick.id]), {"qty": 2})
+        self.client.get(reverse("about"))
+        with CaptureQueriesContext(connection) as ctx:
+            resp = self.client.get(reverse("about"))
+        self.assertEqual(len(ctx), 0)
+        self.assertEqual(resp.context["cart_summary"]["count"], 2)
+        self.assertEqual(resp.context["cart_summary"]["total"], Decimal("30.00"))
+
+        self.stick.discount = False
+        self.stick.save()
+        resp = self.client.get(reverse("about"))
+        self.assertEqual(resp.context["cart_summary"]["total"], Decimal("40.00"))
+        self.client.post(reverse("remove_from_cart", args=[self.stick.id]))
+        self.assertEqual(self.client.get(reverse("about")).context["cart_summary"]["count"], 0)
+
+
+class SessionTests(TestCase):
+    """Sessions are only created when needed and expired ones are purged in batches"""
+
+    def test_anonymous_shopping_creates_no_session(self):
+        product = Product.objects.create(name="Pad", price=Decimal("10.00"), stock=5)
+        self.client.get(reverse("products"))
+        self.client.post(reverse("add_to_cart", args=[product.id]))
+        self.client.get(reverse("cart"))
+        self.assertNotIn(settings.SESSION_COOKIE_NAME, self.client.cookies)
+
+    def test_purge_sessions_in_batches(self):
+        now = timezone.now()
+        Session.objects.bulk_create(
+            [Session(session_key=f"old{i}", session_data="", expire_date=now - timedelta(days=1))
+             for i in range(5)] +
+            [Session(session_key="live", session_data="", expire_date=now + timedelta(days=1))])
+        stale, fresh = Cart.objects.create(), Cart.objects.create()
+        owned = Cart.objects.create(user=User.objects.create_user("owner"))
+        Cart.objects.filter(pk__in=[stale.pk, owned.pk]).update(
+            updated_at=now - timedelta(days=31))
+        CartItem.objects.create(cart=stale, product=Product.objects.create(
+            name="Pad", price=Decimal("10.00"), stock=5))
+
+        out = StringIO()
+        with CaptureQueriesContext(connection) as ctx:
+            call_command("purge_sessions", batch_size=2, pause=0, stdout=out)
+        self.assertIn("Deleted 5 expired sessions and 1 abandoned carts.", out.getvalue())
+        self.assertEqual(list(Session.objects.values_list("session_key", flat=True)), ["live"])
+        self.assertEqual(set(Cart.objects.all()), {fresh, owned})
+        deletes = [q for q in ctx.captured_queries
+                   if q["sql"].startswith('DELETE FROM "django_session"')]
+        self.assertEqual(len(deletes), 3)
+
+    def test_bench_sessions_compares_every_engine(self):
+        out = StringIO()
+        call_command("bench_sessions", requests=3, stdout=out)
+        for name in settings.SESSION_ENGINES:
+            self.assertIn(f"{name}:", out.getvalue())
+        self.assertFalse(Session.objects.exists())
+
+
+@override_settings(PERF_TIMING=True, PERF_PROFILE_SAMPLE=0)
+class PerformanceTests(TestCase):
+    """Timed requests report their queries, templates and cache use"""
+
+    def setUp(self):
+        cache.clear()
+        Product.objects.create(name="Pad", price=Decimal("12.00"), stock=3)
+
+    def test_server_timing_header_counts_queries_and_cache(self):
+        with self.assertLogs("storefront.performance", "INFO"):
+            with CaptureQueriesContext(connection) as ctx:
+                miss = self.client.get(reverse("products"))
+            queries = len(ctx)
+            hit = self.client.get(reverse("products"))
+        timing = miss["Server-Timing"]
+        self.assertGreater(queries, 0)
+        self.assertRegex(timing, rf'db;dur=\d+\.\d;desc="{queries} queries"')
+        self.assertRegex(timing, r"template;dur=\d+\.\d")
+        self.assertIn('cache;desc="0 hits, 1 misses"', timing)
+        self.assertIn("total;dur=", timing)
+        self.assertIn('cache;desc="1 hits, 0 misses"', hit["Server-Timing"])
+        # What loadtest reads over HTTP
+        self.assertEqual(loadtest._queries(miss.headers), queries)
+
+    def test_each_request_is_logged(self):
+        with self.assertLogs("storefront.performance", "INFO") as logs:
+            self.client.get(reverse("products"))
+        self.assertRegex(logs.output[0],
+                         r"method=GET path=/products/ status=200 total_ms=[\d.]+ "
+                         r"db_queries=\d+ db_ms=[\d.]+ template_ms=[\d.]+ "
+                         r"cache_hits=\d+ cache_misses=[1-9]")
+
+    def test_slow_sampled_requests_save_a_profile(self):
+        with tempfile.TemporaryDirectory() as directory, \
+                self.settings(PERF_PROFILE_SAMPLE=1, PERF_SLOW_REQUEST_MS=0,
+                              PERF_PROFILE_DIR=directory), \
+                self.assertLogs("storefront.performance", "WARNING") as logs:
+            self.client.get(reverse("products"))
+            files = os.listdir(directory)
+            self.assertEqual(len(files), 1)
+            self.assertRegex(files[0], r"-GET-products-\d+ms\.prof$")
+            pstats.Stats(os.path.join(directory, files[0]))
+        self.assertIn("Slow request GET /products/", logs.output[0])
+
+    def test_removed_when_timing_is_off(self):
+        with self.settings(PERF_TIMING=False):
+            with self.assertRaises(MiddlewareNotUsed):
+                PerformanceMiddleware(lambda request: HttpResponse())
+            self.assertNotIn("Server-Timing", Client().get(reverse("products")))
+
+
+@override_settings(CACHE_STATS=True)
+class CatalogueCacheTests(TestCase):
+    """Catalogue pages are served from cache until a signal invalidates them"""
+
+    def setUp(self):
+        cache.clear()
+        self.pad = Product.objects.create(name="Pad", price=Decimal("12.00"), stock=3)
+
+    def _listing(self):
+        return [p.name for p in self.client.get(reverse("products")).context["products"]]
+
+    def test_listing_is_cached_per_variant(self):
+        self.client.get(reverse("products"))
+        with self.assertNumQueries(0):
+            self.client.get(reverse("products"))
+        with self.assertNumQueries(2):
+            self.client.get(reverse("products"), {"search": "pad", "sort": "alphabetical"})
+        self.assertEqual(caching.stats()["hits"], 1)
+        self.assertEqual(caching.stats()["misses"], 2)
+
+    def test_product_save_and_delete_invalidate_listing(self):
+        self.assertEqual(self._listing(), ["Pad"])
+        Product.objects.create(name="Mouse", price=Decimal("8.00"), stock=3)
+        self.assertEqual(self._listing(), ["Mouse", "Pad"])
+        self.pad.delete()
+        self.assertEqual(self._listing(), ["Mouse"])
+
+    def test_junk_review_cursors_share_the_first_page_entry(self):
+        url = reverse("product", args=[self.pad.id])
+        self.client.get(url)
+        misses = caching.stats()["misses"]
+        for junk in ("x" * 500, "a b\n", listing.encode_cursor(["notadate", 1])):
+            self.client.get(url, {"reviews_after": junk})
+            self.client.get(reverse("api_reviews", args=[self.pad.id]), {"before": junk})
+        # Only the API's first page and its product are new
+        self.assertEqual(caching.stats()["misses"], misses + 2)
+
+    def test_review_invalidates_product_page(self):
+        url = reverse("product", args=[self.pad.id])
+        self.client.get(url)
+        with self.assertNumQueries(0):
+            self.client.get(url)
+        Review.objects.create(product=self.pad, rating=4, title="Title",
+                              body="A review body.")
+        self.assertEqual(self.client.get(url).context["review_count"], 1)
+
+    def test_category_change_invalidates_product_page(self):
+        category = ProductCategory.objects.create(name="Pads")
+        self.pad.category = category
+        self.pad.save()
+        url = reverse("product", args=[self.pad.id])
+        self.assertContains(self.client.get(url), "Pads")
+        category.name = "Gamepads"
+        category.save()
+        self.assertContains(self.client.get(url), "Gamepads")
+
+    def test_checkout_invalidates_stock(self):
+        self.client.get(reverse("product", args=[self.pad.id]))
+        seed_cart(self.client, [(self.pad, 3)])
+        self.client.post(reverse("checkout"), data=CheckoutTests.form)
+        resp = self.client.get(reverse("product", args=[self.pad.id]))
+        self.assertEqual(resp.context["product"].stock, 0)
+
+    def test_file_based_backend(self):
+        with tempfile.TemporaryDirectory() as location:
+            backend = {"default": {
+                "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+                "LOCATION": location}}
+            with self.settings(CACHES=backend):
+                self.assertEqual(self._listing(), ["Pad"])
+                with self.assertNumQueries(0):
+                    self._listing()
+                self.pad.name = "Gamepad"
+                self.pad.save()
+                self.assertEqual(self._listing(), ["Gamepad"])
+
+
+# Database 15 of a local server by default, the tests flush it
+REDIS_TEST_URL = os.environ.get("DJANGO_TEST_REDIS_URL", "redis://127.0.0.1:6379/15")
+
+
+def _redis_cache_options():
+    """
+        OPTIONS for a RedisCache on REDIS_TEST_URL: a live server if one
+        answers there, else fakeredis's in-process stand-in, which every
+        client in the process shares. None without either package.
+    """
+    try:
+        import redis
+    except ImportError:
+        return None
+    try:
+        if redis.Redis.from_url(REDIS_TEST_URL, socket_connect_timeout=0.5).ping():
+            return {}
+    except redis.RedisError:
+        pass
+    try:
+        import fakeredis
+    except ImportError:
+        return None
+    return {"connection_class": fakeredis.FakeConnection}
+
+
+REDIS_OPTIONS = _redis_cache_options()
+
+
+@unittest.skipIf(REDIS_OPTIONS is None, "neither redis nor fakeredis is installed")
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.redis.RedisCache",
+                                       "LOCATION": REDIS_TEST_URL,
+                                       "OPTIONS": REDIS_OPTIONS or {}}})
+class RedisCatalogueCacheTests(CatalogueCacheTests):
+    """The catalogue cache tests again on Redis, the cache shared by every web process"""
+
+    def test_versions_are_shared_between_processes(self):
+        from django.core.cache import caches
+        from django.core.cache.backends.redis import RedisCache
+
+        self.assertEqual(self._listing(), ["Pad"])
+        self.assertIsInstance(caches["default"], RedisCache)
+        # A second client, as another process would have, sees the bump
+        other = RedisCache(REDIS_TEST_URL, {"OPTIONS": REDIS_OPTIONS})
+        before = other.get(caching._version_key("catalogue"))
+        self.pad.name = "Gamepad"
+        self.pad.save()
+        self.assertNotEqual(other.get(caching._version_key("catalogue")), before)
+
+
+class ProductSearchTests(TestCase):
+    """Search uses the full-text index over all product text fields"""
+
+    def setUp(self):
+        cache.clear()
+        Product.objects.create(name="Mechanical Keyboard", price=Decimal("80.00"),
+                               stock=3, description="Clicky blue switches.")
+        Product.objects.create(name="Wrist Rest", price=Decimal("20.00"), stock=3,
+                               description="Pairs well with any mechanical keyboard.")
+        Product.objects.create(name="Gaming Mouse", price=Decimal("40.00"), stock=3,
+                               specifications="Sensor: 26000 DPI")
+
+    def _search(self, query, **extra):
+        resp = self.client.get(reverse("products"), {"search": query, **extra})
+        return [p.name for p in resp.context["products"]]
+
+    def test_matches_every_text_field_ranked_by_name_first(self):
+        self.assertEqual(self._search("keyboard"), ["Mechanical Keyboard", "Wrist Rest"])
+        self.assertEqual(self._search("dpi"), ["Gaming Mouse"])
+        self.assertEqual(self._search("keyboard", sort="highest-price"),
+                         ["Mechanical Keyboard", "Wrist Rest"])
+
+    def test_prefix_and_typo_tolerant_matching(self):
+        self.assertEqual(self._search("mech keyb"), ["Mechanical Keyboard", "Wrist Rest"])
+        resp = self.client.get(reverse("products"), {"search": "mosue"})
+        self.assertEqual([p.name for p in resp.context["products"]], ["Gaming Mouse"])
+        self.assertEqual(resp.context["suggestion"], "mouse")
+
+    def test_search_joins_the_index_once(self):
+        sql = str(search.search_products(Product.objects.all(), "keyboard").query)
+        self.assertEqual(sql.count("SELECT"), 1)
+        self.assertEqual(sql.count(f"{search.FTS_TABLE} MATCH"), 1)
+
+    def test_suggestions_compare_the_most_used_terms_of_a_close_length(self):
+        # As close to "mosue" as "mouse", but in fewer products
+        Product.objects.create(name="Moose Plush", price=Decimal("5.00"), stock=3)
+        Product.objects.create(name="Mouse Bungee", price=Decimal("5.00"), stock=3)
+        # Shorter than 3/5 or longer than 5/3 of the word can't be close enough
+        self.assertEqual(search._similar_lengths("mosue"), (3, 8))
+        original = search.SUGGEST_CANDIDATES
+        search.SUGGEST_CANDIDATES = 1
+        try:
+            self.assertEqual(search.suggest("mosue"), "mouse")
+        finally:
+            search.SUGGEST_CANDIDATES = original
+
+    def test_index_follows_updates_deletes_and_bulk_writes(self):
+        mouse = Product.objects.get(name="Gaming Mouse")
+        mouse.name = "Trackball"
+        mouse.save()
+        self.assertEqual(self._search("trackball"), ["Trackball"])
+        Product.objects.bulk_create([Product(name="Bulk Headset", price=Decimal("5.00"),
+                                             sale_price=Decimal("5.00"), stock=1)])
+        Product.objects.filter(name="Trackball").delete()
+        cache.clear()
+        self.assertEqual(self._search("headset"), ["Bulk Headset"])
+        self.assertEqual(self._search("trackball"), [])
+
+    def test_rebuild_recreates_missing_index(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DROP TABLE {search.FTS_TABLE}")
+        call_command("rebuild_search_index", stdout=StringIO())
+        self.assertEqual(self._search("clicky"), ["Mechanical Keyboard"])
+
+
+class ProductPaginationTests(TestCase):
+    """The listing is paged with keyset cursors and filtered with facets"""
+
+    def setUp(self):
+        cache.clear()
+        self.keyboards = ProductCategory.objects.create(name="Keyboards")
+        self.mice = ProductCategory.objects.create(name="Mice")
+        self.limited = ProductRange.objects.create(name="Limited Edition")
+        for i in range(7):
+            Product.objects.create(name=f"Board {i}", price=Decimal(10 + i % 3),
+                                   stock=3, category=self.keyboards,
+                                   range=self.limited if i < 2 else None)
+        for i in range(3):
+            Product.objects.create(name=f"Mouse {i}", price=Decimal("5.00"),
+                                   stock=3, category=self.mice)
+        Product.objects.create(name="Hidden", price=Decimal("1.00"), stock=3,
+                               display_item=False)
+
+    def _walk(self, sort, size=3):
+        params = listing.parse_params({"sort": sort})
+        names, pages = [], []
+        while True:
+            page = listing.build_listing(params, size=size)
+            pages.append(page)
+            names += [p.name for p in page["products"]]
+            if not page["next"]:
+                return names, pages
+            params["after"] = page["next"]
+
+    def test_pages_cover_every_sort_without_gaps_or_repeats(self):
+        for sort, key in (("alphabetical", lambda p: (p.name, p.id)),
+                          ("lowest-price", lambda p: (p.sale_price, p.id)),
+                          ("highest-price", lambda p: (-p.sale_price, -p.id))):
+            expected = [p.name for p in sorted(
+                Product.objects.filter(display_item=True), key=key)]
+            names, _ = self._walk(sort)
+            self.assertEqual(names, expected, sort)
+
+    def test_previous_cursor_returns_the_page_before(self):
+        _, pages = self._walk("highest-price")
+        params = listing.parse_params({"sort": "highest-price",
+                                       "before": pages[2]["previous"]})
+        page = listing.build_listing(params, size=3)
+        self.assertEqual(page["products"], pages[1]["products"])
+
+    def test_facet_counts_come_from_one_query(self):
+        with self.assertNumQueries(1):
+            facets = listing.facet_counts(Product.objects.filter(display_item=True),
+                                          category=self.keyboards.id)
+        self.assertEqual([(f["name"], f["count"]) for f in facets["categories"]],
+                         [("Keyboards", 7), ("Mice", 3)])
+        self.assertEqual([(f["name"], f["count"]) for f in facets["ranges"]],
+                         [("Limited Edition", 2)])
+        self.assertEqual(facets["total"], 7)
+
+    def test_listing_page_is_linkable_and_filtered(self):
+        resp = self.client.get(reverse("products"), {"category": self.mice.id})
+        self.assertEqual(resp.context["count"], 3)
+        self.assertEqual([p.name for p in resp.context["products"]],
+                         ["Mouse 0", "Mouse 1", "Mouse 2"])
+        self.assertNotContains(resp, "Hidden")
+
+    def test_query_count_is_independent_of_page_depth(self):
+        _, pages = self._walk("alphabetical")
+        counts = []
+        for cursor in ("", pages[-2]["next"]):
+            cache.clear()
+            with CaptureQueriesContext(connection) as ctx:
+                self.client.get(reverse("products"), {"after": cursor})
+            counts.append(len(ctx))
+        self.assertEqual(counts[0], counts[1])
+
+    def test_search_results_page_by_relevance(self):
+        params = listing.parse_params({"search": "board"})
+        self.assertEqual(params["sort"], "relevance")
+        names = []
+        while True:
+            page = listing.build_listing(params, size=2)
+            self.assertEqual(page["count"], 7)
+            names += [p.name for p in page["products"]]
+            if not page["next"]:
+                break
+            params["after"] = page["next"]
+        self.assertEqual(sorted(names), [f"Board {i}" for i in range(7)])
+
+    def test_post_is_not_allowed(self):
+        self.assertEqual(self.client.post(reverse("products")).status_code, 405)
+
+    def test_tampered_cursors_fall_back_to_the_first_page(self):
+        first = self.client.get(reverse("products"), {"sort": "lowest-price"})
+        product = Product.objects.first()
+        Review.objects.create(product=product, rating=5, title="Good")
+        for values in (["abc", 1], [None, "x"], [[1], {"a": 1}], [1]):
+            cursor = listing.encode_cursor(values)
+            for param in ("after", "before"):
+                with self.subTest(values=values, param=param):
+                    resp = self.client.get(reverse("products"),
+                                           {"sort": "lowest-price", param: cursor})
+                    self.assertEqual(list(resp.context["products"]),
+                                     list(first.context["products"]))
+                    resp = self.client.get(reverse("product", args=[product.id]),
+                                           {f"reviews_{param}": cursor})
+                    self.assertEqual([r.title for r in resp.context["reviews"]], ["Good"])
+        self.assertEqual(self.client.get(reverse("products"), {"after": "%%%"}).status_code, 200)
+
+
+class ApiTests(TestCase):
+    """The JSON API mirrors the HTML views and supports conditional GETs"""
+
+    def setUp(self):
+        cache.clear()
+        self.category = ProductCategory.objects.create(name="Pads")
+        self.pad = Product.objects.create(name="Pad", price=Decimal("20.00"), discount=True,
+                                          sale_price=Decimal("15.00"), stock=3,
+                                          category=self.category)
+        self.stick = Product.objects.create(name="Stick", price=Decimal("5.00"), stock=10)
+        Product.objects.create(name="Hidden", price=Decimal("1.00"), display_item=False)
+
+    def test_product_list_filters_and_selects_fields(self):
+        resp = self.client.get(reverse("api_products"),
+                               {"sort": "highest-price", "fields": "name,sale_price"})
+        self.assertEqual(resp.status_code, 200)
+        data = resp.json()
+        self.assertEqual(data["count"], 2)
+        self.assertEqual(data["results"], [{"name": "Pad", "sale_price": "15.00"},
+                                           {"name": "Stick", "sale_price": "5.00"}])
+
+        data = self.client.get(reverse("api_products"), {"category": self.category.id}).json()
+        self.assertEqual([p["name"] for p in data["results"]], ["Pad"])
+        self.assertEqual(data["results"][0]["category"], {"id": self.category.id, "name": "Pads"})
+
+        resp = self.client.get(reverse("api_products"), {"fields": "name,secret"})
+        self.assertEqual(resp.status_code, 400)
+        self.assertIn("secret", resp.json()["error"])
+
+    def test_product_list_reads_long_fields_in_one_query(self):
+        self.client.get(reverse("api_products"))
+        # The cached catalogue cards plus one query for both text fields
+        with self.assertNumQueries(1):
+            data = self.client.get(reverse("api_products"),
+                                   {"fields": "name,overview,description"}).json()
+        self.assertEqual(data["results"][0], {"name": "Pad",
+                                              "overview": "One of the finest product.",
+                                              "description": "No description"})
+
+    def test_conditional_get_returns_304_until_catalogue_changes(self):
+        url = reverse("api_product", args=[self.pad.id])
+        resp = self.client.get(url)
+        self.assertEqual(resp.json()["rating"]["count"], 0)
+        etag, modified = resp["ETag"], resp["Last-Modified"]
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=modified).status_code, 304)
+
+        Review.objects.create(product=self.pad, rating=4, title="Good")
+        resp = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json()["rating"]["count"], 1)
+
+        listing_etag = self.client.get(reverse("api_products"))["ETag"]
+        self.assertEqual(self.client.get(reverse("api_products"),
+                                         HTTP_IF_NONE_MATCH=listing_etag).status_code, 304)
+        self.stick.save()
+        self.assertEqual(self.client.get(reverse("api_products"),
+                                         HTTP_IF_NONE_MATCH=listing_etag).status_code, 200)
+
+    def test_reviews_are_paged_newest_first(self):
+        for i in range(3):
+            Review.objects.create(product=self.pad, rating=5, title=f"Review {i}")
+        data = self.client.get(reverse("api_reviews", args=[self.pad.id])).json()
+        self.assertEqual(data["summary"]["count"], 3)
+        self.assertEqual([r["title"] for r in data["results"]],
+                         ["Review 2", "Review 1", "Review 0"])
+        self.assertEqual(self.client.get(reverse("api_product", args=[999])).status_code, 404)
+
+    def test_tampered_review_cursor_falls_back_to_the_first_page(self):
+        Review.objects.create(product=self.pad, rating=5, title="Good")
+        for values in (["notadate", 1], [None, None], ["2026-01-01T00:00:00", "x"]):
+            resp = self.client.get(reverse("api_reviews", args=[self.pad.id]),
+                                   {"after": listing.encode_cursor(values)})
+            self.assertEqual(resp.status_code, 200, values)
+            self.assertEqual([r["title"] for r in resp.json()["results"]], ["Good"])
+
+    def test_cart_prices_match_the_html_cart(self):
+        resp = self.client.post(reverse("api_cart_items"),
+                                {"product_id": self.pad.id, "qty": 5},
+                                content_type="application/json")
+        self.assertEqual(resp.json()["added"], 3)
+        self.client.post(reverse("api_cart_items"), {"product_id": self.stick.id})
+
+        data = self.client.get(reverse("api_cart")).json()
+        html = self.client.get(reverse("cart"))
+        self.assertEqual(data["total"], str(html.context["total"]))
+        self.assertEqual(data["total"], "50.00")
+        self.assertEqual(data["count"], 4)
+
+        data = self.client.delete(reverse("api_cart_item", args=[self.stick.id])).json()
+        self.assertEqual(data["count"], 3)
+        self.assertEqual(self.client.delete(reverse("api_cart_item", args=[self.stick.id]))
+                         .status_code, 404)
+        self.assertEqual(self.client.delete(reverse("api_cart")).json()["items"], [])
+
+    def test_checkout(self):
+        self.client.post(reverse("api_cart_items"), {"product_id": self.pad.id, "qty": 2})
+        resp = self.client.post(reverse("api_checkout"), {**CheckoutTests.form, "card_cvc": ""},
+                                content_type="application/json")
+        self.assertEqual(resp.status_code, 400)
+
+        resp = self.client.post(reverse("api_checkout"), CheckoutTests.form,
+                                content_type="application/json")
+        self.assertEqual(resp.status_code, 201)
+        order = Order.objects.get(pk=resp.json()["order"])
+        self.assertEqual(order.get_total_cost(), Decimal("30.00"))
+        self.assertEqual(self.client.get(reverse("api_cart")).json()["count"], 0)
+
+        self.client.post(reverse("api_cart_items"), {"product_id": self.pad.id, "qty": 1})
+        Product.objects.filter(pk=self.pad.pk).update(stock=0)
+        resp = self.client.post(reverse("api_checkout"), CheckoutTests.form,
+                                content_type="application/json")
+        self.assertEqual(resp.status_code, 409)
+        self.assertEqual(resp.json()["products"], [self.pad.id])
+
+    def test_csrf_is_enforced(self):
+        client = Client(enforce_csrf_checks=True)
+        resp = client.post(reverse("api_cart_items"), {"product_id": self.pad.id})
+        self.assertEqual(resp.status_code, 403)
+        token = client.get(reverse("api_cart")).cookies["csrftoken"].value
+        resp = client.post(reverse("api_cart_items"), {"product_id": self.pad.id},
+                           HTTP_X_CSRFTOKEN=token)
+        self.assertEqual(resp.status_code, 200)
+
+
+class QueryPlanTests(TestCase):
+    """Every query behind the hot pages is answered from an index, never a table scan"""
+
+    def setUp(self):
+        if connection.vendor != "sqlite":
+            self.skipTest("Reads SQLite query plans")
+        cache.clear()
+        category = ProductCategory.objects.create(name="Keyboards")
+        products = [Product.objects.create(name=f"Board {i}", price=Decimal(10 + i % 4), stock=3,
+                                           category=category, display_item=i % 5 != 0)
+                    for i in range(30)]
+        self.product = products[1]
+        for i in range(10):
+            Review.objects.create(product=self.product, rating=i % 5 + 1, title=f"Review {i}")
+        self.user = User.objects.create_user("planner", password="pw-12345!")
+        for _ in range(3):
+            order = Order.objects.create(user=self.user, address="1 Street")
+            OrderItem.objects.create(order=order, product=self.product, unit_price=Decimal("10.00"))
+        ContactMessage.objects.create(name="A", email="a@example.com", subject="Hi", message="Hi")
+        self.client.force_login(self.user)
+
+    def _plans(self, url, params=None):
+        cache.clear()
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(self.client.get(url, params).status_code, 200)
+        with connection.cursor() as cursor:
+            for query in ctx.captured_queries:
+                if query["sql"].startswith("SELECT"):
+                    cursor.execute("EXPLAIN QUERY PLAN " + query["sql"])
+                    yield query["sql"], "\n".join(row[3] for row in cursor.fetchall())
+
+    def assertIndexed(self, url, params=None, sorted_by_index=True):
+        for sql, plan in self._plans(url, params):
+            message = f"{url} {params or ''}\n{sql}\n{plan}"
+            self.assertNotRegex(plan, re.compile(r"^SCAN storefront_\w+$", re.M), message)
+            if sorted_by_index and "LIMIT" in sql:
+                self.assertNotRegex(plan, r"TEMP B-TREE FOR .*ORDER BY", message)
+
+    def test_listing_sorts_and_filters(self):
+        for sort in listing.SORTS:
+            if sort != "relevance":
+                self.assertIndexed(reverse("products"), {"sort": sort})
+                self.assertIndexed(reverse("api_products"), {"sort": sort})
+        self.assertIndexed(reverse("products"), {"category": ProductCategory.objects.get().id})
+        self.assertIndexed(reverse("products"), {"search": "board"}, sorted_by_index=False)
+
+    def test_product_reviews_account_pages(self):
+        self.assertIndexed(reverse("product", args=[self.product.id]))
+        self.assertIndexed(reverse("api_reviews", args=[self.product.id]))
+        self.assertIndexed(reverse("account"))
+        User.objects.filter(pk=self.user.pk).update(is_staff=True)
+        self.assertIndexed(reverse("account"))
+        self.assertIndexed(reverse("account"), {"filter": "unread"})
+
+    def test_order_exports_read_date_ranges_from_an_index(self):
+        today = timezone.localdate()
+        for status, index in ((None, "order_date_idx"), ("Processing", "order_status_date_idx")):
+            plan = exports.orders(today, today, status).explain()
+            self.assertIn(f"USING INDEX {index}", plan)
+            self.assertNotIn("TEMP B-TREE", plan)
+
+    def test_rating_summary_uses_covering_index(self):
+        plan = Review.objects.all().summaries_by_product().explain()
+        self.assertIn("COVERING INDEX review_product_rating_idx", plan)
+
+    def test_reviews_outside_one_to_five_are_rejected(self):
+        from django.db import IntegrityError
+        with self.assertRaises(IntegrityError):
+            Review.objects.bulk_create([Review(product=self.product, rating=6, title="Six")])
+
+
+class QueryBudgetTests(TestCase):
+    """
+        Every storefront URL stays within its query budget, and issues the
+        same queries for a catalogue of 10 products with no reviews as for
+        1000 products with 500 reviews, so nothing runs a query per row.
+    """
+
+    # URL name -> most queries one request may issue, with a cold cache
+    BUDGETS = {
+        "home": 3,
+        "products": 5,
+        "product": 7,
+        "add_review": 10,
+        "about": 3,
+        "contact": 4,
+        "account": 5,
+        "cart": 5,
+        "add_to_cart": 6,
+        "remove_from_cart": 5,
+        "clear_cart": 5,
+        "checkout": 15,
+        "checkoutsuccess": 4,
+        "api_products": 2,
+        "api_product": 1,
+        "api_reviews": 2,
+        "api_cart": 4,
+        "api_cart_items": 7,
+        "api_cart_item": 6,
+        "api_checkout": 15,
+        "signup": 3,
+        "_routes": 0,
+        "mark_message_read": 3,
+        "mark_message_unread": 3,
+        "delete_message": 3,
+        "bulk_update_messages": 3,
+        "export_orders": 4,
+        "sales_dashboard": 10,
+    }
+
+    def setUp(self):
+        self.category = ProductCategory.objects.create(name="Pads")
+        self.products = self._add_products(10)
+        self.product = self.products[0]
+        # bulk_create skips the signal that makes a Customer profile, which
+        # can only be made once with a blank phone number
+        self.staff, self.buyer = User.objects.bulk_create([
+            User(username="budget", is_staff=True),
+            User(username="jane@example.com", first_name="Jane", last_name="Doe",
+                 email="jane@example.com")])
+        self.order = Order.objects.create(user=self.staff, address="1 Street")
+        OrderItem.objects.create(order=self.order, product=self.product, unit_price=Decimal("10.00"))
+        self.client.force_login(self.staff)
+
+    def _add_products(self, count):
+        start = Product.objects.count()
+        return Product.objects.bulk_create([
+            Product(name=f"Pad {start + i:04}", price=Decimal("10.00"), sale_price=Decimal("10.00"),
+                    stock=10**6, category=self.category)
+            for i in range(count)])
+
+    def _grow(self):
+        self._add_products(990)
+        Review.objects.bulk_create([
+            Review(product=self.product, user=self.staff, rating=i % 5 + 1, title=f"Review {i}")
+            for i in range(500)])
+        ContactMessage.objects.bulk_create([
+            ContactMessage(name="A", email="a@example.com", subject=f"Hi {i}", message="Hello there")
+            for i in range(500)])
+        OrderItem.objects.bulk_create([
+            OrderItem(order=self.order, product=p, unit_price=Decimal("10.00"))
+            for p in Product.objects.all()[:200]])
+
+    def _reset(self):
+        """Puts back what the previous request changed: cart, message and cache."""
+        cart, _ = Cart.objects.get_or_create(user=self.staff)
+        cart.items.all().delete()
+        CartItem.objects.bulk_create([CartItem(cart=cart, product=p, quantity=1)
+                                      for p in self.products[:3]])
+        self.message, _ = ContactMessage.objects.get_or_create(
+            pk=1, defaults={"name": "B", "email": "b@example.com", "subject": "Budget",
+                            "message": "Hello there"})
+        cache.clear()
+
+    def _requests(self):
+        product, message = self.product.pk, self.message.pk
+        review = {"title": "Great", "rating": 5, "body": "Comfortable and very responsive."}
+        contact = {"name": "Ann", "email": "ann@example.com", "subject": "Hello",
+                   "message": "A question about shipping."}
+        return {
+            "home": ("get", reverse("home"), {}),
+            "products": ("get", reverse("products"), {"sort": "top-rated"}),
+            "product": ("get", reverse("product", args=[product]), {}),
+            "add_review": ("post", reverse("add_review", args=[product]), review),
+            "about": ("get", reverse("about"), {}),
+            "contact": ("post", reverse("contact"), contact),
+            "account": ("get", reverse("account"), {}),
+            "cart": ("get", reverse("cart"), {}),
+            "add_to_cart": ("post", reverse("add_to_cart", args=[product]), {"qty": 1}),
+            "remove_from_cart": ("post", reverse("remove_from_cart", args=[product]), {}),
+            "clear_cart": ("post", reverse("clear_cart"), {}),
+            "checkout": ("post", reverse("checkout"), CheckoutTests.form),
+            "checkoutsuccess": ("get", reverse("checkoutsuccess", args=[self.order.pk]), {}),
+            "api_products": ("get", reverse("api_products"), {"sort": "top-rated"}),
+            "api_product": ("get", reverse("api_product", args=[product]), {}),
+            "api_reviews": ("get", reverse("api_reviews", args=[product]), {}),
+            "api_cart": ("get", reverse("api_cart"), {}),
+            "api_cart_items": ("post", reverse("api_cart_items"), {"product_id": product}),
+            "api_cart_item": ("delete", reverse("api_cart_item", args=[product]), None),
+            "api_checkout": ("post", reverse("api_checkout"), CheckoutTests.form),
+            "signup": ("get", reverse("signup"), {}),
+            "_routes": ("get", reverse("_routes"), {}),
+            "mark_message_read": ("post", reverse("mark_message_read", args=[message]), {}),
+            "mark_message_unread": ("post", reverse("mark_message_unread", args=[message]), {}),
+            "delete_message": ("post", reverse("delete_message", args=[message]), {}),
+            "bulk_update_messages": ("post", reverse("bulk_update_messages"),
+                                     {"ids": [message], "action": "read"}),
+            "export_orders": ("get", reverse("export_orders"), {}),
+            "sales_dashboard": ("get", reverse("sales_dashboard"), {}),
+        }
+
+    def _measure(self) -> dict:
+        queries = {}
+        for name in self.BUDGETS:
+            self._reset()
+            method, url, data = self._requests()[name]
+            with CaptureQueriesContext(connection) as ctx:
+                response = getattr(self.client, method)(url, data)
+                if response.streaming:
+                    b"".join(response.streaming_content)
+            self.assertLess(response.status_code, 400, name)
+            queries[name] = [q["sql"] for q in ctx.captured_queries]
+        return queries
+
+    @staticmethod
+    def _explain(queries, budget=None) -> str:
+        lines = [f"{len(queries)} queries" + (f", budget {budget}:" if budget is not None else ":")]
+        return "\n".join(lines + [f"{i:>3}. {sql}" for i, sql in enumerate(queries, 1)])
+
+    @staticmethod
+    def _diff(small, large) -> str:
+        # Literals differ between the runs, compare the statements' shapes
+        shape = [re.sub(r"\b\d+\b", "N", sql) for sql in small]
+        grown = [re.sub(r"\b\d+\b", "N", sql) for sql in large]
+        return "\n".join(difflib.unified_diff(shape, grown, "10 products, 0 reviews",
+                                              "1000 products, 500 reviews", lineterm=""))
+
+    def test_every_url_has_a_budget(self):
+        from .urls import urlpatterns
+        names = {p.name for p in urlpatterns if getattr(p, "name", None)}
+        self.assertEqual(names, set(self.BUDGETS))
+
+    def test_budgets_hold_as_the_catalogue_grows(self):
+        small = self._measure()
+        self._grow()
+        large = self._measure()
+        for name, budget in self.BUDGETS.items():
+            with self.subTest(name):
+                self.assertLessEqual(len(small[name]), budget, self._explain(small[name], budget))
+                self.assertLessEqual(len(large[name]), budget, self._explain(large[name], budget))
+                self.assertEqual(len(large[name]), len(small[name]),
+                                 self._diff(small[name], large[name]))
+
+
+class ProductImageTests(TestCase):
+    """Uploads get resized AVIF/WebP variants that the templates offer via srcset"""
+
+    def setUp(self):
+        cache.clear()
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=media.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def _upload(self, name="pad.png", size=(1200, 800), mode="RGB"):
+        buffer = BytesIO()
+        Image.new(mode, size, "red").save(buffer, format="PNG")
+        return SimpleUploadedFile(name, buffer.getvalue(), content_type="image/png")
+
+    def _save(self, product):
+        # Variants are generated once the save commits
+        with self.captureOnCommitCallbacks(execute=True):
+            product.save()
+        return product
+
+    def test_upload_generates_variants(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            product = Product.objects.create(name="Pad", image=self._upload())
+            # Nothing is encoded inside the saving transaction
+            self.assertEqual(Product.objects.get(pk=product.pk).image_variants, {})
+        variants = Product.objects.get(pk=product.pk).image_variants
+        self.assertEqual(variants["source"], product.image.name)
+        self.assertEqual((variants["width"], variants["height"]), (1200, 800))
+        self.assertEqual(set(variants["formats"]), {"avif", "webp", "jpeg"})
+        self.assertEqual([w for w, _ in variants["formats"]["webp"]], list(images.WIDTHS))
+        for _, name in variants["formats"]["webp"]:
+            self.assertTrue(default_storage.exists(name))
+        with default_storage.open(variants["formats"]["avif"][0][1]) as f:
+            self.assertEqual(Image.open(f).size, (175, 117))
+
+    def test_small_and_transparent_images(self):
+        product = self._save(Product(name="Icon", image=self._upload(size=(300, 300), mode="RGBA")))
+        formats = product.image_variants["formats"]
+        self.assertIn("png", formats)
+        self.assertEqual([w for w, _ in formats["png"]], [175, 300])
+
+    def test_replacing_image_deletes_old_variants(self):
+        product = self._save(Product(name="Pad", image=self._upload()))
+        old = [name for _, name in product.image_variants["formats"]["webp"]]
+        product.image = self._upload("stick.png")
+        self._save(product)
+        self.assertFalse(any(default_storage.exists(name) for name in old))
+        self.assertEqual(product.image_variants["source"], product.image.name)
+        product.image = None
+        self._save(product)
+        self.assertEqual(Product.objects.get(pk=product.pk).image_variants, {})
+
+    def test_listing_renders_srcset(self):
+        self._save(Product(name="Pad", image=self._upload()))
+        resp = self.client.get(reverse("products"))
+        self.assertContains(resp, '<source type="image/avif" srcset="')
+        self.assertContains(resp, '175w')
+        self.assertContains(resp, 'height="117"')
+        self.assertNotContains(resp, 'src="/media/uploads/products/pad.png"')
+
+    def test_backfill_command(self):
+        product = Product.objects.create(name="Pad", image=self._upload())
+        self.assertEqual(Product.objects.get(pk=product.pk).image_variants, {})
+        out = StringIO()
+        call_command("generate_image_variants", workers=1, stdout=out)
+        self.assertIn("Generated image variants for 1 products", out.getvalue())
+        self.assertTrue(images.is_current(Product.objects.get(pk=product.pk)))
+
+
+class AssetServingTests(TestCase):
+    """Production asset mode: hashed precompressed static files, media with ETags and ranges"""
+
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        os.makedirs(os.path.join(media_root.name, "uploads"))
+        with open(os.path.join(media_root.name, "uploads", "pad.png"), "wb") as f:
+            f.write(b"0123456789")
+        settings_override = override_settings(MEDIA_ROOT=media_root.name,
+                                              ASSET_MODE="whitenoise")
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.factory = RequestFactory()
+
+    def _get(self, path="uploads/pad.png", **headers):
+        return media.serve(self.factory.get(f"/media/{path}", **headers), path)
+
+    def test_media_has_validators_and_revalidates(self):
+        resp = self._get()
+        self.assertEqual(b"".join(resp.streaming_content), b"0123456789")
+        self.assertEqual(resp["Content-Type"], "image/png")
+        self.assertIn("max-age=", resp["Cache-Control"])
+        self.assertEqual(self._get(HTTP_IF_NONE_MATCH=resp["ETag"]).status_code, 304)
+        self.assertEqual(self._get(HTTP_IF_MODIFIED_SINCE=resp["Last-Modified"]).status_code, 304)
+
+    def test_media_range_requests(self):
+        resp = self._get(HTTP_RANGE="bytes=2-5")
+        self.assertEqual(resp.status_code, 206)
+        self.assertEqual(resp["Content-Range"], "bytes 2-5/10")
+        self.assertEqual(b"".join(resp.streaming_content), b"2345")
+        self.assertEqual(b"".join(self._get(HTTP_RANGE="bytes=-3").streaming_content), b"789")
+        self.assertEqual(self._get(HTTP_RANGE="bytes=20-").status_code, 416)
+        # An invalid range is ignored, the whole file is sent
+        resp = self._get(HTTP_RANGE="bytes=5-3")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(b"".join(resp.streaming_content), b"0123456789")
+        # A stale If-Range gets the whole file
+        self.assertEqual(self._get(HTTP_RANGE="bytes=2-5", HTTP_IF_RANGE='"old"').status_code, 200)
+
+    def test_media_path_traversal_and_missing_files(self):
+        from django.http import Http404
+        for path in ("../settings.py", "uploads/missing.png", "uploads"):
+            with self.assertRaises(Http404):
+                self._get(path)
+
+    def test_sendfile_handoff(self):
+        with override_settings(ASSET_MODE="sendfile", SENDFILE_HEADER="X-Accel-Redirect",
+                               SENDFILE_PREFIX="/internal-media/"):
+            resp = self._get()
+            self.assertEqual(resp["X-Accel-Redirect"], "/internal-media/uploads/pad.png")
+            self.assertEqual(resp.content, b"")
+        with override_settings(ASSET_MODE="sendfile", SENDFILE_HEADER="X-Sendfile"):
+            self.assertTrue(self._get()["X-Sendfile"].endswith(os.path.join("uploads", "pad.png")))
+
+    def test_collectstatic_hashes_and_compresses(self):
+        static_root = tempfile.TemporaryDirectory()
+        self.addCleanup(static_root.cleanup)
+        storages = {**settings.STORAGES, "staticfiles": {
+            "BACKEND": "whitenoise.storage.CompressedManifestStaticFilesStorage"}}
+        with override_settings(STATIC_ROOT=static_root.name, STORAGES=storages):
+            call_command("collectstatic", interactive=False, verbosity=0)
+        names = os.listdir(os.path.join(static_root.name, "css"))
+        hashed = [n for n in names if n.startswith("styles.") and n.endswith(".css")
+                  and n != "styles.css"]
+        self.assertEqual(len(hashed), 1)
+        self.assertIn(hashed[0] + ".gz", names)
+        self.assertIn(hashed[0] + ".br", names)
+
+
+class FlakyEmailBackend(BaseEmailBackend):
+    """Fails the first `failures` sends"""
+
+    def __init__(self, failures=1, **kwargs):
+        super().__init__(**kwargs)
+        self.failures = failures
+        self.sent = []
+        self.opened = 0
+
+    def open(self):
+        self.opened += 1
+
+    def send_messages(self, messages):
+        if self.failures:
+            self.failures -= 1
+            raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+        self.sent += messages
+        return len(messages)
+
+
+class OutboxTests(TestCase):
+    """Emails are queued with the change they report and sent by a worker"""
+
+    contact = {"name": "Sam", "email": "sam@example.com", "subject": "Hello", "message": "Hi there, a question"}
+
+    def test_contact_form_queues_instead_of_sending(self):
+        resp = self.client.post(reverse("contact"), self.contact)
+        self.assertRedirects(resp, reverse("contact"))
+        self.assertEqual(len(mail.outbox), 0)
+        email = OutboundEmail.objects.get()
+        self.assertEqual(email.to, [settings.ADMIN_EMAIL])
+        self.assertEqual(ContactMessage.objects.count(), 1)
+
+        self.assertEqual(outbox.drain(), (1, 0))
+        self.assertEqual(mail.outbox[0].subject, "New Contact Form: Hello")
+        self.assertEqual(OutboundEmail.objects.get().status, OutboundEmail.SENT)
+        self.assertEqual(outbox.drain(), (0, 0))
+
+    def test_checkout_queues_order_confirmation(self):
+        product = Product.objects.create(name="Pad", price=Decimal("12.50"), stock=2)
+        seed_cart(self.client, [(product, 2)])
+        self.client.post(reverse("checkout"), CheckoutTests.form)
+        email = OutboundEmail.objects.get()
+        self.assertEqual(email.to, ["jane@example.com"])
+        self.assertIn("2 x Pad @ $12.50", email.body)
+        self.assertIn("Total: $25.00", email.body)
+
+        # A checkout that rolls back queues nothing
+        seed_cart(self.client, [(product, 1)])
+        self.client.post(reverse("checkout"), CheckoutTests.form)
+        self.assertEqual(OutboundEmail.objects.count(), 1)
+
+    def test_failures_back_off_then_give_up(self):
+        outbox.enqueue("Hi", "Body", ["a@example.com"])
+        backend = FlakyEmailBackend(failures=outbox.MAX_ATTEMPTS)
+        self.assertEqual(outbox.drain(connection=backend), (0, 1))
+        email = OutboundEmail.objects.get()
+        self.assertEqual((email.status, email.attempts), (OutboundEmail.PENDING, 1))
+        self.assertGreater(email.next_attempt_at, timezone.now() + outbox.BACKOFF_BASE * 0.7)
+        self.assertIn("SMTPServerDisconnected", email.last_error)
+        # Not due yet
+        self.assertEqual(outbox.drain(connection=backend), (0, 0))
+
+        for _ in range(outbox.MAX_ATTEMPTS - 1):
+            OutboundEmail.objects.update(next_attempt_at=timezone.now())
+            outbox.drain(connection=backend)
+        email.refresh_from_db()
+        self.assertEqual((email.status, email.attempts), (OutboundEmail.FAILED, outbox.MAX_ATTEMPTS))
+
+    def test_batches_share_one_connection(self):
+        for i in range(5):
+            outbox.enqueue(f"Email {i}", "Body", ["a@example.com"])
+        backend = FlakyEmailBackend(failures=1)
+        self.assertEqual(outbox.drain(batch_size=2, connection=backend), (4, 1))
+        self.assertEqual(len(backend.sent), 4)
+        self.assertEqual(outbox.drain(connection=backend), (0, 0))
+        self.assertEqual(outbox.claim_batch(), [])
+
+    def test_empty_queue_does_not_connect(self):
+        backend = FlakyEmailBackend(failures=0)
+        self.assertEqual(outbox.drain(connection=backend), (0, 0))
+        self.assertEqual(backend.opened, 0)
+        outbox.enqueue("Hi", "Body", ["a@example.com"])
+        self.assertEqual(outbox.drain(connection=backend), (1, 0))
+        self.assertEqual(backend.opened, 1)
+
+    def test_send_outbox_command(self):
+        outbox.enqueue("Hi", "Body", ["a@example.com"])
+        out = StringIO()
+        call_command("send_outbox", stdout=out)
+        self.assertIn("Sent 1 emails, 0 failed.", out.getvalue())
+        self.assertEqual(len(mail.outbox), 1)
+
+
+class InboxTests(TestCase):
+    """The staff inbox is paged, counted in one query and updated in bulk"""
+
+    def setUp(self):
+        self.staff = User.objects.create_user("staff", password="pw-12345!", is_staff=True)
+        self.client.force_login(self.staff)
+        ContactMessage.objects.bulk_create([
+            ContactMessage(name=f"Sender {i}", email="s@example.com",
+                           subject=f"Subject {i}", message="Hello there", is_read=i % 3 == 0)
+            for i in range(45)])
+
+    def test_customers_never_load_the_inbox(self):
+        # bulk_create skips the signal that makes a Customer profile
+        User.objects.bulk_create([User(username="shopper")])
+        self.client.force_login(User.objects.get(username="shopper"))
+        with CaptureQueriesContext(connection) as ctx:
+            resp = self.client.get(reverse("account"))
+        self.assertNotContains(resp, "Subject 1")
+        self.assertFalse([q for q in ctx.captured_queries if "storefront_contactmessage" in q["sql"]])
+
+    def test_pages_and_counts(self):
+        with CaptureQueriesContext(connection) as ctx:
+            resp = self.client.get(reverse("account"))
+        self.assertEqual(len(resp.context["contact_messages"]), views.INBOX_PAGE_SIZE)
+        self.assertEqual((resp.context["total_messages"], resp.context["unread_messages"]), (45, 30))
+        self.assertEqual(len([q for q in ctx.captured_queries
+                              if "storefront_contactmessage" in q["sql"]]), 2)
+
+        seen, url = [], reverse("account")
+        while url:
+            resp = self.client.get(url)
+            seen += [m.pk for m in resp.context["contact_messages"]]
+            url = resp.context["next_url"]
+        self.assertEqual(seen, list(ContactMessage.objects.order_by("-created_at", "-id")
+                                    .values_list("pk", flat=True)))
+
+        resp = self.client.get(reverse("account"), {"filter": "unread"})
+        self.assertTrue(all(not m.is_read for m in resp.context["contact_messages"]))
+        self.assertIn("filter=unread", resp.context["next_url"])
+
+    def test_tampered_cursor_falls_back_to_the_first_page(self):
+        first = self.client.get(reverse("account")).context["contact_messages"]
+        for values in (["notadate", 1], [None, 1], ["2026-01-01", "x"]):
+            resp = self.client.get(reverse("account"), {"before": listing.encode_cursor(values)})
+            self.assertEqual(list(resp.context["contact_messages"]), list(first), values)
+
+    def test_single_message_actions(self):
+        msg = ContactMessage.objects.filter(is_read=False).first()
+        resp = self.client.post(reverse("mark_message_read", args=[msg.pk]),
+                                {"next": reverse("account") + "?filter=unread"})
+        self.assertRedirects(resp, reverse("account") + "?filter=unread")
+        msg.refresh_from_db()
+        self.assertTrue(msg.is_read)
+        self.client.post(reverse("mark_message_unread", args=[msg.pk]))
+        msg.refresh_from_db()
+        self.assertFalse(msg.is_read)
+        resp = self.client.post(reverse("delete_message", args=[msg.pk]),
+                                {"next": "https://evil.example.com/"})
+        self.assertRedirects(resp, reverse("account"))
+        self.assertFalse(ContactMessage.objects.filter(pk=msg.pk).exists())
+
+    def test_bulk_actions_are_single_statements(self):
+        ids = list(ContactMessage.objects.filter(is_read=False).values_list("pk", flat=True)[:10])
+        for action in ("read", "delete"):
+            with CaptureQueriesContext(connection) as ctx:
+                self.client.post(reverse("bulk_update_messages"), {"ids": ids, "action": action})
+            self.assertEqual(len([q for q in ctx.captured_queries
+                                  if "storefront_contactmessage" in q["sql"]]), 1, action)
+            if action == "read":
+                self.assertFalse(ContactMessage.objects.filter(pk__in=ids, is_read=False).exists())
+        self.assertEqual(ContactMessage.objects.count(), 35)
+
+    def test_customers_cannot_change_messages(self):
+        User.objects.bulk_create([User(username="shopper")])
+        self.client.force_login(User.objects.get(username="shopper"))
+        msg = ContactMessage.objects.first()
+        resp = self.client.post(reverse("delete_message", args=[msg.pk]))
+        self.assertEqual(resp.status_code, 302)
+        self.client.post(reverse("bulk_update_messages"),
+                         {"ids": [msg.pk], "action": "delete"})
+        self.assertEqual(ContactMessage.objects.count(), 45)
+
+
+class LoadTestTests(TestCase):
+    """The load test seeds a consistent catalogue and replays the shopper flows"""
+
+    def setUp(self):
+        cache.clear()
+        self.counts = loadtest.seed(products=40, reviews=200, users=3, orders=10,
+                                    rng=random.Random(1), batch_size=50)
+
+    def test_seed_is_consistent_and_clearable(self):
+        self.assertEqual(self.counts, {"products": 40, "users": 3, "reviews": 200, "orders": 10})
+        out = StringIO()
+        call_command("recompute_ratings", dry_run=True, stdout=out)
+        self.assertIn("Found 0 products", out.getvalue())
+        self.assertTrue(User.objects.get(username="loadtest-0").check_password(loadtest.PASSWORD))
+
+        loadtest.clear()
+        self.assertFalse(Product.objects.exists())
+        self.assertFalse(Review.objects.exists())
+        self.assertFalse(Order.objects.exists())
+
+    def test_shopper_flows_succeed_and_count_queries(self):
+        client = loadtest.InProcessClient()
+        self.assertTrue(client.login("loadtest-0", loadtest.PASSWORD))
+        user = User.objects.filter(username="loadtest-0").values(
+            "first_name", "last_name", "email").get()
+        catalogue = list(Product.objects.filter(display_item=True, stock__gt=0)
+                         .values_list("pk", flat=True))
+        shopper = loadtest.Shopper(client, random.Random(2), catalogue, [], user)
+        with self.settings(ALLOWED_HOSTS=["testserver"]):
+            samples = [shopper.step() for _ in range(60)]
+
+        summary = loadtest.summarise({"samples": samples})
+        self.assertEqual(set(summary), set(loadtest.MIX))
+        for name, flow in summary.items():
+            self.assertEqual(flow["errors"], 0, name)
+            self.assertGreater(flow["queries"], 0, name)
+            self.assertLessEqual(flow["p50"], flow["p95"])
+        self.assertTrue(Order.objects.filter(user__username="loadtest-0").exists())
+        self.assertEqual(loadtest.percentile([1, 2, 3, 4], 50), 2)
+        # Nothing is left for the outbox worker to send to the shoppers
+        self.assertTrue(OutboundEmail.objects.exists())
+        loadtest.clear()
+        self.assertFalse(OutboundEmail.objects.exists())
+
+
+class CatalogueFeedTests(TestCase):
+    """Supplier feeds update the catalogue in bulk and round trip through exports"""
+
+    def setUp(self):
+        cache.clear()
+        self.pads = ProductCategory.objects.create(name="Pads")
+        self.pad = Product.objects.create(name="Pad", sku="PAD-1", price=Decimal("20.00"),
+                                          stock=5, category=self.pads)
+        self.stick = Product.objects.create(name="Stick", price=Decimal("5.00"), stock=10)
+
+    def test_import_updates_creates_and_reports_invalid_rows(self):
+        feed = ("sku,id,name,price,stock,category\n"
+                "PAD-1,,,24.50,0,Pads\n"
+                f"STICK-1,{self.stick.id},,,10,\n"
+                "MAT-1,,Mat,12,3,Mats\n"
+                "MAT-2,,Broken,abc,3,Mats\n"
+                ",999,,1,1,\n")
+        self.assertEqual(self.client.get(reverse("products")).context["count"], 2)
+        report = feeds.import_feed(StringIO(feed), "csv", chunk_size=2)
+
+        self.assertEqual((report["created"], report["updated"], report["invalid"]), (1, 2, 2))
+        self.assertEqual(report["new_categories"], 1)
+        self.assertEqual([line for line, _ in report["errors"]], [5, 6])
+        self.assertIn("price", report["errors"][0][1])
+        self.pad.refresh_from_db()
+        # Unlisted columns are kept, derived fields follow the new values
+        self.assertEqual((self.pad.name, self.pad.price, self.pad.sale_price),
+                         ("Pad", Decimal("24.50"), Decimal("24.50")))
+        self.assertEqual(self.pad.tagline, "Out of Stock")
+        self.assertEqual(Product.objects.get(pk=self.stick.pk).sku, "STICK-1")
+        mat = Product.objects.get(sku="MAT-1")
+        self.assertEqual((mat.category.name, mat.sale_price), ("Mats", Decimal("12.00")))
+        self.assertEqual(self.client.get(reverse("products")).context["count"], 3)
+
+    def test_dry_run_writes_nothing(self):
+        feed = '{"sku": "PAD-1", "price": "30.00"}\n{"sku": "NEW", "name": "New", "price": 1}\n'
+        with CaptureQueriesContext(connection) as ctx:
+            report = feeds.import_feed(StringIO(feed), "jsonl", dry_run=True)
+        self.assertEqual((report["created"], report["updated"]), (1, 1))
+        self.assertEqual(report["fields"], {"price": 1, "sale_price": 1})
+        self.assertTrue(all(q["sql"].startswith("SELECT") for q in ctx.captured_queries))
+        self.assertEqual(Product.objects.count(), 2)
+
+    def test_export_imports_back_unchanged(self):
+        for fmt, name in (("csv", "catalogue.csv"), ("jsonl", "catalogue.jsonl")):
+            with tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, name)
+                call_command("export_catalogue", path, stdout=StringIO())
+                with CaptureQueriesContext(connection) as ctx:
+                    out = StringIO()
+                    call_command("import_catalogue", path, stdout=out)
+            self.assertIn("0 products created, 0 updated and 2 unchanged", out.getvalue())
+            self.assertTrue(all(q["sql"].startswith("SELECT") for q in ctx.captured_queries))
+
+    def test_bad_json_lines_rows_are_reported_not_fatal(self):
+        self.assertEqual(self.client.get(reverse("products")).context["count"], 2)
+        feed = ('{"sku": "PAD-1", "stock": 0}\n'
+                '{"name": "No key", "price": 1}\n'
+                '{"sku": "PAD-1", "colour": "red"}\n'
+                '{"id": %d, "stock": 1}\n' % self.stick.id)
+        report = feeds.import_feed(StringIO(feed), "jsonl", chunk_size=1)
+        self.assertEqual((report["updated"], report["invalid"]), (2, 2))
+        self.assertEqual(report["errors"], [(2, "A feed needs an id or sku column"),
+                                            (3, "Unknown columns: colour")])
+        self.assertEqual(Product.objects.get(pk=self.stick.pk).stock, 1)
+        # The cached listing no longer shows the sold out pad as in stock
+        pad = next(p for p in self.client.get(reverse("products")).context["products"]
+                   if p.pk == self.pad.pk)
+        self.assertEqual(pad.stock, 0)
+
+    def test_cache_is_invalidated_when_a_feed_stops_part_way(self):
+        self.client.get(reverse("products"))
+        feed = '{"sku": "PAD-1", "stock": 0}\n{"sku": "PAD-1", "stock": 2}\n'
+        chunk = feeds._Import.chunk
+        calls = []
+
+        def fail_second(job, rows):
+            calls.append(rows)
+            if len(calls) > 1:
+                raise RuntimeError("database went away")
+            chunk(job, rows)
+
+        feeds._Import.chunk = fail_second
+        try:
+            with self.assertRaises(RuntimeError):
+                feeds.import_feed(StringIO(feed), "jsonl", chunk_size=1)
+        finally:
+            feeds._Import.chunk = chunk
+        pad = next(p for p in self.client.get(reverse("products")).context["products"]
+                   if p.pk == self.pad.pk)
+        self.assertEqual(pad.stock, 0)
+
+    def test_rows_moving_a_sku_to_another_product_are_reported(self):
+        self.stick.sku = "STICK-1"
+        self.stick.save()
+        feed = ("id,sku,stock\n"
+                # Swapping the two skus
+                f"{self.pad.id},STICK-1,1\n"
+                f"{self.stick.id},PAD-1,1\n"
+                # A new sku, then the same sku for a new product
+                f"{self.stick.id},STICK-2,2\n"
+                ",STICK-2,3\n")
+        report = feeds.import_feed(StringIO(feed), "csv")
+        self.assertEqual([line for line, _ in report["errors"]], [2, 3])
+        self.assertIn("STICK-1 belongs to another product", report["errors"][0][1])
+        self.assertEqual(list(Product.objects.order_by("pk").values_list("sku", "stock")),
+                         [("PAD-1", 5), ("STICK-2", 3)])
+
+    def test_new_categories_roll_back_with_their_chunk(self):
+        feed = "sku,category\nPAD-1,Mats\n"
+        manager = Product.objects
+
+        def fail(*args, **kwargs):
+            raise DatabaseError("disk I/O error")
+
+        manager.bulk_update = fail
+        try:
+            with self.assertRaises(DatabaseError):
+                feeds.import_feed(StringIO(feed), "csv")
+        finally:
+            del manager.bulk_update
+        self.assertFalse(ProductCategory.objects.filter(name="Mats").exists())
+        feeds.import_feed(StringIO(feed), "csv")
+        self.assertEqual(Product.objects.get(pk=self.pad.pk).category.name, "Mats")
+
+    def test_unknown_columns_are_rejected(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".csv") as feed:
+            feed.write("sku,colour\nPAD-1,red\n")
+            feed.flush()
+            with self.assertRaisesMessage(CommandError, "Unknown columns: colour"):
+                call_command("import_catalogue", feed.name, stdout=StringIO())
+
+
+class OrderExportTests(TestCase):
+    """Orders stream out with their items and payments for finance"""
+
+    def setUp(self):
+        self.staff, self.buyer = User.objects.bulk_create([
+            User(username="finance", is_staff=True),
+            User(username="jane", email="jane@example.com")])
+        pad = Product.objects.create(name="Pad", sku="PAD-1", price=Decimal("20.00"), stock=9)
+        stick = Product.objects.create(name="Stick", price=Decimal("5.00"), stock=9)
+        self.paid = Order.objects.create(user=self.buyer, address="1 Street", status="Shipped")
+        OrderItem.objects.bulk_create([
+            OrderItem(order=self.paid, product=pad, quantity=2, unit_price=Decimal("18.00")),
+            OrderItem(order=self.paid, product=stick, unit_price=Decimal("5.00"))])
+        Payment.objects.create(order=self.paid, brand="visa", last4="4242")
+        self.old = Order.objects.create(address="2 Street")
+        Order.objects.filter(pk=self.old.pk).update(date=timezone.now() - timedelta(days=40))
+
+    def _export(self, **params):
+        response = self.client.get(reverse("export_orders"), params)
+        self.assertEqual(response.status_code, 200)
+        return b"".join(response.streaming_content).decode()
+
+    def test_staff_stream_csv_with_a_row_per_item(self):
+        self.client.force_login(self.staff)
+        rows = list(csv.DictReader(StringIO(self._export())))
+        self.assertEqual([(r["order_id"], r["product"]) for r in rows],
+                         [(str(self.old.pk), ""),
+                          (str(self.paid.pk), "Pad"), (str(self.paid.pk), "Stick")])
+        self.assertEqual(rows[1]["total"], "41.00")
+        self.assertEqual((rows[1]["sku"], rows[1]["subtotal"]), ("PAD-1", "36.00"))
+        self.assertEqual((rows[2]["payment_brand"], rows[2]["payment_last4"]), ("visa", "4242"))
+
+    def test_jsonl_filters_by_date_and_status(self):
+        self.client.force_login(self.staff)
+        today = timezone.localdate().isoformat()
+        lines = self._export(format="jsonl", start=today, end=today).splitlines()
+        self.assertEqual(len(lines), 1)
+        order = json.loads(lines[0])
+        self.assertEqual((order["id"], order["user"]["email"]), (self.paid.pk, "jane@example.com"))
+        self.assertEqual([i["quantity"] for i in order["items"]], [2, 1])
+        self.assertEqual(self._export(format="jsonl", status="Cancelled"), "")
+        self.assertEqual(self.client.get(reverse("export_orders"), {"start": "May"}).status_code, 400)
+
+    def test_only_staff_can_export(self):
+        self.client.force_login(self.buyer)
+        self.assertEqual(self.client.get(reverse("export_orders")).status_code, 302)
+
+    def test_command_queries_per_chunk_not_per_order(self):
+        for _ in range(8):
+            Order.objects.create(user=self.buyer, address="3 Street")
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "orders.jsonl")
+            with CaptureQueriesContext(connection) as ctx:
+                call_command("export_orders", path, chunk_size=5, stdout=StringIO())
+            with open(path) as file:
+                self.assertEqual(len(file.readlines()), 10)
+        # One query for the orders, fetched a chunk at a time, and one for
+        # the items of each of the two chunks
+        self.assertEqual(len(ctx), 3)
+
+
+class SalesRollupTests(TestCase):
+    """Checkout keeps the sales rollups current and the dashboard reads only them"""
+
+    def setUp(self):
+        cache.clear()
+        self.pads = ProductCategory.objects.create(name="Pads")
+        self.pad = Product.objects.create(name="Pad", price=Decimal("20.00"), stock=50,
+                                          category=self.pads)
+        self.stick = Product.objects.create(name="Stick", price=Decimal("5.00"), stock=50)
+
+    def _checkout(self, lines):
+        client = Client()
+        seed_cart(client, lines)
+        # The rollups are updated once the checkout commits
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(client.post(reverse("checkout"), CheckoutTests.form).status_code, 302)
+
+    def _rollups(self):
+        return {(r.period, r.start, r.dimension, r.key): (r.revenue, r.units, r.orders)
+                for r in SalesRollup.objects.all()}
+
+    def test_checkout_adds_to_day_and_week(self):
+        self._checkout([(self.pad, 2), (self.stick, 1)])
+        self._checkout([(self.pad, 1)])
+        today = timezone.localdate()
+        rollups_ = self._rollups()
+        for period, start in (("day", today), ("week", rollups.week_start(today))):
+            self.assertEqual(rollups_[(period, start, "all", 0)], (Decimal("65.00"), 4, 2))
+            self.assertEqual(rollups_[(period, start, "product", self.pad.pk)],
+                             (Decimal("60.00"), 3, 2))
+            self.assertEqual(rollups_[(period, start, "category", self.pads.pk)],
+                             (Decimal("60.00"), 3, 2))
+            # Products without a category or range roll up under key 0
+            self.assertEqual(rollups_[(period, start, "range", 0)], (Decimal("65.00"), 4, 2))
+        # All, two products, category and none, range none
+        self.assertEqual(len(rollups_), 2 * 6)
+
+    def test_rollups_are_updated_after_the_checkout_commits(self):
+        client = Client()
+        seed_cart(client, [(self.pad, 1)])
+        with self.captureOnCommitCallbacks() as callbacks:
+            client.post(reverse("checkout"), CheckoutTests.form)
+        self.assertFalse(SalesRollup.objects.exists())
+        for callback in callbacks:
+            callback()
+        self.assertEqual(SalesRollup.objects.get(period="day", dimension="all").revenue,
+                         Decimal("20.00"))
+
+    def test_backfill_rebuilds_what_checkout_wrote(self):
+        self._checkout([(self.pad, 2), (self.stick, 1)])
+        self._checkout([(self.stick, 3)])
+        # An order from another week, written without checkout
+        old = Order.objects.create(address="1 Street")
+        Order.objects.filter(pk=old.pk).update(date=timezone.now() - timedelta(days=9))
+        OrderItem.objects.create(order=old, product=self.pad, quantity=1,
+                                 unit_price=Decimal("19.99"))
+        live = self._rollups()
+
+        SalesRollup.objects.all().delete()
+        out = StringIO()
+        call_command("backfill_rollups", window_weeks=1, include_current_week=True, stdout=out)
+        rebuilt = self._rollups()
+        self.assertIn(f"Wrote {len(rebuilt)} sales rollups.", out.getvalue())
+        old_day = timezone.localdate(timezone.now() - timedelta(days=9))
+        self.assertEqual(rebuilt.pop(("day", old_day, "product", self.pad.pk)),
+                         (Decimal("19.99"), 1, 1))
+        rebuilt = {k: v for k, v in rebuilt.items() if k[1] >= rollups.week_start(timezone.localdate())}
+        self.assertEqual(rebuilt, live)
+
+    def test_backfill_leaves_the_current_week_to_checkout(self):
+        self._checkout([(self.pad, 1)])
+        live = self._rollups()
+        old_day = timezone.localdate() - timedelta(days=14)
+        SalesRollup.objects.create(period="day", start=old_day, dimension="all",
+                                   revenue=Decimal("99.00"), units=1, orders=1)
+        # Its order was deleted, a rebuild of that range clears it
+        self.assertEqual(rollups.backfill(first=old_day), 0)
+        self.assertEqual(self._rollups(), live)
+        Order.objects.all().delete()
+        SalesRollup.objects.create(period="day", start=old_day, dimension="all",
+                                   revenue=Decimal("99.00"), units=1, orders=1)
+        call_command("backfill_rollups", start=old_day, stdout=StringIO())
+        self.assertEqual(self._rollups(), live)
+
+    def test_dashboard_reads_only_rollups(self):
+        self._checkout([(self.pad, 2), (self.stick, 1)])
+        staff = User.objects.bulk_create([User(username="staff", is_staff=True)])[0]
+        self.assertEqual(self.client.get(reverse("sales_dashboard")).status_code, 302)
+        self.client.force_login(staff)
+        for period in ("day", "week"):
+            with CaptureQueriesContext(connection) as ctx:
+                resp = self.client.get(reverse("sales_dashboard"), {"period": period})
+            self.assertEqual(resp.context["revenue"], Decimal("45.00"))
+            self.assertEqual(resp.context["top"][0][1][0]["name"], "Pad")
+            self.assertFalse([q for q in ctx.captured_queries
+                              if "storefront_order" in q["sql"]])
+        self.assertEqual(len(resp.context["series"]), 12)
+
+
+class RecommendationTests(TestCase):
+    """Products bought together are scored from the orders and shown on the product page"""
+
+    def setUp(self):
+        cache.clear()
+        self.pad, self.stick, self.case, self.cable = (
+            Product.objects.create(name=name, price=Decimal("10.00"), stock=50)
+            for name in ("Pad", "Stick", "Case", "Cable"))
+        for basket in ([self.pad, self.stick], [self.pad, self.stick], [self.pad, self.case],
+                       [self.pad, self.case], [self.pad, self.stick, self.case], [self.cable]):
+            self._order(basket)
+        # Placed well before any build, out of refresh()'s rescan
+        self._age_orders()
+
+    def _age_orders(self):
+        Order.objects.update(date=timezone.now() - recommendations.RESCAN - timedelta(hours=1))
+
+    def _order(self, basket):
+        order = Order.objects.create(address="1 Street")
+        for product in basket:
+            OrderItem.objects.create(order=order, product=product, unit_price=product.price)
+
+    def _recommended(self):
+        rows = ProductRecommendation.objects.order_by("product", "rank")
+        return {(r.product_id, r.rank): (r.recommended_id, round(r.score, 4)) for r in rows}
+
+    def test_build_scores_pairs_by_cosine_similarity(self):
+        result = recommendations.build()
+        self.assertEqual(result, {"products": 4, "recommendations": 4,
+                                  "through_order": Order.objects.latest("pk").pk})
+        # Pad is in 5 orders, Stick and Case in 3, each shares 3 with Pad
+        # and only 1 with each other, under MIN_ORDERS
+        score = round(3 / (5 * 3) ** 0.5, 4)
+        self.assertEqual(self._recommended(), {
+            (self.pad.pk, 0): (self.stick.pk, score), (self.pad.pk, 1): (self.case.pk, score),
+            (self.stick.pk, 0): (self.pad.pk, score), (self.case.pk, 0): (self.pad.pk, score)})
+
+    def test_refresh_redoes_only_products_ordered_since(self):
+        recommendations.build()
+        self._order([self.stick, self.case])
+        before = ProductRecommendation.objects.get(product=self.pad, rank=0).pk
+
+        out = StringIO()
+        call_command("build_recommendations", stdout=out)
+        self.assertIn("Wrote 4 recommendations for 2 products", out.getvalue())
+        self.assertFalse(RecommendationBuild.objects.latest("pk").full)
+        refreshed = self._recommended()
+        # Stick and Case now share 2 orders, and rank each other second
+        self.assertEqual(refreshed[(self.stick.pk, 1)], (self.case.pk, round(2 / 4, 4)))
+        self.assertEqual(refreshed[(self.case.pk, 1)], (self.stick.pk, round(2 / 4, 4)))
+        # Pad wasn't ordered, its rows were left alone
+        self.assertEqual(ProductRecommendation.objects.get(product=self.pad, rank=0).pk, before)
+
+        # Nothing ordered since, nothing to do
+        self._age_orders()
+        self.assertEqual(recommendations.refresh()["products"], 0)
+        # A full build agrees on the refreshed products
+        recommendations.build()
+        rebuilt = self._recommended()
+        for product in (self.stick, self.case):
+            self.assertEqual({k: v for k, v in rebuilt.items() if k[0] == product.pk},
+                             {k: v for k, v in refreshed.items() if k[0] == product.pk})
+
+    def test_refresh_reads_orders_that_committed_after_a_lower_id_was_read(self):
+        # An order takes its id, then the build reads past it before it commits
+        late = Order.objects.create(address="1 Street")
+        self._order([self.cable])
+        Order.objects.filter(pk=late.pk).delete()
+        recommendations.build()
+        self.assertEqual(RecommendationBuild.objects.latest("pk").through_order, late.pk + 1)
+
+        late = Order.objects.create(pk=late.pk, address="1 Street")
+        for product in (self.stick, self.case):
+            OrderItem.objects.create(order=late, product=product, unit_price=product.price)
+        # Cable's order is in the rescan too
+        self.assertEqual(recommendations.refresh()["products"], 3)
+        self.assertEqual(self._recommended()[(self.stick.pk, 1)], (self.case.pk, round(2 / 4, 4)))
+
+    def test_product_page_shows_customers_also_bought(self):
+        url = reverse("product", args=[self.pad.id])
+        self.assertEqual(list(self.client.get(url).context["also_bought"]), [])
+
+        recommendations.build()
+        resp = self.client.get(url)
+        self.assertEqual(list(resp.context["also_bought"]), [self.stick, self.case])
+        self.assertContains(resp, "Customers Also Bought")
+
+        # Hidden products aren't recommended, and the change shows at once
+        self.stick.display_item = False
+        self.stick.save()
+        with CaptureQueriesContext(connection) as ctx:
+            resp = self.client.get(url)
+        self.assertEqual(list(resp.context["also_bought"]), [self.case])
+        lookups = [q["sql"] for q in ctx.captured_queries if "productrecommendation" in q["sql"]]
+        self.assertEqual(len(lookups), 1)
@@ -1,7 +1,7 @@
 from django.urls import path, include
 from django.http import HttpResponse
 from django.urls import get_resolver
-from . import views
+from . import api, views
 from .views import SignUpView
 
 def _routes(_request):
@@ -24,14 +24,26 @@ urlpatterns = [
     path("checkout/", views.checkout, name="checkout"),
     path("checkout/success/<int:order_id>/", views.checkoutsuccess, name="checkoutsuccess"),
 
+    path("api/v1/products/", api.products, name="api_products"),
+    path("api/v1/products/<int:pk>/", api.product, name="api_product"),
+    path("api/v1/products/<int:pk>/reviews/", api.reviews, name="api_reviews"),
+    path("api/v1/cart/", api.cart, name="api_cart"),
+    path("api/v1/cart/items/", api.cart_items, name="api_cart_items"),
+    path("api/v1/cart/items/<int:product_id>/", api.cart_item, name="api_cart_item"),
+    path("api/v1/checkout/", api.checkout, name="api_checkout"),
+
     path("accounts/signup/", SignUpView.as_view(), name="signup"),
     path("accounts/", include("django.contrib.auth.urls")),
 
     path("_routes/", _routes, name="_routes"),
 
     # Contact message management URLs
-    # path('message/<int:message_id>/read/', views.mark_message_read, name='mark_message_read'),
-    # path('message/<int:message_id>/unread/', views.mark_message_unread, name='mark_message_unread'),
-    # path('message/<int:message_id>/delete/', views.delete_message, name='delete_message')
+    path('message/<int:message_id>/read/', views.mark_message_read, name='mark_message_read'),
+    path('message/<int:message_id>/unread/', views.mark_message_unread, name='mark_message_unread'),
+    path('message/<int:message_id>/delete/', views.delete_message, name='delete_message'),
+    path('messages/bulk/', views.bulk_update_messages, name='bulk_update_messages'),
+
+    path("staff/orders/export/", views.export_orders, name="export_orders"),
+    path("staff/sales/", views.sales_dashboard, name="sales_dashboard"),
 ]
 
@@ -3,23 +3,29 @@ from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib import messages
 from django.contrib.auth import login, authenticate
 from django.contrib.auth.models import User
-from django.contrib.auth.decorators import login_required
-from django.core.mail import send_mail
+from django.contrib.auth.decorators import login_required, user_passes_test
 from django.conf import settings
-from django.db import models
-from django.urls import reverse_lazy
-from django.views.decorators.http import require_POST
+from django.db import transaction
+from django.db.models import Count, Prefetch, Q
+from django.http import HttpResponseBadRequest, StreamingHttpResponse
+from django.urls import reverse, reverse_lazy
+from django.utils import timezone
+from django.utils.http import url_has_allowed_host_and_scheme, urlencode
+from django.views.decorators.http import require_GET, require_POST
 from django.views.generic import FormView
 from .models import Customer, Product, Order, OrderItem, Review
-from .models import ContactMessage
+from .models import ContactMessage, OutOfStock, Payment, SalesRollup, star_icons
 from .forms import ContactForm, ReviewForm, SignUpForm
+from . import caching, carts, exports, listing, outbox, recommendations, rollups
 import re
+from datetime import date, timedelta
 from .models import Customer, Product, Order, OrderItem, Review, ContactMessage
 
 
 
 
-CART_SESSION_KEY = "cart"
+REVIEWS_PAGE_SIZE = 20
+REVIEW_KEYS = (("created_at", True), ("id", True))
 
 
 def home(request):
@@ -29,81 +35,101 @@ def home(request):
     return render(request, "index.html")
 
 
+@require_GET
 def products(request):
     """
-        Returns a rendered view to display all products with search and
-        sort functionality
+        Returns a rendered view to display one page of products with search,
+        sort and facet filters taken from the query string, so every result
+        page can be linked and cached.
     """
-    # Get all products that are marked for display
-    products = Product.objects.all().filter(display_item=True)
-    # Update sale price to price for all products not on discount
-    # this for price ordering purposes and check stock to update tagline
-    # if any products is out of stock.
-    for product in products:
-        product.update_sale_price()
-        product.check_stock()
-
-    # Handle POST requests for search and sort requests
-    if request.method == "POST":
-        query = request.POST.get('search')
-        sort = request.POST.get('sort')
-
-        # Handles search query
-        if query:
-            products = products.filter(name__icontains=query)
-
-        # Handles product sorting
-        products = products.order_by('name')
-        if sort == "non-alphabetical":
-            products = products.order_by('-name')
-        elif sort == "lowest-price":
-            products = products.order_by('sale_price')
-        elif sort == "highest-price":
-            products = products.order_by('-sale_price')
-
-        # Return the rendered view with the filtered products
-        return render(request, "products.html", {'products': products,
-                                                 "count": len(products),
-                                                 "query": query,
-                                                 "sort": sort})
-    else:
-        # Return all display-able products ordered alphabetically by default
-        products = products.order_by('name')
-        return render(request, "products.html", {'products': products,
-                                                 "count": len(products)})
+    params = listing.parse_params(request.GET)
+    # Sale price and the out of stock tagline are kept up to date by
+    # Product.save(), so this page only ever reads.
+    page = caching.get_or_set(caching.listing_key(**params),
+                              lambda: listing.build_listing(params))
+
+    facets = page["facets"]
+    for name, facet in (("category", facets["categories"]), ("range", facets["ranges"])):
+        for option in facet:
+            option["selected"] = option["id"] == params[name]
+            option["url"] = _products_url(
+                params, **{name: None if option["selected"] else option["id"]})
+
+    return render(request, "products.html", {
+        'products': page["products"],
+        "count": page["count"],
+        "facets": facets,
+        "query": params["search"],
+        "suggestion": page["suggestion"],
+        "sort": params["sort"],
+        "min_rating": params["min_rating"],
+        "category": params["category"],
+        "range": params["range"],
+        "next_url": page["next"] and _products_url(params, after=page["next"]),
+        "previous_url": page["previous"] and _products_url(params, before=page["previous"]),
+    })
+
+
+def _products_url(params, **changes):
+    """
+        Builds a products page URL from the current listing parameters with
+        some changed. Changing anything but the page starts from page one.
+    """
+    query = {**params, "after": "", "before": "", **changes}
+    query = {k: v for k, v in query.items() if v not in (None, "")}
+    return f"{reverse('products')}?{urlencode(query)}" if query else reverse('products')
 
 
 def product(request, pk):
     """
         Returns a rendered view for displaying a single product passed in
-        the URL.
+        the URL, with one page of its reviews, newest first.
     """
-    product = Product.objects.get(id=pk)
-    review_count = Review.objects.filter(product=product).count()
+    after = listing.decode_cursor(request.GET.get("reviews_after"), REVIEW_KEYS, Review)
+    before = listing.decode_cursor(request.GET.get("reviews_before"), REVIEW_KEYS, Review)
+
+    def load():
+        product = Product.objects.get(id=pk)
+        page = listing.keyset_page(
+            Review.objects.filter(product=product).select_related("user"), REVIEW_KEYS,
+            after=after, before=before, size=REVIEWS_PAGE_SIZE)
+        return product, page
+
+    product, page = caching.get_or_set(
+        f"{caching.product_key(pk)}:reviews:{caching.cursor_digest(after, before)}", load)
+    # Precomputed by the recommendations job, one indexed lookup
+    also_bought = caching.get_or_set(caching.also_bought_key(pk),
+                                     lambda: recommendations.also_bought(pk))
+    summary = product.rating_summary()
+    review_count = summary["count"]
     if review_count >= 1:
-        review_per_star = {i: [Review.objects.filter(product=product, rating=i).count(
-        ), f"{round((Review.objects.filter(product=product, rating=i).count()/review_count)*100)}%"] for i in range(5, 0, -1)}
-        avg_rating = round(Review.objects.filter(
-            product=product).aggregate(models.Avg('rating'))['rating__avg'], 1)
-        stars = []
-        counter = round(avg_rating * 2) / 2
-        for _ in range(5):
-            if counter - 1 >= 0:
-                stars.append("fas fa-star")
-                counter -= 1
-            elif counter - 0.5 == 0:
-                stars.append("fas fa-star-half-alt")
-            else:
-                stars.append("far fa-star")
-        overall_review = [avg_rating, stars]
-        reviews = Review.objects.all().filter(product=product)
-        return render(request, "product.html", {'product': product,
-                                                'review_per_star': review_per_star,
-                                                'review_count': review_count,
-                                                'overall_review': overall_review,
-                                                'reviews': reviews})
+        def page_url(**cursor):
+            return f"{reverse('product', args=[pk])}?{urlencode(cursor)}#reviews"
+
+        return render(request, "product.html", {
+            'product': product,
+            'review_count': review_count,
+            'also_bought': also_bought,
+            'reviews': page["items"],
+            'reviews_next_url': page["next"] and page_url(reviews_after=page["next"]),
+            'reviews_previous_url': page["previous"] and page_url(reviews_before=page["previous"]),
+            **_review_summary_context(summary)})
     return render(request, "product.html", {'product': product,
-                                            'review_count': review_count})
+                                            'review_count': review_count,
+                                            'also_bought': also_bought})
+
+
+def _review_summary_context(summary):
+    """
+        Builds the star breakdown and overall rating shown on the product
+        page from a rating summary (see Product.rating_summary).
+    """
+    count = summary["count"]
+    review_per_star = {star: [n, f"{round((n / count) * 100)}%"]
+                       for star, n in summary["histogram"].items()}
+    avg_rating = round(summary["average"], 1)
+    return {"review_per_star": review_per_star,
+            "overall_review": [avg_rating, star_icons(avg_rating)]}
 
 
 def about(request):
@@ -115,20 +141,15 @@ def contact(request):
     if request.method == 'POST':
         form = ContactForm(request.POST)
         if form.is_valid():
-            # Save the contact message to database
-            contact_message = form.save()
-
-            # Send email notification to admin (need to fix this)
-            try:
-                send_mail(
+            # Save the message and queue the admin notification together,
+            # the outbox worker sends it outside the request
+            with transaction.atomic():
+                contact_message = form.save()
+                outbox.enqueue(
                     subject=f'New Contact Form: {contact_message.subject}',
-                    message=f'From: {contact_message.name} ({contact_message.email})\n\n{contact_message.message}',
-                    from_email=settings.DEFAULT_FROM_EMAIL,
-                    recipient_list=[settings.ADMIN_EMAIL],
-                    fail_silently=True,
+                    body=f'From: {contact_message.name} ({contact_message.email})\n\n{contact_message.message}',
+                    to=[settings.ADMIN_EMAIL],
                 )
-            except Exception as e:
-                print(f"Email error: {e}")
 
             # Add success message
             messages.success(
@@ -145,70 +166,194 @@ def contact(request):
 
 @login_required
 def account(request):
-    if request.user.is_authenticated:
-        all_messages = ContactMessage.objects.all()
-        total_messages = ContactMessage.objects.count()
-        unread_messages = ContactMessage.objects.filter(
-            created_at__gte=request.user.last_login).count()
-        orders = Order.objects.all().filter(
-            user=request.user).order_by('id')
-        return render(request, "account.html", {"user": request.user,
-                                                "orders": orders,
-                                                "contact_messages": all_messages,
-                                                "total_messages": total_messages,
-                                                "unread_messages": unread_messages})
-
-
-def _get_cart(session):
-    return session.setdefault(CART_SESSION_KEY, {})
-
-
-def _cart_items(cart):
-    if not cart:
-        return []
-    products = {p.id: p for p in Product.objects.filter(
-        id__in=[int(pid) for pid in cart.keys()])}
-    items = []
-    for pid, qty in cart.items():
-        p = products.get(int(pid))
-        if not p:
-            continue
-        q = int(qty)
-        unit_price = p.sale_price if getattr(p, "discount", False) else p.price
-        items.append({"product": p, "quantity": q,
-                     "unit_price": unit_price, "subtotal": q * unit_price})
-    return items
-
-
-def _totals(items):
-    total = sum(i["subtotal"] for i in items)
-    count = sum(i["quantity"] for i in items)
-    return total, count
+    if request.user.is_staff:
+        return _inbox(request)
+    orders = (Order.objects.filter(user=request.user).with_totals()
+              .prefetch_related(Prefetch(
+                  "orderitem_set",
+                  queryset=OrderItem.objects.select_related("product")))
+              .order_by('id'))
+    return render(request, "account.html", {"user": request.user,
+                                            "orders": orders})
+
+
+# --------------------
+# Staff inbox
+# --------------------
+INBOX_PAGE_SIZE = 20
+INBOX_KEYS = (("created_at", True), ("id", True))
+
+
+def _inbox(request):
+    """
+        Renders one page of contact messages, newest first, for staff.
+        The page is read with a keyset cursor and both counts come from
+        one aggregate, so the cost doesn't grow with the inbox.
+    """
+    unread_only = request.GET.get("filter") == "unread"
+    messages_qs = ContactMessage.objects.all()
+    if unread_only:
+        messages_qs = messages_qs.filter(is_read=False)
+    page = listing.keyset_page(
+        messages_qs, INBOX_KEYS,
+        after=listing.decode_cursor(request.GET.get("after"), INBOX_KEYS, ContactMessage),
+        before=listing.decode_cursor(request.GET.get("before"), INBOX_KEYS, ContactMessage),
+        size=INBOX_PAGE_SIZE)
+    counts = ContactMessage.objects.aggregate(
+        total=Count("id"), unread=Count("id", filter=Q(is_read=False)))
+
+    def page_url(**cursor):
+        query = {k: v for k, v in {"filter": "unread" if unread_only else "", **cursor}.items() if v}
+        return f"{reverse('account')}?{urlencode(query)}" if query else reverse('account')
+
+    return render(request, "account.html", {
+        "user": request.user,
+        "contact_messages": page["items"],
+        "total_messages": counts["total"],
+        "unread_messages": counts["unread"],
+        "unread_only": unread_only,
+        "current_url": request.get_full_path(),
+        "next_url": page["next"] and page_url(after=page["next"]),
+        "previous_url": page["previous"] and page_url(before=page["previous"]),
+    })
+
+
+def _back_to_inbox(request):
+    next_url = request.POST.get("next")
+    if next_url and url_has_allowed_host_and_scheme(next_url, allowed_hosts={request.get_host()}):
+        return redirect(next_url)
+    return redirect("account")
+
+
+staff_required = user_passes_test(lambda user: user.is_staff)
+
+
+@staff_required
+@require_POST
+def mark_message_read(request, message_id):
+    ContactMessage.objects.filter(pk=message_id).update(is_read=True)
+    return _back_to_inbox(request)
+
+
+@staff_required
+@require_POST
+def mark_message_unread(request, message_id):
+    ContactMessage.objects.filter(pk=message_id).update(is_read=False)
+    return _back_to_inbox(request)
+
+
+@staff_required
+@require_POST
+def delete_message(request, message_id):
+    ContactMessage.objects.filter(pk=message_id).delete()
+    messages.info(request, "Message deleted.")
+    return _back_to_inbox(request)
+
+
+@staff_required
+@require_POST
+def bulk_update_messages(request):
+    """Applies the chosen action to every selected message with one statement."""
+    ids = [int(pk) for pk in request.POST.getlist("ids") if pk.isdigit()]
+    selected = ContactMessage.objects.filter(pk__in=ids)
+    action = request.POST.get("action")
+    if not ids:
+        messages.warning(request, "No messages selected.")
+    elif action == "read":
+        messages.info(request, f"Marked {selected.update(is_read=True)} messages as read.")
+    elif action == "unread":
+        messages.info(request, f"Marked {selected.update(is_read=False)} messages as unread.")
+    elif action == "delete":
+        deleted, _ = selected.delete()
+        messages.info(request, f"Deleted {deleted} messages.")
+    return _back_to_inbox(request)
+
+
+# --------------------
+# Staff exports
+# --------------------
+def _day(value):
+    return date.fromisoformat(value) if value else None
+
+
+@staff_required
+@require_GET
+def export_orders(request):
+    """
+        Streams the orders placed from ?start= to ?end= (YYYY-MM-DD, both
+        optional) with their items and payments as CSV, or JSON Lines
+        with ?format=jsonl. ?status= keeps orders with that status.
+    """
+    fmt = request.GET.get("format") or "csv"
+    try:
+        start, end = _day(request.GET.get("start")), _day(request.GET.get("end"))
+    except ValueError:
+        return HttpResponseBadRequest("Dates must be given as YYYY-MM-DD.")
+    if fmt not in exports.FORMATS:
+        return HttpResponseBadRequest(f"Format must be one of {', '.join(exports.FORMATS)}.")
+
+    orders = exports.orders(start, end, request.GET.get("status"))
+    response = StreamingHttpResponse(exports.lines(orders, fmt),
+                                     content_type=exports.CONTENT_TYPES[fmt])
+    span = "-".join(str(day) for day in (start, end) if day) or "all"
+    response["Content-Disposition"] = f'attachment; filename="orders-{span}.{fmt}"'
+    return response
+
+
+# --------------------
+# Staff sales dashboard
+# --------------------
+DASHBOARD_PERIODS = {SalesRollup.DAY: 30, SalesRollup.WEEK: 12}
+
+
+@staff_required
+@require_GET
+def sales_dashboard(request):
+    """
+        Shows revenue, units and orders per day for the last 30 days, or
+        per week for the last 12 with ?period=week, and what sold best.
+        Reads only the sales rollups, never the orders.
+    """
+    period = request.GET.get("period")
+    if period not in DASHBOARD_PERIODS:
+        period = SalesRollup.DAY
+    last = timezone.localdate()
+    if period == SalesRollup.WEEK:
+        last = rollups.week_start(last)
+        first = last - timedelta(weeks=DASHBOARD_PERIODS[period] - 1)
+    else:
+        first = last - timedelta(days=DASHBOARD_PERIODS[period] - 1)
+
+    series = rollups.series(period, first, last)
+    peak = max((r.revenue for r in series), default=0) or 1
+    for row in series:
+        row.share = round(row.revenue / peak * 100)
+    return render(request, "sales.html", {
+        "period": period,
+        "first": first,
+        "last": last,
+        "series": series,
+        "revenue": sum(r.revenue for r in series),
+        "units": sum(r.units for r in series),
+        "orders": sum(r.orders for r in series),
+        "top": [(title, rollups.top(period, dimension, first, last))
+                for title, dimension in (("Products", SalesRollup.PRODUCT),
+                                         ("Categories", SalesRollup.CATEGORY),
+                                         ("Ranges", SalesRollup.RANGE))],
+    })
 
 
 def cart(request):
-    cart_dict = _get_cart(request.session)
-    items = _cart_items(cart_dict)
-    total, count = _totals(items)
+    items = carts.items(carts.get_cart(request))
+    total, count = carts.totals(items)
     return render(request, "cart.html", {"items": items, "total": total, "count": count})
 
 
 @require_POST
 def add_to_cart(request, product_id):
     product = get_object_or_404(Product, pk=product_id)
-    qty = max(1, int(request.POST.get("qty", 1)))
-
-    if product.stock and qty > product.stock:
-        qty = product.stock
-
-    cart_dict = _get_cart(request.session)
-    pid = str(product.id)
-    new_qty = int(cart_dict.get(pid, 0)) + qty
-    if product.stock and new_qty > product.stock:
-        new_qty = product.stock
-
-    cart_dict[pid] = new_qty
-    request.session.modified = True
+    qty = carts.add(carts.get_cart(request, create=True), product,
+                    request.POST.get("qty", 1))
 
     messages.success(request, f"Added {qty} × {product.name} to cart.")
     return redirect("cart")
@@ -216,111 +361,45 @@ def add_to_cart(request, product_id):
 
 @require_POST
 def remove_from_cart(request, product_id):
-    cart_dict = _get_cart(request.session)
-    pid = str(product_id)
-    if pid in cart_dict:
-        del cart_dict[pid]
-        request.session.modified = True
+    if carts.remove(carts.get_cart(request), product_id):
         messages.info(request, "Item removed from cart.")
     return redirect("cart")
 
 
 @require_POST
 def clear_cart(request):
-    request.session[CART_SESSION_KEY] = {}
-    request.session.modified = True
+    carts.clear(carts.get_cart(request))
     messages.info(request, "Cart cleared.")
     return redirect("cart")
 
 
 def checkout(request):
-    cart_dict = _get_cart(request.session)
-    items = _cart_items(cart_dict)
+    cart = carts.get_cart(request)
+    items = carts.items(cart)
     if not items:
         messages.warning(request, "Your cart is empty.")
         return redirect("home")
 
-    total, _ = _totals(items)
+    total, _ = carts.totals(items)
 
     if request.method == "POST":
-        # Shipping
-        first_name = request.POST.get("first_name", "").strip()
-        last_name  = request.POST.get("last_name", "").strip()
-        email      = request.POST.get("email", "").strip()
-        phone      = request.POST.get("phone", "").strip()
-        address    = request.POST.get("address", "").strip()
-
-        # Payment (demo)
-        card_name   = request.POST.get("card_name", "").strip()
-        card_number = (request.POST.get("card_number", "") or "").replace(" ", "")
-        card_exp    = request.POST.get("card_exp", "").strip()
-        card_cvc    = request.POST.get("card_cvc", "").strip()
-
-        # Basic validation
-        valid_num = re.fullmatch(r"\d{13,19}", card_number)
-        valid_exp = re.fullmatch(r"(0[1-9]|1[0-2])\/(\d{2})", card_exp)
-        valid_cvc = re.fullmatch(r"\d{3,4}", card_cvc)
-
-        if not all([first_name, last_name, email, phone, address, card_name, valid_num, valid_exp, valid_cvc]):
+        details = _checkout_details(request.POST)
+        if details is None:
             messages.error(request, "Please complete all fields with valid details.")
             return render(request, "checkout.html", {"items": items, "total": total})
+        shipping, payment = details
 
-        # Get or create a user
         try:
-            user = User.objects.get(first_name=first_name, last_name=last_name, email=email)
-        except User.DoesNotExist:
-            user = User.objects.create_user(
-                username=email,
-                first_name=first_name,
-                last_name=last_name,
-                email=email,
-                password=f"guest{phone}",
-            )
-
-        # Keep customers phone up to date if we have their profile
-        try:
-            cust = Customer.objects.get(user=user)
-            if phone and cust.phone != phone:
-                cust.phone = phone
-                cust.save(update_fields=["phone"])
-        except Customer.DoesNotExist:
-            pass
-
-        # Derive minimal payment data for demo receipt
-        brand = "visa" if card_number.startswith("4") else "card"
-        last4 = card_number[-4:]
-        exp_month = int(valid_exp.group(1))
-        exp_year  = 2000 + int(valid_exp.group(2))
-
-        # Create order
-        order = Order.objects.create(user=user, address=address)
-
-        # Add items and update stock
-        for i in items:
-            p = i["product"]
-            qty = i["quantity"]
-            OrderItem.objects.create(order=order, product=p, quantity=qty)
-            if p.stock is not None:
-                p.stock = max(0, p.stock - qty)
-                p.save(update_fields=["stock"])
-
-        from django.apps import apps
-
-        Payment = apps.get_model("storefront", "Payment")
-        Payment.objects.create(
-            order=order,
-            provider="demo",
-            brand=brand,
-            last4=last4,
-            exp_month=exp_month,
-            exp_year=exp_year,
-            status="succeeded",
-        )
+            order = _place_order(shipping, payment, items)
+        except OutOfStock as e:
+            names = ", ".join(p.name for p in e.short_products())
+            messages.error(request, f"Sorry, {names or 'an item in your cart'} "
+                                    "is out of stock for the quantity requested.")
+            return redirect("cart")
 
         # Clear cart & redirect
-        request.session[CART_SESSION_KEY] = {}
-        request.session.modified = True
-        
+        carts.clear(cart)
+
         return redirect("checkoutsuccess", order_id=order.id)
 
     # GET
@@ -328,6 +407,103 @@ def checkout(request):
 
 
 
+def _checkout_details(data):
+    """
+        Validates checkout form data and returns the (shipping, payment)
+        details _place_order() takes, or None if anything is missing or
+        invalid.
+    """
+    # Shipping
+    first_name = data.get("first_name", "").strip()
+    last_name  = data.get("last_name", "").strip()
+    email      = data.get("email", "").strip()
+    phone      = data.get("phone", "").strip()
+    address    = data.get("address", "").strip()
+
+    # Payment (demo)
+    card_name   = data.get("card_name", "").strip()
+    card_number = (data.get("card_number", "") or "").replace(" ", "")
+    card_exp    = data.get("card_exp", "").strip()
+    card_cvc    = data.get("card_cvc", "").strip()
+
+    # Basic validation
+    valid_num = re.fullmatch(r"\d{13,19}", card_number)
+    valid_exp = re.fullmatch(r"(0[1-9]|1[0-2])\/(\d{2})", card_exp)
+    valid_cvc = re.fullmatch(r"\d{3,4}", card_cvc)
+
+    if not all([first_name, last_name, email, phone, address, card_name, valid_num, valid_exp, valid_cvc]):
+        return None
+
+    # Derive minimal payment data for demo receipt
+    payment = {
+        "provider": "demo",
+        "brand": "visa" if card_number.startswith("4") else "card",
+        "last4": card_number[-4:],
+        "exp_month": int(valid_exp.group(1)),
+        "exp_year": 2000 + int(valid_exp.group(2)),
+        "status": "succeeded",
+    }
+    shipping = {"first_name": first_name, "last_name": last_name,
+                "email": email, "phone": phone, "address": address}
+    return shipping, payment
+
+
+@transaction.atomic
+def _place_order(shipping, payment, items):
+    """
+        Writes a whole order as one unit of work: customer, stock
+        reservation, order, order items, payment and the confirmation
+        email, then the sales rollups once it commits. The number of
+        statements doesn't depend on the number of items. Raises OutOfStock
+        with nothing written if any item can't be fulfilled.
+    """
+    # Get or create a user
+    try:
+        user = User.objects.get(first_name=shipping["first_name"],
+                                last_name=shipping["last_name"],
+                                email=shipping["email"])
+    except User.DoesNotExist:
+        user = User.objects.create_user(
+            username=shipping["email"],
+            first_name=shipping["first_name"],
+            last_name=shipping["last_name"],
+            email=shipping["email"],
+            password=f"guest{shipping['phone']}",
+        )
+
+    # Keep customers phone up to date if we have their profile
+    phone = shipping["phone"]
+    if phone:
+        Customer.objects.filter(user=user).exclude(phone=phone).update(phone=phone)
+
+    quantities = {i["product"].id: i["quantity"] for i in items}
+    Product.objects.reserve_stock(quantities)
+    caching.invalidate_products(quantities)
+
+    order = Order.objects.create(user=user, address=shipping["address"])
+    OrderItem.objects.bulk_create([
+        OrderItem(order=order, product=i["product"], quantity=i["quantity"],
+                  unit_price=i["unit_price"])
+        for i in items])
+    Payment.objects.create(order=order, **payment)
+    rollups.record_order(order, items)
+    _queue_order_confirmation(order, shipping, items)
+    return order
+
+
+def _queue_order_confirmation(order, shipping, items):
+    total, _ = carts.totals(items)
+    lines = "\n".join(f"{i['quantity']} x {i['product'].name} @ ${i['unit_price']}"
+                      for i in items)
+    outbox.enqueue(
+        subject=f"Your Wavelength order #{order.id}",
+        body=(f"Hi {shipping['first_name']},\n\n"
+              f"Thanks for your order. We'll ship it to:\n{shipping['address']}\n\n"
+              f"{lines}\n\nTotal: ${total}\n"),
+        to=[shipping["email"]],
+    )
+
+
 def checkoutsuccess(request, order_id):
     order = get_object_or_404(Order, pk=order_id)
     return render(request, "checkoutsuccess.html", {"order": order})